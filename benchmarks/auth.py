@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Auth file load, reload and token lookup throughput.
+
+Builds auth file with ``--tokens`` brokers and measures index build time
+and ``AuthenticationPolicy.get_user`` lookups with and without token cache.
+
+    python benchmarks/auth.py --tokens 100000
+"""
+import argparse
+import os
+from hashlib import sha512
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+from timeit import timeit
+
+from openregistry.api.auth import AuthenticationPolicy
+
+
+def write_auth_file(path, tokens):
+    with open(path, 'w') as auth_file:
+        auth_file.write('[brokers]\n')
+        for i, token in enumerate(tokens):
+            auth_file.write('broker{} = {},1234\n'.format(i, sha512(token).hexdigest()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Auth lookup benchmark ----')
+    parser.add_argument('--tokens', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=100000)
+    params = parser.parse_args()
+    tokens = [os.urandom(16).encode('hex') for i in xrange(params.tokens)]
+    directory = mkdtemp()
+    try:
+        path = os.path.join(directory, 'auth.ini')
+        write_auth_file(path, tokens)
+        start = time()
+        policy = AuthenticationPolicy(path, cache_size=params.tokens)
+        print 'load {} tokens: {:.2f} s'.format(len(policy.users), time() - start)
+
+        hot = tokens[:1000]
+        lookups = [hot[i % len(hot)] for i in xrange(params.lookups)]
+
+        def uncached():
+            for token in lookups:
+                policy.users.get(sha512(token).hexdigest())
+
+        def cached():
+            for token in lookups:
+                policy.get_user(token)
+
+        for name, func in [('sha512 + index', uncached), ('token cache', cached)]:
+            seconds = timeit(func, number=1)
+            print '{:>16}: {:>10.0f} lookups/s'.format(name, params.lookups / seconds)
+
+        write_auth_file(path, tokens[1:])
+        os.utime(path, (time() + 1, time() + 1))
+        start = time()
+        policy.auth_file.reload()
+        print 'reload {} tokens: {:.2f} s'.format(len(policy.users), time() - start)
+    finally:
+        rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
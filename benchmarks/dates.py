@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Import and export time of revision heavy documents.
+
+Compares ``iso8601.parse_date``/``isoformat`` for every date field with
+cached ``IsoDateTimeType`` codec of
+``openregistry.api.models.schematics_extender``.
+
+    python benchmarks/dates.py --revisions 10,100,1000
+"""
+import argparse
+from datetime import timedelta
+from timeit import timeit
+from uuid import uuid4
+
+from iso8601 import parse_date
+from schematics.types import StringType
+from schematics.types.compound import ModelType
+
+from openregistry.api.constants import TZ
+from openregistry.api.models.common import BaseResourceItem
+from openregistry.api.models.ocds import Document, Period
+from openregistry.api.models.roles import plain_role
+from openregistry.api.models.schematics_extender import (
+    ListType, IsoDateTimeType, PARSED_DATES, FORMATTED_DATES
+)
+from openregistry.api.utils import get_now
+
+
+class Asset(BaseResourceItem):
+    class Options:
+        roles = {'plain': plain_role}
+
+    title = StringType(required=True)
+    period = ModelType(Period)
+    documents = ListType(ModelType(Document), default=list())
+
+
+def asset(revisions):
+    now = get_now()
+    dates = [(now + timedelta(minutes=i)).isoformat() for i in xrange(revisions)]
+    return {
+        '_id': uuid4().hex,
+        'title': u'asset',
+        'dateModified': dates[-1],
+        'period': {'startDate': dates[0], 'endDate': dates[-1]},
+        'documents': [{
+            'id': uuid4().hex,
+            'title': u'document {}'.format(i),
+            'url': u'http://localhost/get/{}'.format(uuid4().hex),
+            'datePublished': dates[i],
+            'dateModified': dates[i],
+        } for i in xrange(0, revisions, 10)],
+        'revisions': [{
+            'author': u'broker',
+            'date': date,
+            'changes': [{'op': 'replace', 'path': '/dateModified', 'value': date}],
+        } for date in dates],
+    }
+
+
+def to_native(self, value, context=None):
+    if not hasattr(value, 'isoformat'):
+        value = parse_date(value, None)
+        if not value.tzinfo:
+            value = TZ.localize(value)
+    return value
+
+
+def to_primitive(self, value, context=None):
+    return value.isoformat()
+
+
+def roundtrip(data):
+    return Asset(data).serialize()
+
+
+def measure(data, number):
+    return timeit(lambda: roundtrip(data), number=number) * 1000 / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Date codec benchmark ----')
+    parser.add_argument('--revisions', default='10,100,1000', help='Revisions per asset')
+    parser.add_argument('--number', type=int, default=20)
+    params = parser.parse_args()
+    print '{:>10} {:>12} {:>12} {:>8}'.format('revisions', 'iso8601 ms', 'cached ms', 'speedup')
+    for revisions in [int(i) for i in params.revisions.split(',')]:
+        data = asset(revisions)
+        cached_to_native, cached_to_primitive = IsoDateTimeType.to_native, IsoDateTimeType.to_primitive
+        IsoDateTimeType.to_native, IsoDateTimeType.to_primitive = to_native, to_primitive
+        try:
+            expected = roundtrip(data)
+            old = measure(data, params.number)
+        finally:
+            IsoDateTimeType.to_native, IsoDateTimeType.to_primitive = cached_to_native, cached_to_primitive
+        PARSED_DATES.clear()
+        FORMATTED_DATES.clear()
+        assert roundtrip(data) == expected
+        new = measure(data, params.number)
+        print '{:>10} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(revisions, old, new, old / new)
+
+
+if __name__ == '__main__':
+    main()
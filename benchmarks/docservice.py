@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""GET latency of resources with docservice documents.
+
+Serializes resource with ``--documents`` documents stored in document
+service, as GET view does, with previous signing of every URL, with cold
+signature cache (first GET of the resource) and with warm cache.
+
+    python benchmarks/docservice.py --documents 10,100,500
+"""
+import argparse
+from base64 import b64encode
+from timeit import timeit
+from urllib import quote, urlencode
+from urlparse import urlparse, urlunsplit
+from uuid import uuid4
+
+from libnacl.sign import Signer
+from pyramid import testing
+from pyramid.request import Request
+from schematics.types import StringType
+from schematics.types.compound import ModelType
+
+from openregistry.api import utils
+from openregistry.api.models.ocds import Document
+from openregistry.api.models.roles import blacklist
+from openregistry.api.models.schematics_extender import Model, ListType
+from openregistry.api.traversal import Root
+from openregistry.api.utils import DocserviceSigner
+
+
+class Asset(Model):
+    class Options:
+        roles = {'view': blacklist('__parent__')}
+
+    id = StringType()
+    status = StringType()
+    documents = ListType(ModelType(Document), default=list())
+
+
+def previous_generate_docservice_url(request, doc_id, temporary=True, prefix=None):
+    docservice_key = request.registry.docservice_key
+    parsed_url = urlparse(request.registry.docservice_url)
+    query = {}
+    mess = doc_id
+    if prefix:
+        mess = '{}/{}'.format(prefix, mess)
+        query['Prefix'] = prefix
+    query['Signature'] = quote(b64encode(docservice_key.signature(mess.encode("utf-8"))))
+    query['KeyID'] = docservice_key.hex_vk()[:8]
+    return urlunsplit((parsed_url.scheme, parsed_url.netloc, '/get/{}'.format(doc_id), urlencode(query), ''))
+
+
+def asset(request, documents):
+    asset_id = uuid4().hex
+    model = Asset({
+        'id': asset_id,
+        'status': 'active',
+        'documents': [{
+            'title': u'document {}'.format(i),
+            'format': u'application/pdf',
+            'url': 'http://localhost/api/2.3/assets/{}/documents/{}?download={}'.format(
+                asset_id, uuid4().hex, uuid4().hex),
+        } for i in xrange(documents)],
+    })
+    model.__parent__ = Root(request)
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Docservice URL benchmark ----')
+    parser.add_argument('--documents', default='10,100,500', help='Documents per asset')
+    parser.add_argument('--number', type=int, default=20)
+    params = parser.parse_args()
+    request = Request.blank('/')
+    config = testing.setUp(request=request)
+    request.registry = config.registry
+    request.registry.db = None
+    request.registry.docservice_url = 'http://docs'
+    request.registry.docservice_key = key = Signer('0' * 32)
+    request.registry.docservice_signer = signer = DocserviceSigner(key, 100000)
+
+    def get(model):
+        for cache in ['document_owners', 'document_url_roles', 'docservice_documents']:
+            request.__dict__.pop(cache, None)
+        return model.serialize('view')
+
+    def cold(model):
+        signer.cache.clear()
+        return get(model)
+
+    generate_docservice_url = utils.generate_docservice_url
+    print '{:>10} {:>14} {:>14} {:>14}'.format('documents', 'previous ms', 'cold ms', 'warm ms')
+    for documents in [int(i) for i in params.documents.split(',')]:
+        model = asset(request, documents)
+        utils.generate_docservice_url = previous_generate_docservice_url
+        try:
+            expected = get(model)
+            previous = timeit(lambda: get(model), number=params.number)
+        finally:
+            utils.generate_docservice_url = generate_docservice_url
+        assert cold(model) == expected
+        cold_time = timeit(lambda: cold(model), number=params.number)
+        warm = timeit(lambda: get(model), number=params.number)
+        print '{:>10} {:>14.2f} {:>14.2f} {:>14.2f}'.format(
+            documents, *[i * 1000 / params.number for i in [previous, cold_time, warm]])
+    testing.tearDown()
+
+
+if __name__ == '__main__':
+    main()
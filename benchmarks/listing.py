@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Crawl a local fixture database the way sync clients crawl listings.
+
+Compares the old ``limit + 1`` startkey paging with AES-encrypted offsets
+against (key, docid) cursors. Many documents share one ``dateModified``
+so the old paging visibly loses its place.
+
+    python benchmarks/listing.py --couchdb-url http://op:op@localhost:5984/ --docs 200000
+"""
+import argparse
+from timeit import timeit
+from time import time
+from uuid import uuid4
+
+from couchdb import Server
+from couchdb.design import ViewDefinition
+
+from openregistry.api.utils import (
+    encrypt, decrypt, encode_cursor, decode_cursor, cursor_startkey_docid
+)
+
+bench_view = ViewDefinition('bench', 'by_dateModified', '''function(doc) {
+    if(doc.doc_type == 'Bench') {
+        emit(doc.dateModified, null);
+    }
+}''')
+
+
+def fill(db, count, ties):
+    batch = []
+    for i in xrange(count):
+        batch.append({
+            '_id': uuid4().hex,
+            'doc_type': 'Bench',
+            'dateModified': '2017-01-01T00:00:00.{:06d}+02:00'.format(i // ties),
+        })
+        if len(batch) == 1000:
+            db.update(batch)
+            batch = []
+    if batch:
+        db.update(batch)
+    bench_view.sync(db)
+    len(bench_view(db, limit=1))  # build index
+
+
+def crawl_offset(db, secret, limit, max_pages):
+    seen, pages, offset = [], 0, ''
+    while pages < max_pages:
+        view_offset = decrypt(secret, db.name, offset) if offset else ''
+        rows = list(bench_view(db, startkey=view_offset, limit=limit + 1 if offset else limit))
+        if offset and rows and rows[0].key == view_offset:
+            rows = rows[1:]
+        else:
+            rows = rows[:limit]
+        if not rows:
+            break
+        seen.extend(i.id for i in rows)
+        offset = encrypt(secret, db.name, rows[-1].key)
+        pages += 1
+    return seen, pages
+
+
+def crawl_cursor(db, secret, limit, max_pages):
+    seen, pages, offset = [], 0, ''
+    while pages < max_pages:
+        options = {'limit': limit}
+        if offset:
+            key, docid = decode_cursor(secret, db.name, offset)
+            options.update(startkey=key, startkey_docid=cursor_startkey_docid(docid))
+        rows = list(bench_view(db, **options))
+        if not rows:
+            break
+        seen.extend(i.id for i in rows)
+        offset = encode_cursor(secret, db.name, rows[-1].key, rows[-1].id)
+        pages += 1
+    return seen, pages
+
+
+def report(name, count, seen, pages, duration):
+    print '{:8} pages: {:6} rows: {:8} unique: {:8} missing: {:8} {:8.0f} rows/s'.format(
+        name, pages, len(seen), len(set(seen)), count - len(set(seen)), len(seen) / duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Listing crawl benchmark ----')
+    parser.add_argument('--couchdb-url', default='http://localhost:5984/')
+    parser.add_argument('--docs', type=int, default=100000)
+    parser.add_argument('--ties', type=int, default=150, help='Documents per dateModified')
+    parser.add_argument('--limit', type=int, default=100)
+    params = parser.parse_args()
+
+    server = Server(params.couchdb_url)
+    db = server.create('bench_listing_{}'.format(uuid4().hex))
+    secret = uuid4().hex
+    try:
+        start = time()
+        fill(db, params.docs, params.ties)
+        print 'fixture: {} docs in {:.1f}s'.format(params.docs, time() - start)
+        max_pages = params.docs / params.limit * 2
+        for name, crawl in (('offset', crawl_offset), ('cursor', crawl_cursor)):
+            start = time()
+            seen, pages = crawl(db, secret, params.limit, max_pages)
+            report(name, params.docs, seen, pages, time() - start)
+
+        key = '2017-01-01T00:00:00.000000+02:00'
+        docid = uuid4().hex
+        number = 10000
+        print 'AES offset  {:.2f} us/page'.format(timeit(
+            lambda: decrypt(secret, db.name, encrypt(secret, db.name, key)), number=number) * 1e6 / number)
+        print 'HMAC cursor {:.2f} us/page'.format(timeit(
+            lambda: decode_cursor(secret, db.name, encode_cursor(secret, db.name, key, docid)), number=number) * 1e6 / number)
+    finally:
+        server.delete(db.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Per request overhead of logging context.
+
+Runs NewRequest and ContextFound logging subscribers for authenticated
+requests, eager (previous implementation) and lazy, for requests which
+never log and requests which log once.
+
+    python benchmarks/logging_context.py --number 10000
+"""
+import argparse
+import os
+from timeit import timeit
+
+from pyramid import testing
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.request import Request, apply_request_extensions
+
+from openregistry.api.auth import AuthenticationPolicy, authenticated_role
+from openregistry.api.constants import VERSION
+from openregistry.api.subscribers import add_logging_context, set_logging_context
+from openregistry.api.utils import get_now, context_unpack, request_params
+
+AUTH_FILE = os.path.join(os.path.dirname(__file__), '..', 'openregistry', 'api', 'tests', 'auth.ini')
+
+
+class Event(object):
+
+    def __init__(self, request):
+        self.request = request
+
+
+def eager_add_logging_context(event):
+    request = event.request
+    request.logging_context = {
+        'API_VERSION': VERSION,
+        'TAGS': 'python,api',
+        'USER': str(request.authenticated_userid or ''),
+        'CURRENT_URL': request.url,
+        'CURRENT_PATH': request.path_info,
+        'REMOTE_ADDR': request.remote_addr or '',
+        'USER_AGENT': request.user_agent or '',
+        'REQUEST_METHOD': request.method,
+        'TIMESTAMP': get_now().isoformat(),
+        'REQUEST_ID': request.environ.get('REQUEST_ID', ''),
+        'CLIENT_REQUEST_ID': request.headers.get('X-Client-Request-ID', ''),
+    }
+
+
+def eager_set_logging_context(event):
+    request = event.request
+    request.logging_context['ROLE'] = str(request.authenticated_role)
+    if request.params:
+        request.logging_context['PARAMS'] = str(dict(request.params))
+    for x, j in request.matchdict.items():
+        request.logging_context[x.upper()] = j
+
+
+def eager_context_unpack(request, msg):
+    for key, value in request.logging_context.items():
+        msg["JOURNAL_" + key] = value
+    return msg
+
+
+def make_request(config):
+    request = Request.blank('/api/2.3/assets/{}?opt_fields=status'.format('a' * 32),
+                            headers={'Authorization': 'Bearer chrisr', 'User-Agent': 'benchmark'})
+    request.registry = config.registry
+    apply_request_extensions(request)
+    request.matchdict = {'asset_id': 'a' * 32}
+    request.context = None
+    return request
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Logging context benchmark ----')
+    parser.add_argument('--number', type=int, default=10000)
+    params = parser.parse_args()
+    config = testing.setUp()
+    config.set_authorization_policy(ACLAuthorizationPolicy())
+    config.set_authentication_policy(AuthenticationPolicy(AUTH_FILE))
+    config.add_request_method(request_params, 'params', reify=True)
+    config.add_request_method(authenticated_role, property=True)
+    config.commit()
+
+    def run(add, set_context, unpack, log):
+        request = make_request(config)
+        event = Event(request)
+        add(event)
+        set_context(event)
+        if log:
+            unpack(request, {'MESSAGE_ID': 'benchmark'})
+
+    baseline = timeit(lambda: make_request(config), number=params.number)
+    print '{:>8} {:>12} {:>12}'.format('logs', 'eager us', 'lazy us')
+    for log in [False, True]:
+        eager = timeit(lambda: run(eager_add_logging_context, eager_set_logging_context,
+                                   eager_context_unpack, log), number=params.number)
+        lazy = timeit(lambda: run(add_logging_context, set_logging_context,
+                                  context_unpack, log), number=params.number)
+        print '{:>8} {:>12.1f} {:>12.1f}'.format(int(log), (eager - baseline) * 1e6 / params.number,
+                                                (lazy - baseline) * 1e6 / params.number)
+    testing.tearDown()
+
+
+if __name__ == '__main__':
+    main()
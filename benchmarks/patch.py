@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""PATCH latency against document size.
+
+Compares the full serialize/patch/re-import round trip of ``validate_data``
+with the incremental path of ``openregistry.api.models.patching`` for a
+one-field PATCH of asset-like documents.
+
+    python benchmarks/patch.py --sizes 10,100,500
+"""
+import argparse
+from timeit import timeit
+from uuid import uuid4
+
+from schematics.types import StringType
+from schematics.types.compound import ModelType
+
+from openregistry.api.models.common import BaseResourceItem
+from openregistry.api.models.ocds import Item, Document, Organization
+from openregistry.api.models.roles import plain_role
+from openregistry.api.models.schematics_extender import ListType
+from openregistry.api.models.patching import patched_model, export_fields
+from openregistry.api.utils import apply_data_patch, get_now
+
+
+class Asset(BaseResourceItem):
+    class Options:
+        roles = {'edit': plain_role}
+
+    title = StringType(required=True)
+    status = StringType(default='pending')
+    assetCustodian = ModelType(Organization)
+    items = ListType(ModelType(Item), default=list())
+    documents = ListType(ModelType(Document), default=list())
+
+
+def asset(size):
+    return Asset({
+        '_id': uuid4().hex,
+        'title': u'asset',
+        'dateModified': get_now().isoformat(),
+        'items': [{
+            'id': uuid4().hex,
+            'description': u'item {}'.format(i),
+            'classification': {'scheme': u'CPV', 'id': u'44617100-9', 'description': u'Cartons'},
+            'quantity': i,
+            'address': {'countryName': u'Україна', 'locality': u'м. Київ'},
+        } for i in xrange(size)],
+        'documents': [{
+            'title': u'document {}'.format(i),
+            'format': u'application/pdf',
+            'url': u'http://localhost/get/{}'.format(uuid4().hex),
+            'datePublished': get_now().isoformat(),
+        } for i in xrange(size)],
+    })
+
+
+def full_patch(context, data):
+    initial_data = context.serialize()
+    m = Asset(initial_data)
+    new_patch = apply_data_patch(initial_data, data)
+    if new_patch:
+        m.import_data(new_patch, partial=True, strict=True)
+    m.validate()
+    return m.to_patch('edit')
+
+
+def incremental_patch(context, data):
+    m, fields = patched_model(Asset, context, data)
+    return export_fields(m, fields, 'edit')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- PATCH benchmark ----')
+    parser.add_argument('--sizes', default='1,10,100,500', help='Items and documents per asset')
+    parser.add_argument('--number', type=int, default=20)
+    params = parser.parse_args()
+    data = {'title': u'new title'}
+    print '{:>6} {:>12} {:>12} {:>8}'.format('size', 'full ms', 'incr ms', 'speedup')
+    for size in [int(i) for i in params.sizes.split(',')]:
+        context = asset(size)
+        full = timeit(lambda: full_patch(context, data), number=params.number) * 1000 / params.number
+        incremental = timeit(lambda: incremental_patch(context, data), number=params.number) * 1000 / params.number
+        print '{:>6} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(size, full, incremental, full / incremental)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Render time of listings with documents.
+
+Compares full tree walk of previous ``fix_url``, current ``fix_url`` and
+``fix_url_paths`` over ``document_paths`` of the model for a listing page
+of serialized asset-like documents, with JSON encoding as reference.
+
+    python benchmarks/render.py --rows 1000 --documents 5
+"""
+import argparse
+from copy import deepcopy
+from json import dumps
+from timeit import timeit
+from uuid import uuid4
+
+from schematics.types import StringType
+from schematics.types.compound import ModelType
+
+from openregistry.api.constants import ROUTE_PREFIX
+from openregistry.api.models.common import BaseResourceItem
+from openregistry.api.models.ocds import Item, Document, Organization
+from openregistry.api.models.roles import blacklist, schematics_default_role
+from openregistry.api.models.schematics_extender import ListType
+from openregistry.api.models.serializer import EACH, document_paths
+from openregistry.api.utils import get_now, fix_url, fix_url_paths
+
+APP_URL = 'http://localhost'
+
+
+class Asset(BaseResourceItem):
+    class Options:
+        roles = {'view': blacklist('revisions', 'owner_token') + schematics_default_role}
+
+    title = StringType(required=True)
+    assetCustodian = ModelType(Organization)
+    items = ListType(ModelType(Item), default=list())
+    documents = ListType(ModelType(Document), default=list())
+
+
+def asset(documents):
+    asset_id = uuid4().hex
+    data = Asset({
+        '_id': asset_id,
+        'title': u'asset',
+        'dateModified': get_now().isoformat(),
+        'assetCustodian': {
+            'name': u'custodian',
+            'identifier': {'scheme': u'UA-EDR', 'id': u'00037256'},
+            'address': {'countryName': u'Україна'},
+        },
+        'items': [{
+            'id': uuid4().hex,
+            'description': u'item {}'.format(i),
+            'classification': {'scheme': u'CPV', 'id': u'44617100-9', 'description': u'Cartons'},
+            'address': {'countryName': u'Україна', 'locality': u'м. Київ'},
+        } for i in xrange(documents)],
+        'documents': [{
+            'title': u'document {}'.format(i),
+            'format': u'application/pdf',
+            'url': u'http://public.docs/api/2.3/assets/{}/documents/{}'.format(asset_id, uuid4().hex),
+        } for i in xrange(documents)],
+    }).serialize('view')
+    # API URLs as stored, serialize_document_url would need request to export them
+    for document in data['documents']:
+        document['url'] += '?download={}'.format(uuid4().hex)
+    return data
+
+
+def previous_fix_url(item, app_url):
+    if isinstance(item, list):
+        [
+            previous_fix_url(i, app_url)
+            for i in item
+            if isinstance(i, dict) or isinstance(i, list)
+        ]
+    elif isinstance(item, dict):
+        if "format" in item and "url" in item and '?download=' in item['url']:
+            path = item["url"] if item["url"].startswith('/') else '/' + '/'.join(item['url'].split('/')[5:])
+            item["url"] = app_url + ROUTE_PREFIX + path
+            return
+        [
+            previous_fix_url(item[i], app_url)
+            for i in item
+            if isinstance(item[i], dict) or isinstance(item[i], list)
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Render benchmark ----')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--documents', type=int, default=5, help='Items and documents per asset')
+    parser.add_argument('--number', type=int, default=20)
+    params = parser.parse_args()
+    page = [asset(params.documents) for i in xrange(params.rows)]
+    paths = tuple([(EACH,) + i for i in document_paths(Asset)])
+    expected = deepcopy(page)
+    previous_fix_url(expected, APP_URL)
+    for fix in [lambda data: fix_url(data, APP_URL), lambda data: fix_url_paths(data, paths, APP_URL)]:
+        data = deepcopy(page)
+        fix(data)
+        assert data == expected
+    # rewriting is idempotent for API URLs, so the same page is reused
+    page = expected
+    print 'rows {}, documents per row {}'.format(params.rows, params.documents)
+    for name, func in [
+        ('previous fix_url', lambda: previous_fix_url(page, APP_URL)),
+        ('fix_url', lambda: fix_url(page, APP_URL)),
+        ('fix_url_paths', lambda: fix_url_paths(page, paths, APP_URL)),
+        ('json dumps', lambda: dumps({'data': page})),
+    ]:
+        print '{:>18}: {:>8.2f} ms'.format(name, timeit(func, number=params.number) * 1000 / params.number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Revision diff microbenchmarks on asset shaped documents.
+
+Compares ``jsonpatch.make_patch`` with ``get_revision_changes`` for
+typical edits: one field, first item removed, new document version.
+
+    python benchmarks/revisions.py --items 100 --documents 100 --revisions 500
+"""
+import argparse
+from copy import deepcopy
+from json import dumps
+from timeit import timeit
+from uuid import uuid4
+
+from jsonpatch import make_patch
+
+from openregistry.api.utils import get_revision_changes, get_now
+
+
+def asset(items, documents, revisions):
+    now = get_now().isoformat()
+    return {
+        'id': uuid4().hex,
+        'title': u'asset',
+        'status': u'pending',
+        'dateModified': now,
+        'items': [{
+            'id': uuid4().hex,
+            'description': u'item {}'.format(i),
+            'classification': {'scheme': u'CPV', 'id': u'44617100-9', 'description': u'Cartons'},
+            'quantity': i,
+            'address': {'countryName': u'Україна', 'locality': u'м. Київ'},
+        } for i in xrange(items)],
+        'documents': [{
+            'id': uuid4().hex,
+            'title': u'document {}'.format(i),
+            'format': u'application/pdf',
+            'url': u'http://localhost/get/{}'.format(uuid4().hex),
+            'datePublished': now,
+        } for i in xrange(documents)],
+        'revisions': [{
+            'author': u'broker',
+            'date': now,
+            'rev': uuid4().hex,
+            'changes': [{'op': 'replace', 'path': '/title', 'value': u'title {}'.format(i)}],
+        } for i in xrange(revisions)],
+    }
+
+
+def edits(src):
+    field = deepcopy(src)
+    field['title'] = u'new title'
+    item_removed = deepcopy(src)
+    del item_removed['items'][0]
+    document_version = deepcopy(src)
+    document_version['documents'].append(dict(document_version['documents'][-1], title=u'new version'))
+    return [('field', field), ('item removed', item_removed), ('document version', document_version)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Revision diff benchmark ----')
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--documents', type=int, default=100)
+    parser.add_argument('--revisions', type=int, default=500)
+    parser.add_argument('--number', type=int, default=20)
+    params = parser.parse_args()
+    src = asset(params.items, params.documents, params.revisions)
+    print '{:>18} {:>12} {:>12} {:>14} {:>14}'.format('edit', 'jsonpatch ms', 'diff ms', 'jsonpatch size', 'diff size')
+    for name, dst in edits(src):
+        old = timeit(lambda: make_patch(dst, src).patch, number=params.number) * 1000 / params.number
+        new = timeit(lambda: get_revision_changes(dst, src), number=params.number) * 1000 / params.number
+        print '{:>18} {:>12.2f} {:>12.2f} {:>14} {:>14}'.format(
+            name, old, new, len(dumps(make_patch(dst, src).patch)), len(dumps(get_revision_changes(dst, src))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Serialization time of compiled role serializers.
+
+Compares schematics ``export_loop`` evaluating roles for every field with
+``openregistry.api.models.serializer`` for GET (``view``) and listing
+(``listing``) exports of asset-like documents.
+
+    python benchmarks/serialize.py --sizes 10,100,500
+"""
+import argparse
+from timeit import timeit
+from uuid import uuid4
+
+from schematics.transforms import export_loop
+from schematics.types import StringType
+from schematics.types.compound import ModelType
+
+from openregistry.api.models.common import BaseResourceItem
+from openregistry.api.models.ocds import Item, Document, Organization
+from openregistry.api.models.roles import blacklist, schematics_default_role, listing_role
+from openregistry.api.models.schematics_extender import ListType
+from openregistry.api.utils import get_now
+
+
+class Asset(BaseResourceItem):
+    class Options:
+        roles = {
+            'view': blacklist('revisions', 'owner_token') + schematics_default_role,
+            'listing': listing_role,
+        }
+
+    title = StringType(required=True)
+    status = StringType(default='pending')
+    assetCustodian = ModelType(Organization)
+    items = ListType(ModelType(Item), default=list())
+    documents = ListType(ModelType(Document), default=list())
+
+
+def asset(size):
+    return Asset({
+        '_id': uuid4().hex,
+        'title': u'asset',
+        'dateModified': get_now().isoformat(),
+        'assetCustodian': {
+            'name': u'custodian',
+            'identifier': {'scheme': u'UA-EDR', 'id': u'00037256'},
+            'address': {'countryName': u'Україна'},
+            'contactPoint': {'name': u'contact', 'email': u'contact@example.com'},
+        },
+        'items': [{
+            'id': uuid4().hex,
+            'description': u'item {}'.format(i),
+            'classification': {'scheme': u'CPV', 'id': u'44617100-9', 'description': u'Cartons'},
+            'quantity': i,
+            'address': {'countryName': u'Україна', 'locality': u'м. Київ'},
+        } for i in xrange(size)],
+        'documents': [{
+            'title': u'document {}'.format(i),
+            'format': u'application/pdf',
+            'url': u'http://localhost/get/{}'.format(uuid4().hex),
+            'datePublished': get_now().isoformat(),
+        } for i in xrange(size)],
+    })
+
+
+def schematics_export(model, role):
+    field_converter = lambda field, value: field.to_primitive(value)
+    return export_loop(type(model), model, field_converter, role=role, raise_error_on_role=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Serialization benchmark ----')
+    parser.add_argument('--sizes', default='1,10,100,500', help='Items and documents per asset')
+    parser.add_argument('--listing', type=int, default=100, help='Assets per listing page')
+    parser.add_argument('--number', type=int, default=20)
+    params = parser.parse_args()
+    print '{:>10} {:>6} {:>12} {:>12} {:>8}'.format('export', 'size', 'schem ms', 'compiled ms', 'speedup')
+    for size in [int(i) for i in params.sizes.split(',')]:
+        model = asset(size)
+        assert model.serialize('view') == schematics_export(model, 'view')
+        old = timeit(lambda: schematics_export(model, 'view'), number=params.number) * 1000 / params.number
+        new = timeit(lambda: model.serialize('view'), number=params.number) * 1000 / params.number
+        print '{:>10} {:>6} {:>12.2f} {:>12.2f} {:>7.1f}x'.format('GET', size, old, new, old / new)
+    page = [asset(1) for i in xrange(params.listing)]
+    old = timeit(lambda: [schematics_export(i, 'listing') for i in page], number=params.number) * 1000 / params.number
+    new = timeit(lambda: [i.serialize('listing') for i in page], number=params.number) * 1000 / params.number
+    print '{:>10} {:>6} {:>12.2f} {:>12.2f} {:>7.1f}x'.format('listing', params.listing, old, new, old / new)
+
+
+if __name__ == '__main__':
+    main()
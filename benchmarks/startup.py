@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Worker startup costs under openregistry control.
+
+Measures in fresh interpreters import of ``openregistry.api.constants``
+(reference data) and first lookup in CPV scheme, and plugin discovery with
+``iter_entry_points`` scan for every ``subscribers.*`` key against entry
+point index of ``openregistry.api.utils.entry_points``. Application
+phases are reported by ``startup_profile = true`` setting.
+
+    python benchmarks/startup.py --keys 20
+"""
+import argparse
+import subprocess
+import sys
+
+CONSTANTS = '''
+from time import time
+import pkg_resources, pytz, requests
+start = time()
+from openregistry.api.constants import ITEM_CLASSIFICATIONS
+imported = time()
+u'44617100-9' in ITEM_CLASSIFICATIONS[u'CPV']
+print imported - start, time() - imported
+'''
+
+DISCOVERY = '''
+from time import time
+from pkg_resources import iter_entry_points
+from openregistry.api.utils import entry_points
+groups = ['openregistry.api.plugins'] + ['openregistry.subscribers.{{}}'.format(i) for i in xrange({keys})]
+discover = {{'scan': lambda group: list(iter_entry_points(group)), 'index': entry_points}}['{mode}']
+start = time()
+for group in groups:
+    discover(group)
+first = time()
+for group in groups:
+    discover(group)
+print first - start, time() - first
+'''
+
+
+def run(code, number):
+    runs = [map(float, subprocess.check_output([sys.executable, '-c', code]).split()) for i in xrange(number)]
+    return [min(i) * 1000 for i in zip(*runs)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Startup benchmark ----')
+    parser.add_argument('--keys', type=int, default=20, help='subscribers.* settings')
+    parser.add_argument('--number', type=int, default=5, help='fresh interpreters per measurement')
+    params = parser.parse_args()
+    print 'import constants: {:.1f} ms, first CPV lookup: {:.1f} ms'.format(*run(CONSTANTS, params.number))
+    print '{:>18} {:>10} {:>10}'.format('discovery', 'first ms', 'next ms')
+    for mode in ['scan', 'index']:
+        first, next = run(DISCOVERY.format(keys=params.keys, mode=mode), params.number)
+        print '{:>18} {:>10.2f} {:>10.2f}'.format(mode, first, next)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,26 +5,39 @@ if 'test' not in __import__('sys').argv[0]: # pragma: no cover
     import gevent.monkey
     gevent.monkey.patch_all()
 import os
+from gevent import spawn
+from importlib import import_module
 from logging import getLogger
-from libnacl.sign import Signer, Verifier
+from libnacl.sign import Signer
 from pyramid.authorization import ACLAuthorizationPolicy as AuthorizationPolicy
 from pyramid.config import Configurator
 from pyramid.renderers import JSON, JSONP
 from pyramid.settings import asbool
 
 from openregistry.api.auth import AuthenticationPolicy, authenticated_role, check_accreditation
-from openregistry.api.database import set_api_security
-from openregistry.api.utils import forbidden, request_params, load_plugins
+from openregistry.api.database import set_api_security, set_revisions_db
+from openregistry.api.design import FieldsViews, IndexWarmer
+from openregistry.api.migration import run_migrations, SchemaState
+from openregistry.api.utils import (
+    forbidden, request_params, load_plugins, ErrorLogLimiter, DocserviceSigner, Keyring, StartupProfile,
+    StalenessPolicy, listing_views, listing_fields_views
+)
 from openregistry.api.constants import ROUTE_PREFIX
 
 LOGGER = getLogger("{}.init".format(__name__))
 
 
 def main(global_config, **settings):
+    # log wall time of startup phases
+    profile = StartupProfile(asbool(settings.get('startup_profile', False)))
     config = Configurator(
         autocommit=True,
         settings=settings,
-        authentication_policy=AuthenticationPolicy(settings['auth.file'], __name__),
+        authentication_policy=AuthenticationPolicy(
+            settings['auth.file'], __name__,
+            cache_size=int(settings.get('auth.cache_size', 1000)),
+            cache_ttl=int(settings.get('auth.cache_ttl', 300)),
+            reload_interval=int(settings.get('auth.reload_interval', 0))),
         authorization_policy=AuthorizationPolicy(),
         route_prefix=ROUTE_PREFIX,
     )
@@ -32,7 +45,7 @@ def main(global_config, **settings):
     config.include("cornice")
     config.add_forbidden_view(forbidden)
     config.add_request_method(request_params, 'params', reify=True)
-    config.add_request_method(authenticated_role, reify=True)
+    config.add_request_method(authenticated_role, property=True)
     config.add_request_method(check_accreditation)
     config.add_renderer('prettyjson', JSON(indent=4))
     config.add_renderer('jsonp', JSONP(param_name='opt_jsonp'))
@@ -40,10 +53,12 @@ def main(global_config, **settings):
 
     # search for plugins
     plugins = settings.get('plugins') and settings['plugins'].split(',')
-    load_plugins(config, group='openregistry.api.plugins', plugins=plugins)
+    with profile('plugins'):
+        load_plugins(config, group='openregistry.api.plugins', plugins=plugins)
 
     # CouchDB connection
-    aserver, server, db = set_api_security(settings)
+    with profile('couchdb'):
+        aserver, server, db = set_api_security(settings)
     config.registry.couchdb_server = server
     if aserver:
         config.registry.admin_couchdb_server = aserver
@@ -55,25 +70,80 @@ def main(global_config, **settings):
     config.registry.docservice_password = settings.get('docservice_password')
     config.registry.docservice_upload_url = settings.get('docservice_upload_url')
     config.registry.docservice_key = dockey = Signer(settings.get('dockey', '').decode('hex'))
-    config.registry.keyring = keyring = {}
+    config.registry.docservice_signer = DocserviceSigner(
+        dockey, int(settings.get('docservice_signature_cache', 10000)))
     dockeys = settings.get('dockeys') if 'dockeys' in settings else dockey.hex_vk()
-    for key in dockeys.split('\0'):
-        keyring[key[:8]] = Verifier(key)
+    # keys of dockeys_file are reloaded every dockeys_reload_interval seconds
+    with profile('keys'):
+        config.registry.keyring = Keyring(
+            dockeys.split('\0'), settings.get('dockeys_file'),
+            int(settings.get('dockeys_reload_interval', 0)), int(settings.get('keyring_cache_size', 10000)))
 
-    # migrate data
-    if not os.environ.get('MIGRATION_SKIP'):
-        load_plugins(config.registry, group='openregistry.api.migrations')
+    # migrate data: "startup" before serving, "background" while serving
+    # or "external" by migrate_api_data script; one process migrates at once.
+    # "startup" is default and still delays worker readiness by the whole
+    # migration run, "background" and "external" serve at once and answer
+    # writes with 503 while schema is pending, which is checked every
+    # migrations.check_interval seconds
+    migrations = 'external' if os.environ.get('MIGRATION_SKIP') else settings.get('migrations', 'startup')
+    lock_ttl = int(settings.get('migrations.lock_ttl', 600))
+    check_interval = int(settings.get('migrations.check_interval', 10))
+    if migrations != 'startup' and check_interval <= 0:
+        raise ValueError('migrations.check_interval should be positive with {} migrations'.format(migrations))
+    if migrations == 'startup':
+        with profile('migrations'):
+            run_migrations(config.registry, lock_ttl)
+    config.registry.schema_state = schema_state = SchemaState(db, check_interval)
+    if migrations == 'background':
+        spawn(schema_state.migrate, config.registry, lock_ttl)
 
     config.registry.server_id = settings.get('id', '')
 
     # search subscribers
     subscribers_keys = [k for k in settings if k.startswith('subscribers.')]
-    for k in subscribers_keys:
-        subscribers = settings[k].split(',')
-        for subscriber in subscribers:
-            load_plugins(config, group='openregistry.{}'.format(k), name=subscriber)
+    with profile('subscribers'):
+        for k in subscribers_keys:
+            subscribers = settings[k].split(',')
+            for subscriber in subscribers:
+                load_plugins(config, group='openregistry.{}'.format(k), name=subscriber)
 
     config.registry.health_threshold = float(settings.get('health_threshold', 512))
     config.registry.health_threshold_func = settings.get('health_threshold_func', 'all')
     config.registry.update_after = asbool(settings.get('update_after', True))
-    return config.make_wsgi_app()
+    # stale option of listings: listing_stale by default, listing_stale.<feed>
+    # and listing_stale.<feed>.<mode> for feeds and modes, e.g. listing_stale.changes
+    config.registry.listing_stale = StalenessPolicy(
+        settings.get('listing_stale', 'update_after' if config.registry.update_after else 'fresh'),
+        dict([(k[len('listing_stale.'):], v) for k, v in settings.items() if k.startswith('listing_stale.')]))
+    # indexes of listing views are updated every index_warm_interval seconds after writes
+    index_warm_interval = float(settings.get('index_warm_interval', 0))
+    config.registry.index_warmer = IndexWarmer(
+        db, listing_views(), index_warm_interval) if index_warm_interval else None
+    config.registry.index_lag_threshold = int(settings.get('index_lag_threshold', 0))
+    config.registry.listing_stream = asbool(settings.get('listing_stream', False))
+    config.registry.incremental_patch = asbool(settings.get('incremental_patch', False))
+    # revisions moved out of resource documents are kept in revisions_db,
+    # <couchdb.db_name>_revisions by default
+    config.registry.revisions_offload = asbool(settings.get('revisions_offload', False))
+    config.registry.revisions_db = set_revisions_db(
+        aserver, server, db, settings.get('revisions_db')) if config.registry.revisions_offload else None
+    # seconds identical errors of one client are not logged again
+    error_log_interval = float(settings.get('error_log_interval', 0))
+    config.registry.error_log_limiter = ErrorLogLimiter(error_log_interval) if error_log_interval else None
+    # module with json compatible ``loads``, e.g. ujson
+    json_backend = settings.get('json_backend')
+    config.registry.json_loads = import_module(json_backend).loads if json_backend else None
+    # opt_fields combinations of listings served by projection views, e.g. title,status;title,description;
+    # views of combinations removed from settings are deleted
+    fields_views = FieldsViews(listing_fields_views([
+        [j.strip() for j in i.split(',') if j.strip()]
+        for i in settings.get('fields_views', '').split(';') if i.strip()
+    ]))
+    fields_views.sync(db, staging=asbool(settings.get('design_staging', False)))
+    if fields_views.views:
+        spawn(fields_views.build, db)
+    config.registry.fields_views = fields_views if fields_views.views else None
+    with profile('wsgi_app'):
+        app = config.make_wsgi_app()
+    profile.report()
+    return app
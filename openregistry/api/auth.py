@@ -1,38 +1,138 @@
 # -*- coding: utf-8 -*-
 import binascii
+import os
 from hashlib import sha512
+from gevent import get_hub, sleep, spawn
 from pyramid.authentication import BasicAuthAuthenticationPolicy, b64decode
 from ConfigParser import ConfigParser
 
+from openregistry.api.constants import LOGGER
+from openregistry.api.utils import request_json_body, TTLCache
+
+# marker of token without user in cache
+UNKNOWN_TOKEN = {}
+
+
+def read_users(auth_file):
+    """ Users of auth file keyed by sha512 of their tokens """
+    config = ConfigParser()
+    if not config.read(auth_file):
+        raise IOError("Can't read {}".format(auth_file))
+    users = {}
+    for i in config.sections():
+        users.update(dict([
+            (
+                k.split(',', 1)[0],
+                {
+                    'name': j,
+                    'level': k.split(',', 1)[1] if ',' in k else '1234',
+                    'group': i
+                }
+            )
+            for j, k in config.items(i)
+        ]))
+    return users
+
+
+class AuthFile(object):
+    """ Users index of auth file, reloaded when file changes.
+
+    With ``interval`` file is polled in background, new index is built
+    aside and swapped in with single assignment, so requests never see
+    partially loaded users. Missing, unparsable or empty file keeps
+    current index.
+    """
+
+    def __init__(self, path, interval=0, callback=None):
+        self.path = path
+        self.interval = interval
+        self.callback = callback
+        self.stamp = self.file_stamp()
+        self.users = read_users(path) if self.stamp else {}
+        if interval:
+            spawn(self.watch)
+
+    def file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size, stat.st_ino
+
+    def reload(self):
+        stamp = self.file_stamp()
+        if stamp == self.stamp:
+            return False
+        # file is parsed again only after next change, e.g. end of rewrite
+        self.stamp = stamp
+        try:
+            if stamp is None:
+                raise IOError("No such file")
+            # parsed in thread, so large file does not block other greenlets
+            users = get_hub().threadpool.apply(read_users, (self.path,))
+            if not users:
+                raise ValueError("No users")
+        except Exception, e:
+            LOGGER.warning("Kept {} users, failed to reload auth file {}: {}".format(len(self.users), self.path, e),
+                           extra={'MESSAGE_ID': 'auth_file_reload_failed'})
+            return False
+        self.users = users
+        LOGGER.info("Reloaded auth file {} with {} users".format(self.path, len(self.users)),
+                    extra={'MESSAGE_ID': 'auth_file_reload'})
+        if self.callback:
+            self.callback()
+        return True
+
+    def watch(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.reload()
+            except Exception, e:
+                LOGGER.warning("Failed to reload auth file {}: {}".format(self.path, e),
+                               extra={'MESSAGE_ID': 'auth_file_reload_failed'})
+
 
 class AuthenticationPolicy(BasicAuthAuthenticationPolicy):
-    def __init__(self, auth_file, realm='OpenRegistry', debug=False):
+    def __init__(self, auth_file, realm='OpenRegistry', debug=False, cache_size=1000, cache_ttl=300,
+                 reload_interval=0):
         self.realm = realm
         self.debug = debug
-        config = ConfigParser()
-        config.read(auth_file)
-        self.users = {}
-        for i in config.sections():
-            self.users.update(dict([
-                (
-                    k.split(',', 1)[0],
-                    {
-                        'name': j,
-                        'level': k.split(',', 1)[1] if ',' in k else '1234',
-                        'group': i
-                    }
-                )
-                for j, k in config.items(i)
-            ]))
+        self.token_users = TTLCache(cache_size, cache_ttl)
+        self.auth_file = AuthFile(auth_file, reload_interval, self.token_users.clear)
+
+    @property
+    def users(self):
+        return self.auth_file.users
+
+    def get_user(self, token):
+        """ User of token, cached by sha512 of token as in auth file, so
+            plain tokens are not kept in memory.
+        """
+        digest = sha512(token).hexdigest()
+        user = self.token_users.get(digest)
+        if user is None:
+            user = self.users.get(digest, UNKNOWN_TOKEN)
+            self.token_users[digest] = user
+        return user if user is not UNKNOWN_TOKEN else None
+
+    def get_request_user(self, request):
+        """ User from ``Authorization`` header, resolved once per request """
+        if 'auth_user' not in request.__dict__:
+            token = self._get_credentials(request)
+            request.__dict__['auth_user'] = self.get_user(token) if token else None
+        return request.__dict__['auth_user']
 
     def unauthenticated_userid(self, request):
         """ The userid parsed from the ``Authorization`` request header."""
-        token = self._get_credentials(request)
-        if token:
-            toket_sha512 = sha512(token).hexdigest()
-            user = self.users.get(toket_sha512)
-            if user:
-                return user['name']
+        user = self.get_request_user(request)
+        if user:
+            return user['name']
+
+    def effective_principals(self, request):
+        if 'auth_principals' not in request.__dict__:
+            request.__dict__['auth_principals'] = super(AuthenticationPolicy, self).effective_principals(request)
+        return list(request.__dict__['auth_principals'])
 
     def check(self, user, request):
         token = request.params.get('acc_token')
@@ -44,7 +144,7 @@ class AuthenticationPolicy(BasicAuthAuthenticationPolicy):
             if not token:
                 if request.method in ['POST', 'PUT', 'PATCH'] and request.content_type == 'application/json':
                     try:
-                        json = request.json_body
+                        json = request_json_body(request)
                     except ValueError:
                         json = None
                     token = isinstance(json, dict) and json.get('access', {}).get('token')
@@ -54,15 +154,12 @@ class AuthenticationPolicy(BasicAuthAuthenticationPolicy):
         return auth_groups
 
     def callback(self, username, request):
-        # Username arg is ignored.  Unfortunately _get_credentials winds up
-        # getting called twice when authenticated_userid is called.  Avoiding
-        # that, however, winds up duplicating logic from the superclass.
-        token = self._get_credentials(request)
-        if token:
-            toket_sha512 = sha512(token).hexdigest()
-            user = self.users.get(toket_sha512)
-            if user:
-                return self.check(user, request)
+        # Username arg is ignored, user is resolved once per request
+        # for both unauthenticated_userid and callback.
+        if 'auth_groups' not in request.__dict__:
+            user = self.get_request_user(request)
+            request.__dict__['auth_groups'] = self.check(user, request) if user else None
+        return request.__dict__['auth_groups']
 
     def _get_credentials(self, request):
         authorization = request.headers.get('Authorization')
@@ -96,7 +193,20 @@ class AuthenticationPolicy(BasicAuthAuthenticationPolicy):
         return username
 
 
-def get_local_roles(context):
+def roles_stamp(location):
+    """ Fields local roles of ``location`` are made of, cached roles are
+        resolved again once they change, e.g. on owner change.
+    """
+    return getattr(location, 'owner', None), getattr(location, 'owner_token', None)
+
+
+def get_local_roles(context, cache=None):
+    """ Local roles of context lineage.
+
+    With ``cache`` dict, callable ``__local_roles__`` of every location
+    is called once per its ``roles_stamp`` and shared by contexts with
+    common parents.
+    """
     from pyramid.location import lineage
     roles = {}
     for location in lineage(context):
@@ -105,20 +215,42 @@ def get_local_roles(context):
         except AttributeError:
             continue
         if local_roles and callable(local_roles):
-            local_roles = local_roles()
+            if cache is None:
+                local_roles = local_roles()
+            else:
+                # location is kept with its roles, so its id is not reused
+                stamp = roles_stamp(location)
+                cached = cache.get(id(location))
+                if cached is None or cached[1] != stamp:
+                    cached = cache[id(location)] = (location, stamp, local_roles())
+                local_roles = cached[2]
         roles.update(local_roles)
     return roles
 
 
 def authenticated_role(request):
+    """ Role of request user in current request context, resolved once
+        per context and owners of its lineage.
+    """
+    from pyramid.location import lineage
+    context = getattr(request, 'context', None)
+    roles_cache = request.__dict__.setdefault('authenticated_roles', {})
+    stamp = tuple([roles_stamp(i) for i in lineage(context)]) if context is not None else ()
+    cached = roles_cache.get(id(context))
+    if cached and cached[0] is context and cached[1] == stamp:
+        return cached[2]
     principals = request.effective_principals
-    if hasattr(request, 'context'):
-        roles = get_local_roles(request.context)
+    role = None
+    if context is not None:
+        roles = get_local_roles(context, request.__dict__.setdefault('local_roles', {}))
         local_roles = [roles[i] for i in reversed(principals) if i in roles]
         if local_roles:
-            return local_roles[0]
-    groups = [g for g in reversed(principals) if g.startswith('g:')]
-    return groups[0][2:] if groups else 'anonymous'
+            role = local_roles[0]
+    if role is None:
+        groups = [g for g in reversed(principals) if g.startswith('g:')]
+        role = groups[0][2:] if groups else 'anonymous'
+    roles_cache[id(context)] = (context, stamp, role)
+    return role
 
 
 def check_accreditation(request, level):
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+
+
+CHOICES_PREVIEW_LENGTH = 10
+
+
+def code_prefix(code):
+    """ Significant hierarchical prefix of CPV-like code, at least its
+        two digit division.
+
+    '45200000-9' -> '452', '45000000' -> '45', '30000000-9' -> '30'
+    """
+    digits = code.split('-', 1)[0]
+    return digits[:max(len(digits.rstrip('0')), 2)]
+
+
+def invalidating(method):
+    """ List ``method`` which drops index built for codes before """
+    def wrapper(self, *args):
+        self._index = None
+        return method(self, *args)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+class ClassificationScheme(list):
+    """ List of codes of one classification scheme.
+
+    Membership test is a hash lookup, hierarchical queries are done with
+    binary search over codes sorted by their digits. Both indexes are built
+    on first use and dropped when list is changed, so importing a scheme
+    costs nothing at worker startup and plugins may still extend it.
+    """
+
+    def __init__(self, name, codes=()):
+        super(ClassificationScheme, self).__init__(codes)
+        self.name = name
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            codes = frozenset(self)
+            self._index = codes, tuple(sorted(codes))
+        return self._index
+
+    @property
+    def codes(self):
+        return self.index[0]
+
+    def __contains__(self, code):
+        return code in self.index[0]
+
+    append = invalidating(list.append)
+    extend = invalidating(list.extend)
+    insert = invalidating(list.insert)
+    remove = invalidating(list.remove)
+    pop = invalidating(list.pop)
+    __setitem__ = invalidating(list.__setitem__)
+    __delitem__ = invalidating(list.__delitem__)
+    __setslice__ = invalidating(list.__setslice__)
+    __delslice__ = invalidating(list.__delslice__)
+    __iadd__ = invalidating(list.__iadd__)
+    __imul__ = invalidating(list.__imul__)
+
+    def descendants(self, code):
+        """ All codes placed under ``code`` in scheme hierarchy,
+            e.g. ``descendants('45200000')`` for all works in 452xxxxx.
+        """
+        prefix = code_prefix(code)
+        digits = code.split('-', 1)[0]
+        codes = self.index[1]
+        result = []
+        for i in codes[bisect_left(codes, prefix):]:
+            if not i.startswith(prefix):
+                break
+            if i.split('-', 1)[0] != digits:
+                result.append(i)
+        return tuple(result)
+
+
+def choices_message(scheme, codes):
+    """ Short description of available codes for validation errors """
+    if len(codes) > CHOICES_PREVIEW_LENGTH:
+        return u'{} codes ({} available)'.format(scheme, len(codes))
+    return unicode(codes)
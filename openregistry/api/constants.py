@@ -6,6 +6,8 @@ import re
 from pytz import timezone
 from requests import Session
 
+from openregistry.api.classifications import ClassificationScheme
+
 SESSION = Session()
 
 PKG = get_distribution(__package__)
@@ -37,8 +39,8 @@ CPV_CODES = read_json('cpv.json')
 ORA_CODES = [i['code'] for i in read_json('OrganisationRegistrationAgency.json')['data']]
 
 ITEM_CLASSIFICATIONS = {
-    u'CPV': CPV_CODES,
-    u'CAV-PS': []
+    u'CPV': ClassificationScheme(u'CPV', CPV_CODES),
+    u'CAV-PS': ClassificationScheme(u'CAV-PS', [])
 }
 
 IDENTIFIER_CODES = ORA_CODES
@@ -51,4 +53,6 @@ VERSION = '{}.{}'.format(int(PKG.parsed_version[0]), int(PKG.parsed_version[1])
 ROUTE_PREFIX = '/api/{}'.format(VERSION)
 
 SCHEMA_VERSION = 1
-SCHEMA_DOC = 'openregistry_schema'
\ No newline at end of file
+SCHEMA_DOC = 'openregistry_schema'
+MIGRATION_LOCK_DOC = 'openregistry_migration_lock'
+DESIGN_DOC = '_local/openregistry_design'
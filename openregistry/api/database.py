@@ -6,6 +6,7 @@ from pbkdf2 import PBKDF2
 from ConfigParser import ConfigParser
 from couchdb import Server as CouchdbServer, Session
 from couchdb.http import Unauthorized, extract_credentials
+from pyramid.settings import asbool
 
 from openregistry.api.design import sync_design
 
@@ -55,6 +56,8 @@ class Server(CouchdbServer):
 def set_api_security(settings):
     # CouchDB connection
     db_name = os.environ.get('DB_NAME', settings['couchdb.db_name'])
+    # index changed views in staging design documents before update
+    staging = asbool(settings.get('design_staging', False))
     server = Server(settings.get('couchdb.url'),
                     session=Session(retry_delays=range(10)))
     if 'couchdb.admin_url' not in settings and server.resource.credentials:
@@ -129,18 +132,44 @@ def set_api_security(settings):
                         extra={'MESSAGE_ID': 'update_api_validate_doc'})
             db.save(auth_doc)
         # sync couchdb views
-        sync_design(db)
+        sync_design(db, staging=staging)
         db = server[db_name]
     else:
         if db_name not in server:
             server.create(db_name)
         db = server[db_name]
         # sync couchdb views
-        sync_design(db)
+        sync_design(db, staging=staging)
         aserver = None
     return aserver, server, db
 
 
+def set_revisions_db(aserver, server, db, name=None):
+    """ Database of revisions offloaded from resource documents of ``db``,
+        created with the same security and validation.
+    """
+    name = name or '{}_revisions'.format(db.name)
+    if aserver is not None:
+        if name not in aserver:
+            aserver.create(name)
+        revisions_db = aserver[name]
+        source = aserver[db.name]
+        if source.security != revisions_db.security:
+            LOGGER.info("Updating revisions db security",
+                        extra={'MESSAGE_ID': 'update_revisions_security'})
+            revisions_db.security = source.security
+        auth_doc = source.get(VALIDATE_DOC_ID)
+        revisions_auth_doc = revisions_db.get(VALIDATE_DOC_ID, {'_id': VALIDATE_DOC_ID})
+        if auth_doc and revisions_auth_doc.get('validate_doc_update') != auth_doc['validate_doc_update']:
+            revisions_auth_doc['validate_doc_update'] = auth_doc['validate_doc_update']
+            LOGGER.info("Updating revisions db validate doc",
+                        extra={'MESSAGE_ID': 'update_revisions_validate_doc'})
+            revisions_db.save(revisions_auth_doc)
+    elif name not in server:
+        server.create(name)
+    return server[name]
+
+
 def bootstrap_api_security():
     parser = argparse.ArgumentParser(description='---- Bootstrap API Security ----')
     parser.add_argument('section', type=str, help='Section in configuration file')
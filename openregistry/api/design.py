@@ -1,14 +1,152 @@
 # -*- coding: utf-8 -*-
+from hashlib import md5, sha1
+from json import dumps
+from logging import getLogger
+from gevent import sleep, spawn
 from couchdb.design import ViewDefinition
+from couchdb.http import ResourceConflict, ResourceNotFound
+
+from openregistry.api.constants import DESIGN_DOC
+
+LOGGER = getLogger(__name__)
+
+STAGING_SUFFIX = '_staging'
 
 
 def add_index_options(doc):
     doc['options'] = {'local_seq': True}
 
 
-def sync_design(db):
-    views = [j for i, j in globals().items() if "_view" in i]
-    ViewDefinition.sync_many(db, views, callback=add_index_options)
+def design_docs(views, callback=add_index_options):
+    """ Content of design documents with ``views`` by document id """
+    docs = {}
+    for view in views:
+        doc_id = '_design/{}'.format(view.design)
+        doc = docs.setdefault(doc_id, {'language': view.language, 'views': {}})
+        funcs = {'map': view.map_fun}
+        if view.reduce_fun:
+            funcs['reduce'] = view.reduce_fun
+        if view.options:
+            funcs['options'] = view.options
+        doc['views'][view.name] = funcs
+    for doc in docs.values():
+        callback(doc)
+    return docs
+
+
+def design_digest(doc):
+    return sha1(dumps(doc, sort_keys=True)).hexdigest()
+
+
+def save_design(db, doc_id, content):
+    """ Update design document with ``content``.
+
+    Document already updated to same content, e.g. by other worker, is not
+    a conflict.
+    """
+    doc = db.get(doc_id, {'_id': doc_id})
+    if all(doc.get(k) == v for k, v in content.items()):
+        return
+    doc.update(content)
+    try:
+        db.save(doc)
+    except ResourceConflict:
+        doc = db.get(doc_id, {})
+        if not all(doc.get(k) == v for k, v in content.items()):
+            raise
+
+
+def stage_design(db, doc_id, content):
+    """ Build index of design document in staging copy, then swap it in.
+
+    Index of CouchDB design document is identified by signature of its
+    views, so index built for staging copy is used by the document as soon
+    as it is updated to the same views. Until then reads are served by
+    previous views.
+    """
+    current = db.get(doc_id, {})
+    content = dict(content, views=dict(current.get('views', {}), **content['views']))
+    staging_id = doc_id + STAGING_SUFFIX
+    LOGGER.info("Building index of {}".format(doc_id), extra={'MESSAGE_ID': 'stage_design'})
+    save_design(db, staging_id, content)
+    db.view('{}/{}'.format(staging_id[len('_design/'):], sorted(content['views'])[0]), limit=1).rows
+    save_design(db, doc_id, content)
+    try:
+        db.delete(db[staging_id])
+    except (ResourceConflict, ResourceNotFound):
+        pass
+
+
+def design_revs(db, doc_ids):
+    """ Current revisions of design documents, None for missing ones """
+    revs = dict((i, None) for i in doc_ids)
+    for row in db.view('_all_docs', keys=list(doc_ids)):
+        if row.value and not row.value.get('deleted'):
+            revs[row.key] = row.value['rev']
+    return revs
+
+
+def prune_design(db, prefix, keep):
+    """ Delete design documents with id ``prefix`` but ``keep``, returns their ids """
+    start = '_design/' + prefix
+    pruned = []
+    for row in db.view('_all_docs', startkey=start, endkey=start + u'\ufff0'):
+        if row.id in keep or row.id.endswith(STAGING_SUFFIX):
+            continue
+        try:
+            db.delete(db[row.id])
+        except (ResourceConflict, ResourceNotFound):
+            continue  # deleted or changed by other worker
+        pruned.append(row.id)
+    if pruned:
+        LOGGER.info("Removed design documents {}".format(', '.join(pruned)), extra={'MESSAGE_ID': 'prune_design'})
+    return pruned
+
+
+def sync_design(db, views=None, staging=False, prune=None):
+    """ Sync ``views`` (all views of this module by default) to ``db``.
+
+    Digests of views and revisions of synced design documents are kept in
+    ``DESIGN_DOC``, so design documents with unchanged views and revision
+    are not fetched and compared: it takes two requests. Design documents
+    deleted, edited or restored since their sync are synced again.
+    With ``staging`` changed design documents are indexed before update.
+    Design documents with id ``prune`` prefix but of ``views`` are removed.
+    Returns ids of synced design documents.
+    """
+    if views is None:
+        views = [j for i, j in globals().items() if "_view" in i and isinstance(j, ViewDefinition)]
+    docs = design_docs(views)
+    state = db.get(DESIGN_DOC, {'_id': DESIGN_DOC})
+    synced = state.setdefault('designs', {})
+    pruned = prune_design(db, prune, docs) if prune else []
+    for doc_id in pruned:
+        synced.pop(doc_id, None)
+    digests = dict((i, design_digest(j)) for i, j in docs.items())
+    revs = design_revs(db, sorted(docs)) if docs else {}
+    changed = sorted(i for i in docs if not revs[i] or synced.get(i) != {'digest': digests[i], 'rev': revs[i]})
+    if not changed:
+        if pruned:
+            save_state(db, state)
+        return []
+    LOGGER.info("Sync design documents {}".format(', '.join(changed)), extra={'MESSAGE_ID': 'sync_design'})
+    if staging:
+        for doc_id in changed:
+            stage_design(db, doc_id, docs[doc_id])
+    else:
+        ViewDefinition.sync_many(db, [i for i in views if '_design/' + i.design in changed],
+                                 callback=add_index_options)
+    for doc_id, rev in design_revs(db, changed).items():
+        synced[doc_id] = {'digest': digests[doc_id], 'rev': rev}
+    save_state(db, state)
+    return changed
+
+
+def save_state(db, state):
+    try:
+        db.save(state)
+    except ResourceConflict:
+        pass  # saved by other worker
 
 
 conflicts_view = ViewDefinition('conflicts', 'all', '''function(doc) {
@@ -16,3 +154,147 @@ conflicts_view = ViewDefinition('conflicts', 'all', '''function(doc) {
         emit(doc._rev, [doc._rev].concat(doc._conflicts));
     }
 }''')
+
+
+FIELDS_PREFIX = 'fields_'
+
+FIELDS_VIEW_MAP = '''function(doc) {
+    var fields = %(fields)s, defaults = %(defaults)s;
+    var project = function(key, value) {
+        var projection = {}, i, k, field;
+        for (i = 0; i < defaults.length; i++) {
+            if (doc[defaults[i]] === undefined || doc[defaults[i]] === null) {
+                return emit(key, {_fallback: true});
+            }
+        }
+        if (value && typeof value === 'object') {
+            for (k in value) {
+                projection[k] = value[k];
+            }
+        }
+        for (i = 0; i < fields.length; i++) {
+            field = doc[fields[i]];
+            if (field !== null && typeof field === 'object') {
+                return emit(key, {_fallback: true});
+            }
+            if (field !== undefined) {
+                projection[fields[i]] = field;
+            }
+        }
+        emit(key, projection);
+    };
+    (function(emit) {
+        (%(map)s)(doc);
+    })(project);
+}'''
+
+
+def fields_view(base_view, fields, defaults=()):
+    """ ``base_view`` with stored scalar ``fields`` of document added to value.
+
+    Documents missing any of ``defaults`` or with object or array in place
+    of a field are emitted with ``_fallback`` value, as their export needs
+    model.
+    """
+    key = '\0'.join([base_view.design, base_view.name] + list(fields) + ['\0'] + list(defaults))
+    return ViewDefinition('{}{}'.format(FIELDS_PREFIX, md5(key.encode('utf-8')).hexdigest()), 'projection',
+                          FIELDS_VIEW_MAP % {'fields': dumps(list(fields)),
+                                             'defaults': dumps(list(defaults)),
+                                             'map': base_view.map_fun},
+                          language=base_view.language)
+
+
+class FieldsViews(object):
+    """ Projection views of configured opt_fields combinations.
+
+    ``views`` are (base view, fields, defaults) of every combination. Their
+    design documents are synced by ``sync``, which removes ones of views
+    not configured any more, so number of indexes is fixed by settings.
+    Listings are routed to views once their index is built by ``build``.
+    """
+
+    def __init__(self, views):
+        self.views = {}
+        for base_view, fields, defaults in views:
+            key = (base_view.design, base_view.name, tuple(sorted(fields)), tuple(sorted(defaults)))
+            self.views[key] = fields_view(base_view, key[2], key[3])
+        self.ready = set()
+
+    def get(self, db, base_view, fields, defaults=()):
+        key = (base_view.design, base_view.name, tuple(sorted(fields)), tuple(sorted(defaults)))
+        if (db.name, key) in self.ready:
+            return self.views[key]
+
+    def sync(self, db, staging=False):
+        return sync_design(db, self.views.values(), staging=staging, prune=FIELDS_PREFIX)
+
+    def build(self, db):
+        """ Wait for index of every view and route listings of ``db`` to it """
+        for key, view in sorted(self.views.items()):
+            LOGGER.info("Building fields view {} for {}".format(view.design, ','.join(key[2])),
+                        extra={'MESSAGE_ID': 'fields_view_build'})
+            try:
+                view(db, limit=1).rows  # wait for index
+            except Exception, e:
+                LOGGER.warning("Failed to build fields view {}: {}".format(view.design, e),
+                               extra={'MESSAGE_ID': 'fields_view_build_failed'})
+            else:
+                self.ready.add((db.name, key))
+
+
+def seq_number(seq):
+    """ Number of update sequence, CouchDB 2 sequences are ``N-opaque`` """
+    return int(str(seq).split('-', 1)[0])
+
+
+class IndexWarmer(object):
+    """ Keeps indexes of listing views up to date in background.
+
+    Every ``interval`` seconds database update sequence is checked, after
+    writes of any worker one view of every design document is queried
+    without ``stale``, so listings read with ``stale`` get recent data and
+    fresh reads do not wait for large index updates. ``lag`` is number of
+    database updates every design index was behind after last warm, failed
+    design documents are warmed again at next check.
+    """
+
+    def __init__(self, db, views, interval):
+        self.db = db
+        self.interval = interval
+        self.views = dict([(i.design, i) for i in reversed(views)])
+        self.update_seq = None
+        self.lag = {}
+        self.watcher = spawn(self.watch)
+
+    def warm(self):
+        update_seq = seq_number(self.db.info()['update_seq'])
+        if update_seq == self.update_seq:
+            self.lag = dict([(i, 0) for i in self.views])
+            return
+        warmed = True
+        for design, view in sorted(self.views.items()):
+            try:
+                view(self.db, limit=1).rows  # wait for index
+            except Exception, e:
+                LOGGER.warning("Failed to warm index of {}: {}".format(design, e),
+                               extra={'MESSAGE_ID': 'index_warm_failed'})
+                warmed = False
+            try:
+                index_seq = seq_number(self.db.info(design)['view_index']['update_seq'])
+            except Exception, e:
+                LOGGER.warning("Failed to check index of {}: {}".format(design, e),
+                               extra={'MESSAGE_ID': 'index_warm_failed'})
+                warmed = False
+                continue
+            self.lag[design] = max(update_seq - index_seq, 0)
+        if warmed:
+            self.update_seq = update_seq
+
+    def watch(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.warm()
+            except Exception, e:
+                LOGGER.warning("Failed to check database update sequence: {}".format(e),
+                               extra={'MESSAGE_ID': 'index_warm_failed'})
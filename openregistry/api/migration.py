@@ -1,6 +1,17 @@
 # -*- coding: utf-8 -*-
+import argparse
 import logging
-from openregistry.api.constants import SCHEMA_VERSION, SCHEMA_DOC
+import os
+from ConfigParser import ConfigParser
+from socket import gethostname
+from time import time
+from couchdb.http import ResourceConflict, ResourceNotFound
+from gevent import get_hub, getcurrent, sleep, spawn
+from gevent.pool import Pool
+from pyramid.registry import Registry
+from openregistry.api.constants import SCHEMA_VERSION, SCHEMA_DOC, MIGRATION_LOCK_DOC
+from openregistry.api.database import set_api_security
+from openregistry.api.utils import load_plugins
 
 LOGGER = logging.getLogger(__name__)
 
@@ -16,13 +27,348 @@ def set_db_schema_version(db, version):
     db.save(schema_doc)
 
 
+def document_migration(func):
+    """ Marks migration step ``func`` as migration of single document, such
+        steps are applied to every resource document by ``MigrationRunner``.
+    """
+    func.document = True
+    return func
+
+
 def migrate_data(registry, destination=None):
     cur_version = get_db_schema_version(registry.db)
     if cur_version == SCHEMA_VERSION:
         return cur_version
+    settings = getattr(registry, 'settings', None) or {}
     for step in xrange(cur_version, destination or SCHEMA_VERSION):
         LOGGER.info("Migrate openregistry schema from {} to {}".format(step, step + 1), extra={'MESSAGE_ID': 'migrate_data'})
-        migration_func = globals().get('from{}to{}'.format(step, step + 1))
-        if migration_func:
+        name = 'from{}to{}'.format(step, step + 1)
+        migration_func = globals().get(name)
+        if getattr(migration_func, 'document', False):
+            MigrationRunner(registry.db, name, migration_func,
+                            batch_size=int(settings.get('migration_batch_size', 500)),
+                            workers=int(settings.get('migration_workers', 4))).run()
+        elif migration_func:
             migration_func(registry)
         set_db_schema_version(registry.db, step + 1)
+
+
+class MigrationRunner(object):
+    """ Applies ``migrate`` to every resource document of ``db``.
+
+    Documents are read from ``_all_docs`` in batches of ``batch_size``,
+    batches are migrated and written back with ``_bulk_docs`` by pool of
+    ``workers`` greenlets. Greenlets overlap only requests to CouchDB,
+    ``migrate`` of all of them runs on one CPU. Design, service and
+    revision documents are skipped. ``migrate`` gets document and returns
+    changed one, or None to leave it as is. Documents still in conflict
+    after migration from current revision are counted as ``conflicts``.
+    Id of last written batch is checkpointed in schema document every
+    ``checkpoint_interval`` batches under ``name``, so interrupted
+    migration resumes after it. With ``dry_run`` nothing is written.
+    """
+
+    SERVICE_DOCS = (SCHEMA_DOC, MIGRATION_LOCK_DOC)
+
+    def __init__(self, db, name, migrate, batch_size=500, workers=4, checkpoint_interval=1, dry_run=False):
+        self.db = db
+        self.name = name
+        self.migrate = migrate
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint_interval = checkpoint_interval
+        self.dry_run = dry_run
+        self.stats = {'read': 0, 'migrated': 0, 'failed': 0, 'conflicts': 0, 'batches': 0}
+
+    def get_checkpoint(self):
+        schema_doc = self.db.get(SCHEMA_DOC, {})
+        return schema_doc.get('migrations', {}).get(self.name)
+
+    def set_checkpoint(self, checkpoint):
+        for attempt in xrange(3):
+            schema_doc = self.db.get(SCHEMA_DOC, {"_id": SCHEMA_DOC})
+            migrations = schema_doc.setdefault('migrations', {})
+            if checkpoint is None:
+                migrations.pop(self.name, None)
+            else:
+                migrations[self.name] = checkpoint
+            try:
+                self.db.save(schema_doc)
+            except ResourceConflict:
+                continue
+            return
+
+    def batches(self, last_id):
+        while True:
+            options = {'include_docs': True, 'limit': self.batch_size}
+            if last_id is not None:
+                options.update(startkey=last_id, limit=self.batch_size + 1)
+            rows = list(self.db.view('_all_docs', **options))
+            # last document of previous batch may be deleted since
+            if rows and rows[0].id == last_id:
+                rows = rows[1:]
+            rows = rows[:self.batch_size]
+            if not rows:
+                return
+            last_id = rows[-1].id
+            yield last_id, [i.doc for i in rows if self.is_resource(i.doc)]
+            if len(rows) < self.batch_size:
+                return
+
+    def is_resource(self, doc):
+        return not doc['_id'].startswith('_design/') and doc['_id'] not in self.SERVICE_DOCS and \
+            doc.get('doc_type') != 'Revision'
+
+    def migrate_docs(self, docs):
+        migrated = []
+        for doc in docs:
+            try:
+                doc = self.migrate(doc)
+            except Exception, e:
+                self.stats['failed'] += 1
+                LOGGER.warning("Failed to migrate {} in {}: {!r}".format(doc.get('_id'), self.name, e),
+                               extra={'MESSAGE_ID': 'migrate_data_failed'})
+                continue
+            if doc is not None:
+                migrated.append(doc)
+        return migrated
+
+    def write(self, docs):
+        """ Writes ``docs``, returns count of written ones and ids of ones
+            in conflict, other errors are counted as failed.
+        """
+        results = self.db.update(docs) if docs else []
+        conflicts = [docid for success, docid, error in results
+                     if not success and isinstance(error, ResourceConflict)]
+        written = len([i for i in results if i[0]])
+        self.stats['failed'] += len(results) - written - len(conflicts)
+        return written, conflicts
+
+    def process(self, batch):
+        last_id, docs = batch
+        migrated = self.migrate_docs(docs)
+        if self.dry_run:
+            return last_id, len(docs), len(migrated), 0
+        written, conflicts = self.write(migrated)
+        if conflicts:
+            # changed since read, migrated again from current revision
+            retried, conflicts = self.write(self.migrate_docs(
+                [i for i in [self.db.get(docid) for docid in conflicts] if i]))
+            written += retried
+            if conflicts:
+                LOGGER.warning("Documents changed while migrated in {}: {}".format(self.name, ', '.join(conflicts)),
+                               extra={'MESSAGE_ID': 'migrate_data_conflict'})
+        return last_id, len(docs), written, len(conflicts)
+
+    def progress(self, started):
+        seconds = time() - started
+        stats = dict(self.stats, seconds=round(seconds, 3),
+                     docs_per_second=int(self.stats['read'] / seconds) if seconds else 0)
+        return stats
+
+    def run(self):
+        """ Runs or resumes migration, returns its stats """
+        checkpoint = self.get_checkpoint() or {}
+        last_id = checkpoint.get('last_id')
+        for key in self.stats:
+            self.stats[key] = checkpoint.get(key, 0)
+        started = time() - checkpoint.get('seconds', 0)
+        if last_id:
+            LOGGER.info("Resume migration {} after {}".format(self.name, last_id),
+                        extra={'MESSAGE_ID': 'migrate_data_resume'})
+        pool = Pool(self.workers)
+        results = pool.imap(self.process, self.batches(last_id))
+        try:
+            for last_id, read, migrated, conflicts in results:
+                self.stats['read'] += read
+                self.stats['migrated'] += migrated
+                self.stats['conflicts'] += conflicts
+                self.stats['batches'] += 1
+                if self.stats['batches'] % self.checkpoint_interval == 0:
+                    stats = self.progress(started)
+                    if not self.dry_run:
+                        self.set_checkpoint(dict(stats, last_id=last_id))
+                    LOGGER.info("Migration {}: {read} read, {migrated} migrated, {failed} failed, "
+                                "{conflicts} in conflict, {docs_per_second} docs/s".format(self.name, **stats),
+                                extra=dict([('MIGRATION_' + k.upper(), v) for k, v in stats.items()],
+                                           MESSAGE_ID='migrate_data_progress'))
+        except BaseException:
+            # e.g. MigrationLockLost, batches in progress are not written
+            results.kill()
+            pool.kill()
+            raise
+        stats = self.progress(started)
+        if not self.dry_run:
+            self.set_checkpoint(None)
+        LOGGER.info("Migration {} {}: {read} read, {migrated} migrated, {failed} failed, "
+                    "{conflicts} in conflict in {seconds} s".format(
+                    self.name, 'checked' if self.dry_run else 'finished', **stats),
+                    extra=dict([('MIGRATION_' + k.upper(), v) for k, v in stats.items()],
+                               MESSAGE_ID='migrate_data_finished'))
+        return stats
+
+
+class MigrationLockLost(Exception):
+    """ Migration lock was taken over by other process """
+
+
+class MigrationLock(object):
+    """ Lock document making one process of all sharing database migrate.
+
+    Lock expires ``ttl`` seconds after it was taken or last refreshed, so
+    lock of crashed process is taken over. While held it is refreshed in
+    background every ``ttl / 3`` seconds, if it is lost anyway
+    ``MigrationLockLost`` is raised in greenlet which acquired it.
+    """
+
+    def __init__(self, db, owner=None, ttl=600):
+        self.db = db
+        self.owner = owner or '{}:{}'.format(gethostname(), os.getpid())
+        self.ttl = ttl
+        self.heartbeat = None
+        self.holder = None
+
+    def save(self):
+        lock = self.db.get(MIGRATION_LOCK_DOC) or {'_id': MIGRATION_LOCK_DOC}
+        if lock.get('owner') != self.owner and lock.get('expires', 0) > time():
+            return False
+        lock.update(owner=self.owner, expires=time() + self.ttl)
+        try:
+            self.db.save(lock)
+        except ResourceConflict:
+            return False
+        return True
+
+    def refresh(self):
+        while True:
+            sleep(self.ttl / 3.)
+            try:
+                saved = self.save()
+            except Exception, e:
+                LOGGER.warning("Failed to refresh migration lock: {}".format(e),
+                               extra={'MESSAGE_ID': 'migrate_data_lock_refresh_failed'})
+                continue
+            if not saved:
+                LOGGER.error("Migration lock taken over from {}".format(self.owner),
+                             extra={'MESSAGE_ID': 'migrate_data_lock_lost'})
+                get_hub().loop.run_callback(self.holder.throw, MigrationLockLost(self.owner))
+                return
+
+    def acquire(self):
+        if not self.save():
+            return False
+        self.holder = getcurrent()
+        self.heartbeat = spawn(self.refresh)
+        return True
+
+    def release(self):
+        if self.heartbeat is not None:
+            self.heartbeat.kill()
+            self.heartbeat = None
+        lock = self.db.get(MIGRATION_LOCK_DOC)
+        if lock and lock.get('owner') == self.owner:
+            try:
+                self.db.delete(lock)
+            except (ResourceConflict, ResourceNotFound):
+                pass
+
+
+def migration_locked(db):
+    """ Whether some process is migrating database now """
+    lock = db.get(MIGRATION_LOCK_DOC)
+    return bool(lock and lock.get('expires', 0) > time())
+
+
+def schema_pending(db):
+    """ Whether stored database schema is older than ``SCHEMA_VERSION``,
+        lock of migrating process marks it pending before version is written.
+    """
+    return get_db_schema_version(db) < SCHEMA_VERSION or migration_locked(db)
+
+
+def run_migrations(registry, lock_ttl=600):
+    """ Runs migrations of schema and plugins if no other process is
+        running them, returns whether they were run.
+    """
+    lock = MigrationLock(registry.db, ttl=lock_ttl)
+    if not lock.acquire():
+        LOGGER.info("Migrations are run by other process",
+                    extra={'MESSAGE_ID': 'migrate_data_locked'})
+        return False
+    try:
+        migrate_data(registry)
+        load_plugins(registry, group='openregistry.api.migrations')
+    except MigrationLockLost:
+        return False
+    finally:
+        lock.release()
+    return True
+
+
+class SchemaState(object):
+    """ Whether database schema is pending, i.e. is old or some process
+    migrates it.
+
+    Checked per request by reading ``pending`` only, schema version and
+    lock documents are polled every ``interval`` seconds in background, so
+    migrations run after this process started, e.g. by ``migrate_api_data``,
+    are noticed too.
+    """
+
+    def __init__(self, db, interval=10):
+        self.db = db
+        self.interval = interval
+        self.pending = schema_pending(db)
+        self.watcher = spawn(self.watch) if interval > 0 else None
+
+    def check(self):
+        try:
+            pending = schema_pending(self.db)
+        except Exception, e:
+            LOGGER.warning("Failed to check database schema: {}".format(e),
+                           extra={'MESSAGE_ID': 'migrate_data_lock_check_failed'})
+            return
+        if pending and not self.pending:
+            LOGGER.info("Database schema is migrated by other process",
+                        extra={'MESSAGE_ID': 'migrate_data_schema_pending'})
+        elif self.pending and not pending:
+            LOGGER.info("Database schema is migrated", extra={'MESSAGE_ID': 'migrate_data_schema_ready'})
+        self.pending = pending
+
+    def watch(self):
+        while True:
+            sleep(self.interval)
+            self.check()
+
+    def set_pending(self):
+        """ Marks schema pending, e.g. while this process migrates it """
+        self.pending = True
+
+    def migrate(self, registry, lock_ttl=600):
+        """ Runs migrations with schema pending, checks it when they end """
+        self.set_pending()
+        try:
+            return run_migrations(registry, lock_ttl)
+        finally:
+            self.check()
+
+
+def migrate_api_data():
+    # couchdb requests yield to lock heartbeat, as in application
+    import gevent.monkey
+    gevent.monkey.patch_all()
+    parser = argparse.ArgumentParser(description='---- Migrate API Data ----')
+    parser.add_argument('section', type=str, help='Section in configuration file')
+    parser.add_argument('config', type=str, help='Path to configuration file')
+    parser.add_argument('--lock-ttl', type=int, default=600, help='Seconds migration lock is held without refresh')
+    params = parser.parse_args()
+    if os.path.isfile(params.config):
+        conf = ConfigParser()
+        conf.read(params.config)
+        settings = {k: v for k, v in conf.items(params.section)}
+        registry = Registry('migration')
+        registry.settings = settings
+        aserver, registry.couchdb_server, registry.db = set_api_security(settings)
+        if aserver:
+            registry.admin_couchdb_server = aserver
+        run_migrations(registry, params.lock_ttl)
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
+from hashlib import sha1
+from json import dumps
+from pytz import utc
 from schematics.types import StringType, BaseType
 from schematics.types.compound import DictType, ListType, ModelType
 from openregistry.api.utils import get_now
 from schematics.types.serializable import serializable
+from couchdb.http import ResourceConflict
 from couchdb_schematics.document import SchematicsDocument
 
 from .schematics_extender import Model, IsoDateTimeType
@@ -15,6 +19,51 @@ class Revision(Model):
     rev = StringType()
 
 
+def revision_doc_id(resource_id, revision):
+    """ Id of offloaded revision document, ordered by revision date and
+        sequence number of resource revision it was made on, digest of
+        content tells apart revisions made at once.
+    """
+    sequence = (revision.rev or '').split('-')[0]
+    digest = sha1(dumps(revision.to_primitive(), sort_keys=True)).hexdigest()[:16]
+    return u'{}_revision_{}_{:010}_{}'.format(
+        resource_id, revision.date.astimezone(utc).strftime('%Y%m%d%H%M%S%f'),
+        int(sequence) if sequence.isdigit() else 0, digest)
+
+
+def save_revisions(db, resource_id, revisions):
+    """ Store revisions as separate documents, existing ones are kept.
+
+    Returns whether every revision is stored, i.e. saved now or already
+    saved with the same content.
+    """
+    docs = []
+    for revision in revisions:
+        doc = revision.to_primitive()
+        doc.update({
+            '_id': revision_doc_id(resource_id, revision),
+            'doc_type': 'Revision',
+            'resource_id': resource_id,
+        })
+        docs.append(doc)
+    stored = True
+    for doc, (success, doc_id, error) in zip(docs, db.update(docs)):
+        if success:
+            continue
+        existing = isinstance(error, ResourceConflict) and db.get(doc_id)
+        if not existing or dict([(i, j) for i, j in existing.items() if i != '_rev']) != doc:
+            stored = False
+    return stored
+
+
+def load_revisions(db, resource_id, revision_class=Revision):
+    prefix = u'{}_revision_'.format(resource_id)
+    return [
+        (row.id, revision_class(dict([(i, j) for i, j in row.doc.items() if i in revision_class._fields])))
+        for row in db.view('_all_docs', startkey=prefix, endkey=prefix + u'\ufff0', include_docs=True)
+    ]
+
+
 class BaseResourceItem(SchematicsDocument, Model):
     owner = StringType()
     owner_token = StringType()
@@ -26,6 +75,12 @@ class BaseResourceItem(SchematicsDocument, Model):
 
     __name__ = ''
 
+    def __init__(self, *args, **kwargs):
+        super(BaseResourceItem, self).__init__(*args, **kwargs)
+        # revisions already saved inline in database
+        self._stored_revisions = len(self.revisions or []) if self._rev else 0
+        self._offloaded_revisions = None
+
     def __repr__(self):
         return '<%s:%r@%r>' % (type(self).__name__, self.id, self.rev)
 
@@ -34,6 +89,76 @@ class BaseResourceItem(SchematicsDocument, Model):
         """A property that is serialized by schematics exports."""
         return self._id
 
+    def get_revisions_db(self):
+        """ Database keeping revisions outside of resource document, if
+            ``revisions_offload`` is on.
+        """
+        root = self.__parent__
+        while root is not None and root.__parent__ is not None:
+            root = root.__parent__
+        request = getattr(root, 'request', None)
+        if request is not None and getattr(request.registry, 'revisions_offload', False):
+            return getattr(request.registry, 'revisions_db', None)
+
+    def exports_revisions(self, role):
+        roles = type(self)._options.roles
+        return role in roles and not roles[role]('revisions', None)
+
+    def all_revisions(self, db):
+        """ Offloaded revisions and inline ones not offloaded yet by date,
+            inline revision is taken for offloaded one with the same content only.
+        """
+        if self._offloaded_revisions is None:
+            self._offloaded_revisions = load_revisions(db, self.id, type(self).revisions.model_class)
+        offloaded = dict([(i, j.to_primitive()) for i, j in self._offloaded_revisions])
+        return sorted([j for _, j in self._offloaded_revisions] + [
+            i for i in self.revisions or [] if offloaded.get(revision_doc_id(self.id, i)) != i.to_primitive()
+        ], key=lambda i: i.date)
+
+    def export_with_revisions(self, method, role, *args):
+        # database truth value is a request, so it is compared to None
+        db = self.get_revisions_db() if self.id and role and self.exports_revisions(role) else None
+        if db is None:
+            return method(role, *args)
+        inline = self._data.get('revisions')
+        self._data['revisions'] = self.all_revisions(db)
+        try:
+            return method(role, *args)
+        finally:
+            self._data['revisions'] = inline
+
+    def to_primitive(self, role=None, context=None):
+        return self.export_with_revisions(super(BaseResourceItem, self).to_primitive, role, context)
+
+    def to_patch(self, role=None):
+        return self.export_with_revisions(super(BaseResourceItem, self).to_patch, role)
+
+    def store(self, database, validate=True, role=None):
+        """ With ``revisions_offload`` revisions stored inline by previous
+            saves are moved to separate documents of revisions database, so
+            resource document keeps only the latest ones.
+        """
+        revisions_db = self.get_revisions_db() if self._stored_revisions else None
+        if revisions_db is None:
+            super(BaseResourceItem, self).store(database, validate, role)
+            self._stored_revisions = len(self.revisions or [])
+            return self
+        revisions = self.revisions
+        self._offloaded_revisions = None
+        if not save_revisions(revisions_db, self.id, revisions[:self._stored_revisions]):
+            # kept inline, offloaded again by next save
+            super(BaseResourceItem, self).store(database, validate, role)
+            self._stored_revisions = len(self.revisions or [])
+            return self
+        self.revisions = revisions[self._stored_revisions:]
+        try:
+            super(BaseResourceItem, self).store(database, validate, role)
+        except Exception:
+            self.revisions = revisions
+            raise
+        self._stored_revisions = len(self.revisions)
+        return self
+
     def import_data(self, raw_data, **kw):
         """
         Converts and imports the raw data into the instance of the model
@@ -11,10 +11,12 @@ from openregistry.api.constants import (DEFAULT_CURRENCY,
     DEFAULT_ITEM_CLASSIFICATION, ITEM_CLASSIFICATIONS, TZ, DOCUMENT_TYPES,
     IDENTIFIER_CODES
 )
-from openregistry.api.utils import get_now, serialize_document_url
+from openregistry.api.utils import get_now, serialize_document_url, sign_document_urls
+from openregistry.api.classifications import choices_message
 
 from .schematics_extender import Model, IsoDateTimeType, HashType
 from .roles import document_roles, organization_roles
+from .projection import role_filter
 
 
 # OCDS Building Blocks.
@@ -53,9 +55,10 @@ class ItemClassification(Classification):
     id = StringType(required=True)
 
     def validate_id(self, data, code):
-        available_codes = ITEM_CLASSIFICATIONS.get(data.get('scheme'), [])
+        scheme = data.get('scheme')
+        available_codes = ITEM_CLASSIFICATIONS.get(scheme, ())
         if code not in available_codes:
-            raise ValidationError(BaseType.MESSAGES['choices'].format(unicode(available_codes)))
+            raise ValidationError(BaseType.MESSAGES['choices'].format(choices_message(scheme, available_codes)))
 
 
 class Unit(Model):
@@ -114,6 +117,12 @@ class Document(Model):
     def download_url(self):
         return serialize_document_url(self)
 
+    @classmethod
+    def prepare_export(cls, documents, role):
+        """ Signs docservice URLs of exported list of documents in batch """
+        if not role_filter(cls, role)('download_url', None):
+            sign_document_urls(documents)
+
     def import_data(self, raw_data, **kw):
         """
         Converts and imports the raw data into the instance of the model
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+from schematics.exceptions import BaseError, ModelConversionError, ModelValidationError
+from schematics.transforms import import_loop
+
+from openregistry.api.utils import apply_data_patch
+
+VALIDATOR_DEPENDENCIES = {}
+
+
+def depends(*names):
+    """ Declares fields other than validated one a model validator reads,
+        so incremental PATCH of them runs it.
+    """
+    def wrapper(func):
+        func.depends = names
+        return func
+    return wrapper
+
+
+def validator_dependencies(cls):
+    """ Field names every model level validator reads from ``data``.
+
+    Taken from ``depends`` declaration of validator, validators without it
+    may read any field and depend on all of them.
+    """
+    if cls not in VALIDATOR_DEPENDENCIES:
+        VALIDATOR_DEPENDENCIES[cls] = dict([
+            (name, set([name]) | set(getattr(func, 'depends', cls._fields)))
+            for name, func in cls._validator_functions.items()
+        ])
+    return VALIDATOR_DEPENDENCIES[cls]
+
+
+def field_names(cls, data):
+    """ Model field names for serialized names of ``data`` """
+    names = {}
+    for name, field in cls._fields.items():
+        for i in [field.serialized_name or name] + list(getattr(field, 'deserialize_from', None) or []):
+            names[i] = name
+    rogues = [i for i in data if i not in names]
+    if rogues:
+        raise ModelConversionError(dict([(i, 'Rogue field') for i in rogues]))
+    return list(set([names[i] for i in data]))
+
+
+def export_fields(model, names, role=None, print_none=True):
+    """ Export only ``names`` fields of model the way ``to_patch`` does """
+    cls = type(model)
+    gottago = cls._options.roles[role] if role else None
+    field_converter = lambda field, value: field.to_primitive(value)
+    data = {}
+    for name in names:
+        field = cls._fields[name]
+        value = model._data.get(name)
+        if gottago and gottago(name, value):
+            continue
+        if value is not None:
+            if hasattr(field, 'export_loop'):
+                value = field.export_loop(value, field_converter, role=role, print_none=print_none)
+            else:
+                value = field_converter(field, value)
+        if value is not None or print_none:
+            data[field.serialized_name or name] = value
+    return data
+
+
+def validate_fields(model, names):
+    """ Validate ``names`` fields subtrees and model validators depending on them """
+    cls = type(model)
+    errors = {}
+
+    def field_converter(field, value):
+        value = field.to_native(value)
+        field.validate(value)
+        return value
+
+    try:
+        data = import_loop(cls, dict([
+            (cls._fields[i].serialized_name or i, model._data.get(i)) for i in names
+        ]), field_converter, partial=True)
+    except ModelConversionError as e:
+        errors.update(e.messages)
+    else:
+        model._data.update([(i, data[i]) for i in names if i in data])
+    for name in names:
+        field = cls._fields[name]
+        if field.required and model._data.get(name) is None:
+            errors[field.serialized_name or name] = [field.messages['required']]
+    touched = set(names)
+    for name, dependencies in validator_dependencies(cls).items():
+        if name not in model._data or not dependencies & touched:
+            continue
+        try:
+            cls._validator_functions[name](cls, model._data, model._data[name])
+        except BaseError as e:
+            errors[cls._fields[name].serialized_name or name] = e.messages
+    if errors:
+        raise ModelValidationError(errors)
+
+
+def patched_model(model, context, data):
+    """ Copy of ``context`` as ``model`` with ``data`` patch applied.
+
+    Untouched fields are shared with context, only patched top level
+    subtrees are converted and validated. Returns model and names of
+    patched fields.
+    """
+    cls = model
+    names = field_names(cls, data)
+    initial_data = export_fields(context, names, print_none=False)
+    new_patch = apply_data_patch(initial_data, data)
+    m = cls()
+    m._data.update(context._data)
+    m.__parent__ = context.__parent__
+    if new_patch:
+        m.import_data(new_patch, partial=True, strict=True)
+        # conversion fills defaults of fields missing in patch
+        m._data.update([(k, v) for k, v in context._data.items() if k not in names])
+    validate_fields(m, names)
+    return m, names
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+from schematics.transforms import wholelist
+from schematics.types.compound import ModelType, ListType, DictType
+
+
+ProjectionPlan = namedtuple('ProjectionPlan', ['raw', 'model', 'cost'])
+
+PROJECTION_PLANS = {}
+PLAIN_MODELS = {}
+
+
+def role_filter(model_class, role):
+    roles = model_class._options.roles
+    return roles[role] if role in roles else roles.get('default', wholelist())
+
+
+def is_plain_type(field, role):
+    """ Exported value of field is the same as stored JSON """
+    if isinstance(field, ModelType):
+        return is_plain_model(field.model_class, role)
+    if isinstance(field, (ListType, DictType)):
+        return is_plain_type(field.field, role)
+    return True
+
+
+def is_plain_model(model_class, role):
+    """ Model has no serializables and its role drops nothing but __parent__ """
+    key = (model_class, role)
+    if key not in PLAIN_MODELS:
+        PLAIN_MODELS[key] = True  # recursive models
+        gottago = role_filter(model_class, role)
+        PLAIN_MODELS[key] = not model_class._serializables and all([
+            not gottago(name, None) and is_plain_type(field, role)
+            for name, field in model_class._fields.items()
+            if name != '__parent__'
+        ])
+    return PLAIN_MODELS[key]
+
+
+def projection_plan(model_class, role, fields):
+    """ Which of ``fields`` can be copied from stored document as is.
+
+    ``cost`` maps every field to 'raw', 'hidden' (dropped by role or
+    unknown) or 'model' when model has to be built to export it.
+    """
+    key = (model_class, role, tuple(sorted(fields)))
+    if key in PROJECTION_PLANS:
+        return PROJECTION_PLANS[key]
+    gottago = role_filter(model_class, role)
+    by_serialized_name = dict([
+        (field.serialized_name or name, (name, field))
+        for name, field in model_class._fields.items()
+    ])
+    serializables = set([
+        serializable.serialized_name or name
+        for name, serializable in model_class._serializables.items()
+    ])
+    raw, model, cost = [], [], {}
+    for i in fields:
+        if i in serializables:
+            model.append(i)
+            cost[i] = 'model'
+        elif i not in by_serialized_name or gottago(by_serialized_name[i][0], None):
+            cost[i] = 'hidden'
+        elif is_plain_type(by_serialized_name[i][1], role):
+            raw.append((i, by_serialized_name[i][1]._default not in (None, [], {})))
+            cost[i] = 'raw'
+        else:
+            model.append(i)
+            cost[i] = 'model'
+    plan = PROJECTION_PLANS[key] = ProjectionPlan(tuple(raw), tuple(model), cost)
+    return plan
+
+
+def scalar_fields(model_class, fields):
+    """ Whether every of ``fields`` is stored as JSON scalar, not object or array """
+    compound = set([
+        field.serialized_name or name
+        for name, field in model_class._fields.items()
+        if isinstance(field, (ModelType, ListType, DictType))
+    ])
+    return not compound.intersection(fields)
+
+
+def project_document(doc, plan):
+    """ Export plan fields of stored document, None if model is required """
+    if plan.model:
+        return None
+    data = {}
+    for name, has_default in plan.raw:
+        value = doc.get(name)
+        if value is None:
+            if has_default:
+                return None
+            continue
+        data[name] = value
+    return data
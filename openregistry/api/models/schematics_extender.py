@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import re
 from datetime import datetime
 from iso8601 import parse_date, ParseError
 from hashlib import algorithms, new as hash_new
@@ -8,9 +9,57 @@ from schematics.models import Model as SchematicsModel
 
 from schematics.types.compound import ListType as BaseListType
 from schematics.types import BaseType, StringType
-from schematics.transforms import whitelist, blacklist, export_loop, convert
+from schematics.transforms import whitelist, blacklist, convert
 from openregistry.api.constants import TZ
-from openregistry.api.utils import get_now, set_parent
+from openregistry.api.utils import get_now, set_parent, LRUCache
+from openregistry.api.models.serializer import COMPILED_LOOPS, serialize_model
+
+
+# format of datetime.isoformat() for dates with time zone
+ISO_DATETIME = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{6}))?([+-]\d\d:\d\d)$')
+ISO_OFFSETS = {}
+PARSED_DATES = LRUCache(10000)
+FORMATTED_DATES = LRUCache(10000)
+
+
+def parse_isoformat(value):
+    """ Parse date in format emitted by API, None if it does not match """
+    match = ISO_DATETIME.match(value)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, microsecond, offset = match.groups()
+    if offset not in ISO_OFFSETS:
+        # same time zone objects as iso8601 gives
+        ISO_OFFSETS[offset] = parse_date('2000-01-01T00:00:00' + offset).tzinfo
+    try:
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                        int(microsecond or 0), ISO_OFFSETS[offset])
+    except ValueError:
+        return None
+
+
+def parse_datetime(value):
+    """ ``iso8601.parse_date`` localized to TZ, cached for strings """
+    if not isinstance(value, basestring):
+        date = parse_date(value, None)
+    else:
+        date = PARSED_DATES.get(value)
+        if date is not None:
+            return date
+        date = parse_isoformat(value) or parse_date(value, None)
+    if not date.tzinfo:
+        date = TZ.localize(date)
+    if isinstance(value, basestring):
+        PARSED_DATES[value] = date
+    return date
+
+
+def format_datetime(value):
+    key = (value.utcoffset(), value)
+    text = FORMATTED_DATES.get(key)
+    if text is None:
+        text = FORMATTED_DATES[key] = value.isoformat()
+    return text
 
 
 class IsoDateTimeType(BaseType):
@@ -22,17 +71,14 @@ class IsoDateTimeType(BaseType):
         if isinstance(value, datetime):
             return value
         try:
-            date = parse_date(value, None)
-            if not date.tzinfo:
-                date = TZ.localize(date)
-            return date
+            return parse_datetime(value)
         except ParseError:
             raise ConversionError(self.messages['parse'].format(value))
         except OverflowError as e:
             raise ConversionError(e.message)
 
     def to_primitive(self, value, context=None):
-        return value.isoformat()
+        return format_datetime(value)
 
 
 class HashType(StringType):
@@ -99,6 +145,9 @@ class ListType(BaseListType):
             return data
 
 
+COMPILED_LOOPS[ListType.export_loop.__func__] = (list, True)
+
+
 class Model(SchematicsModel):
     class Options(object):
         """Export options for Document."""
@@ -137,9 +186,11 @@ class Model(SchematicsModel):
         Return data as it would be validated. No filtering of output unless
         role is defined.
         """
-        field_converter = lambda field, value: field.to_primitive(value)
-        data = export_loop(self.__class__, self, field_converter, role=role, raise_error_on_role=True, print_none=True)
-        return data
+        return serialize_model(self.__class__, self, role, print_none=True, with_context=False,
+                               raise_error_on_role=True)
+
+    def to_primitive(self, role=None, context=None):
+        return serialize_model(self.__class__, self, role, context, raise_error_on_role=True)
 
     def get_role(self):
         root = self.__parent__
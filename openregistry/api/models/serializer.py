@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+from itertools import chain
+from schematics.models import Model
+from schematics.transforms import Role, allow_none, export_loop, sort_dict
+from schematics.types.compound import ListType, DictType, ModelType
+
+from openregistry.api.models.projection import role_filter
+
+# role functions not looking at field value, so role can be applied once
+STATIC_ROLES = (Role.wholelist, Role.whitelist, Role.blacklist)
+
+# export_loop implementations replaced by compiled loops: (container,
+# whether nested values get print_none of the container)
+COMPILED_LOOPS = {
+    ListType.export_loop.__func__: (list, False),
+    DictType.export_loop.__func__: (dict, False),
+}
+
+SERIALIZERS = {}
+
+# path key standing for every item of a list
+EACH = None
+
+DOCUMENT_PATHS = {}
+
+
+def scalar_converter(field, with_context):
+    to_primitive = field.to_primitive
+    if with_context:
+        return lambda value, context: to_primitive(value, context=context)
+    return lambda value, context: to_primitive(value)
+
+
+def loop_converter(field, role, print_none, with_context):
+    """ Fallback to own ``export_loop`` of field """
+    if with_context:
+        return lambda value, context: field.export_loop(
+            value, lambda f, v: f.to_primitive(v, context=context), role=role, print_none=print_none)
+    field_converter = lambda f, v: f.to_primitive(v)
+    return lambda value, context: field.export_loop(value, field_converter, role=role, print_none=print_none)
+
+
+def model_converter(field, role, print_none, with_context):
+    model_class = field.model_class
+
+    def convert(value, context):
+        cls = value.__class__ if isinstance(value, model_class) else model_class
+        shaped = serialize_model(cls, value, role, context, print_none, with_context)
+        if shaped or print_none:
+            return shaped
+    return convert
+
+
+def container_converter(field, container, nested_print_none, role, print_none, with_context):
+    item_field = field.field
+    compound = hasattr(item_field, 'export_loop')
+    convert_item = field_converter(item_field, role, print_none if nested_print_none else False, with_context)
+    item_allow_none = item_field.allow_none()
+    field_allow_none = field.allow_none()
+
+    def keep(shaped):
+        if shaped is None:
+            return print_none or not compound and item_allow_none
+        return True
+
+    # models can prepare export of whole list at once, see Document
+    prepare = getattr(getattr(item_field, 'model_class', None), 'prepare_export', None)
+
+    if container is list:
+        def convert(value, context):
+            if prepare is not None:
+                prepare(value, role)
+            data = [i for i in [convert_item(i, context) for i in value] if keep(i)]
+            if data or field_allow_none or print_none:
+                return data
+    else:
+        def convert(value, context):
+            data = dict([(k, v) for k, v in [(k, convert_item(v, context)) for k, v in value.iteritems()] if keep(v)])
+            if data or field_allow_none or print_none:
+                return data
+    return convert
+
+
+def field_converter(field, role, print_none, with_context):
+    """ Function converting field value the way its ``export_loop`` would """
+    loop = getattr(type(field), 'export_loop', None)
+    if loop is None:
+        if hasattr(field, 'export_loop'):  # serializable of compound type
+            return loop_converter(field, role, print_none, with_context)
+        return scalar_converter(field, with_context)
+    loop = getattr(loop, '__func__', loop)
+    if loop is ModelType.export_loop.__func__:
+        return model_converter(field, role, print_none, with_context)
+    if loop in COMPILED_LOOPS:
+        return container_converter(field, COMPILED_LOOPS[loop][0], COMPILED_LOOPS[loop][1],
+                                   role, print_none, with_context)
+    return loop_converter(field, role, print_none, with_context)
+
+
+def compile_serializer(cls, role, print_none, with_context):
+    """ Fields of ``cls`` exported in ``role`` with their converters.
+
+    Returns (entries, gottago, fields_order), entries are tuples of field
+    name, serialized name, whether value is read from model data,
+    converter and allow_none. ``gottago`` is role to check for every
+    export if it looks at values, None otherwise.
+    """
+    gottago = role_filter(cls, role)
+    static = isinstance(gottago, Role) and gottago.function in STATIC_ROLES
+    entries = []
+    for name, field in chain(cls._fields.iteritems(), cls._serializables.iteritems()):
+        if static and gottago(name, None):
+            continue
+        entries.append((
+            name,
+            field.serialized_name or name,
+            name in cls._fields and getattr(cls, name, None) is field,
+            field_converter(field, role, print_none, with_context),
+            allow_none(cls, field),
+        ))
+    return tuple(entries), None if static else gottago, getattr(cls._options, 'fields_order', None)
+
+
+def serialize_model(cls, instance, role=None, context=None, print_none=False, with_context=True,
+                    raise_error_on_role=False):
+    """ ``export_loop`` of schematics with role and converters of every
+        (model class, role) compiled once.
+    """
+    if role and raise_error_on_role and role not in cls._options.roles:
+        raise ValueError(u'%s Model has no role "%s"' % (cls.__name__, role))
+    if not isinstance(instance, Model):
+        if with_context:
+            converter = lambda field, value: field.to_primitive(value, context=context)
+        else:
+            converter = lambda field, value: field.to_primitive(value)
+        return export_loop(cls, instance, converter, role=role, print_none=print_none)
+    key = (cls, role, print_none, with_context)
+    serializer = SERIALIZERS.get(key)
+    if serializer is None:
+        serializer = SERIALIZERS[key] = compile_serializer(cls, role, print_none, with_context)
+    entries, gottago, fields_order = serializer
+    values = instance._data
+    data = {}
+    for name, serialized_name, stored, convert, allowed in entries:
+        value = values[name] if stored else instance[name]
+        if gottago is not None and gottago(name, value):
+            continue
+        if value is not None:
+            value = convert(value, context)
+        if value is not None or allowed or print_none:
+            data[serialized_name] = value
+    if data:
+        return sort_dict(data, fields_order) if fields_order else data
+    elif print_none:
+        return data
+
+
+def field_document_paths(field, seen):
+    field = getattr(field, 'type', field)  # serializable
+    if not hasattr(field, 'export_loop'):
+        return []
+    if isinstance(field, ModelType):
+        return model_document_paths(field.model_class, seen)
+    if isinstance(field, ListType):
+        return [(EACH,) + path for path in field_document_paths(field.field, seen)]
+    return [()]  # unknown compound type, walked as a whole
+
+
+def model_document_paths(cls, seen):
+    if 'format' in cls._fields and 'url' in cls._fields or cls in seen:
+        return [()]
+    paths = []
+    for name, field in chain(cls._fields.iteritems(), cls._serializables.iteritems()):
+        if name != '__parent__':
+            key = field.serialized_name or name
+            paths.extend([(key,) + path for path in field_document_paths(field, seen + (cls,))])
+    return paths
+
+
+def document_paths(cls, fields=None):
+    """ Paths to nodes of exported ``cls`` which may hold document URLs.
+
+    Path is a tuple of keys, ``EACH`` for items of list. With ``fields``
+    only paths of these top level fields are returned, fields unknown to
+    ``cls`` are returned as a whole.
+    """
+    paths = DOCUMENT_PATHS.get(cls)
+    if paths is None:
+        paths = DOCUMENT_PATHS[cls] = tuple(model_document_paths(cls, ()))
+    if fields is None or () in paths:
+        return paths
+    names = set([field.serialized_name or name
+                 for name, field in chain(cls._fields.iteritems(), cls._serializables.iteritems())])
+    return tuple([i for i in paths if i[0] in fields] + [(i,) for i in fields if i not in names])
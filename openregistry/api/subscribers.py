@@ -1,28 +1,37 @@
 # -*- coding: utf-8 -*-
 from pyramid.events import subscriber
 from pyramid.events import NewRequest, BeforeRender, ContextFound
-from openregistry.api.constants import VERSION
-from openregistry.api.utils import get_now, update_logging_context, fix_url
+from pyramid.httpexceptions import HTTPServiceUnavailable
+from datetime import datetime
+from time import time as ttime
+from openregistry.api.constants import VERSION, TZ
+from openregistry.api.utils import (
+    update_logging_context, fix_url, fix_url_paths, request_json_body, context_document_paths
+)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
 
 
 @subscriber(NewRequest)
 def add_logging_context(event):
     request = event.request
-    params = {
+    timestamp = ttime()
+    # merged into values set earlier, e.g. by request_json_body
+    update_logging_context(request, {
         'API_VERSION': VERSION,
         'TAGS': 'python,api',
-        'USER': str(request.authenticated_userid or ''),
-        'CURRENT_URL': request.url,
-        'CURRENT_PATH': request.path_info,
-        'REMOTE_ADDR': request.remote_addr or '',
-        'USER_AGENT': request.user_agent or '',
         'REQUEST_METHOD': request.method,
-        'TIMESTAMP': get_now().isoformat(),
         'REQUEST_ID': request.environ.get('REQUEST_ID', ''),
-        'CLIENT_REQUEST_ID': request.headers.get('X-Client-Request-ID', ''),
-    }
-
-    request.logging_context = params
+    })
+    update_logging_context(request, {
+        'USER': lambda: str(request.authenticated_userid or ''),
+        'CURRENT_URL': lambda: request.url,
+        'CURRENT_PATH': lambda: request.path_info,
+        'REMOTE_ADDR': lambda: request.remote_addr or '',
+        'USER_AGENT': lambda: request.user_agent or '',
+        'TIMESTAMP': lambda: datetime.fromtimestamp(timestamp, TZ).isoformat(),
+        'CLIENT_REQUEST_ID': lambda: request.headers.get('X-Client-Request-ID', ''),
+    }, lazy=True)
 
 
 @subscriber(ContextFound)
@@ -30,13 +39,24 @@ def set_logging_context(event):
     request = event.request
 
     params = dict()
-    params['ROLE'] = str(request.authenticated_role)
+    params['ROLE'] = lambda: str(request.authenticated_role)
     if request.params:
-        params['PARAMS'] = str(dict(request.params))
+        params['PARAMS'] = lambda: str(dict(request.params))
+    update_logging_context(request, params, lazy=True)
     if request.matchdict:
-        for x, j in request.matchdict.items():
-            params[x.upper()] = j
-    update_logging_context(request, params)
+        update_logging_context(request, request.matchdict)
+
+
+@subscriber(NewRequest)
+def check_schema_pending(event):
+    """ Only reads are served while other process migrates database """
+    request = event.request
+    schema_state = getattr(request.registry, 'schema_state', None)
+    if schema_state is not None and schema_state.pending and request.method not in SAFE_METHODS:
+        raise HTTPServiceUnavailable(json_body={
+            'status': 'error',
+            'errors': [{'location': 'body', 'name': 'data', 'description': 'Database migration is in progress'}]
+        })
 
 
 @subscriber(NewRequest)
@@ -44,7 +64,7 @@ def set_renderer(event):
     request = event.request
 
     try:
-        json = request.json_body
+        json = request_json_body(request)
     except ValueError:
         json = {}
     pretty = isinstance(json, dict) and json.get('options', {}).get('pretty') or request.params.get('opt_pretty')
@@ -63,4 +83,12 @@ def set_renderer(event):
 @subscriber(BeforeRender)
 def beforerender(event):
     if event.rendering_val and isinstance(event.rendering_val, dict) and 'data' in event.rendering_val:
-        fix_url(event.rendering_val['data'], event['request'].application_url)
+        request = event['request']
+        # set by views which know model of data, see document_paths
+        paths = request.__dict__.get('document_url_paths')
+        if paths is None:
+            paths = context_document_paths(request, event.rendering_val['data'])
+        if paths is None:
+            fix_url(event.rendering_val['data'], request.application_url)
+        elif paths:
+            fix_url_paths(event.rendering_val['data'], paths, request.application_url)
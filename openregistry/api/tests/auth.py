@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 import unittest
+import mock
 from pyramid import testing
-from openregistry.api.auth import AuthenticationPolicy
+from openregistry.api.auth import AuthenticationPolicy, AuthFile, authenticated_role, get_local_roles
 from pyramid.tests.test_authentication import TestBasicAuthAuthenticationPolicy
 import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from hashlib import sha512
+from time import time as ttime
 
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -22,9 +27,168 @@ class AuthTest(TestBasicAuthAuthenticationPolicy):
         policy = self._makeOne(None)
         self.assertEqual(policy.unauthenticated_userid(request), 'chrisr')
 
+    def test_resolved_once_per_request(self):
+        policy = self._makeOne(None)
+        request = testing.DummyRequest()
+        request.headers['Authorization'] = 'Bearer chrisr'
+        with mock.patch.object(policy, '_get_credentials', wraps=policy._get_credentials) as get_credentials:
+            principals = policy.effective_principals(request)
+            self.assertEqual(policy.authenticated_userid(request), 'chrisr')
+            self.assertEqual(policy.effective_principals(request), principals)
+            self.assertEqual(get_credentials.call_count, 1)
+        self.assertIn('g:tests', principals)
+
+    def test_token_cache(self):
+        policy = self._makeOne(None)
+        with mock.patch('openregistry.api.auth.sha512', wraps=sha512) as hash_token:
+            for token in ['chrisr', 'chrisr', 'unknown', 'unknown']:
+                request = testing.DummyRequest()
+                request.headers['Authorization'] = 'Bearer {}'.format(token)
+                policy.unauthenticated_userid(request)
+                policy.callback(policy.unauthenticated_userid(request), request)
+            self.assertEqual(hash_token.call_count, 4)  # once per request
+            self.assertIsNone(policy.get_user('unknown'))
+
+        # tokens are kept hashed, as in auth file
+        self.assertEqual(sorted(policy.token_users.recent), sorted([sha512('chrisr').hexdigest(),
+                                                                    sha512('unknown').hexdigest()]))
+        with mock.patch.object(policy.auth_file, 'users', {}):
+            self.assertEqual(policy.get_user('chrisr')['name'], 'chrisr')
+            with mock.patch('openregistry.api.utils.ttime', return_value=ttime() + 301):
+                self.assertIsNone(policy.get_user('chrisr'))
+
+
+class DummyLocation(object):
+
+    def __init__(self, parent, roles):
+        self.__parent__ = parent
+        self.__local_roles__ = mock.MagicMock(return_value=roles)
+
+
+class DummyOwnedLocation(object):
+
+    def __init__(self, parent, owner, owner_token):
+        self.__parent__ = parent
+        self.owner = owner
+        self.owner_token = owner_token
+        self.calls = 0
+
+    def __local_roles__(self):
+        self.calls += 1
+        return {'{}_{}'.format(self.owner, self.owner_token): 'asset_owner'}
+
+
+class DummyPrincipalsRequest(object):
+    pass
+
+
+class AuthenticatedRoleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.request = DummyPrincipalsRequest()
+        self.request.effective_principals = ['system.Everyone', 'g:brokers', 'broker_token']
+        self.root = DummyLocation(None, {})
+        self.resource = DummyLocation(self.root, {'broker_token': 'asset_owner'})
+        self.document = DummyLocation(self.resource, {'other_token': 'document_owner'})
+
+    def test_local_roles(self):
+        self.request.context = self.document
+        self.assertEqual(authenticated_role(self.request), 'asset_owner')
+        self.request.context = self.resource
+        self.assertEqual(authenticated_role(self.request), 'asset_owner')
+        self.assertEqual(authenticated_role(self.request), 'asset_owner')
+        self.assertEqual(self.resource.__local_roles__.call_count, 1)
+        self.assertEqual(self.root.__local_roles__.call_count, 1)
+
+        self.request.context = self.root
+        self.assertEqual(authenticated_role(self.request), 'brokers')
+
+    def test_owner_change(self):
+        resource = DummyOwnedLocation(self.root, 'broker', 'token')
+        self.request.context = DummyLocation(resource, {})
+        self.request.effective_principals = ['system.Everyone', 'g:brokers', 'broker_token']
+        self.assertEqual(authenticated_role(self.request), 'asset_owner')
+        self.assertEqual(authenticated_role(self.request), 'asset_owner')
+        self.assertEqual(resource.calls, 1)
+
+        resource.owner_token = 'other'  # e.g. ownership transfer
+        self.assertEqual(authenticated_role(self.request), 'brokers')
+        self.assertEqual(resource.calls, 2)
+        resource.owner_token = 'token'
+        self.assertEqual(authenticated_role(self.request), 'asset_owner')
+
+    def test_no_context(self):
+        self.assertEqual(authenticated_role(self.request), 'brokers')
+        self.request.effective_principals = ['system.Everyone']
+        del self.request.__dict__['authenticated_roles']
+        self.assertEqual(authenticated_role(self.request), 'anonymous')
+
+    def test_get_local_roles(self):
+        self.assertEqual(get_local_roles(self.document),
+                         {'broker_token': 'asset_owner', 'other_token': 'document_owner'})
+        get_local_roles(self.document)
+        self.assertEqual(self.resource.__local_roles__.call_count, 2)
+
+
+class AuthFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.path = os.path.join(self.dir, 'auth.ini')
+        self.write({'broker': 'token'})
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write(self, users):
+        with open(self.path, 'w') as auth_file:
+            auth_file.write('[brokers]\n')
+            for name, token in users.items():
+                auth_file.write('{} = {},1\n'.format(name, sha512(token).hexdigest()))
+        os.utime(self.path, (ttime() + len(users), ttime() + len(users)))
+
+    def test_reload(self):
+        policy = AuthenticationPolicy(self.path, 'SomeRealm')
+        users = policy.users
+        self.assertEqual(policy.get_user('token')['name'], 'broker')
+        self.assertFalse(policy.auth_file.reload())
+
+        self.write({'broker2': 'token2', 'broker3': 'token'})
+        self.assertTrue(policy.auth_file.reload())
+        self.assertEqual(policy.get_user('token')['name'], 'broker3')
+        self.assertEqual(policy.get_user('token2'), {'name': 'broker2', 'level': '1', 'group': 'brokers'})
+        self.assertEqual(len(users), 1)
+
+    def test_invalid_file(self):
+        policy = AuthenticationPolicy(self.path, 'SomeRealm')
+        users = policy.users
+        os.remove(self.path)
+        self.assertFalse(policy.auth_file.reload())
+        self.assertIs(policy.users, users)
+
+        with open(self.path, 'w') as auth_file:
+            auth_file.write('broker = {}'.format(sha512('token').hexdigest()[:20]))  # partially written
+        self.assertFalse(policy.auth_file.reload())
+        self.assertIs(policy.users, users)
+
+        self.write({})
+        self.assertFalse(policy.auth_file.reload())
+        self.assertEqual(policy.get_user('token')['name'], 'broker')
+
+        self.write({'broker2': 'token2'})
+        self.assertTrue(policy.auth_file.reload())
+        self.assertEqual(policy.get_user('token2')['name'], 'broker2')
+
+    def test_missing_file(self):
+        auth_file = AuthFile(os.path.join(self.dir, 'missing.ini'))
+        self.assertEqual(auth_file.users, {})
+        self.assertFalse(auth_file.reload())
+
 
 def suite():
     suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(AuthFileTest))
+    suite.addTest(unittest.makeSuite(AuthenticatedRoleTest))
     suite.addTest(unittest.makeSuite(AuthTest))
     return suite
 
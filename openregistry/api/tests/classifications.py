@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import unittest
+from schematics.exceptions import ModelValidationError
+
+from openregistry.api.classifications import (
+    ClassificationScheme, code_prefix, choices_message
+)
+from openregistry.api.constants import ITEM_CLASSIFICATIONS, CPV_CODES
+from openregistry.api.models.ocds import ItemClassification
+
+
+class ClassificationSchemeTest(unittest.TestCase):
+
+    def test_code_prefix(self):
+        self.assertEqual(code_prefix('45200000-9'), '452')
+        self.assertEqual(code_prefix('45000000-7'), '45')
+        self.assertEqual(code_prefix('45262410-1'), '4526241')
+        self.assertEqual(code_prefix('30000000-9'), '30')
+        self.assertEqual(code_prefix('90000000'), '90')
+        self.assertEqual(code_prefix('00000000'), '00')
+
+    def test_membership(self):
+        scheme = ITEM_CLASSIFICATIONS[u'CPV']
+        self.assertEqual(len(scheme), len(set(CPV_CODES)))
+        self.assertIn(u'44617100-9', scheme)
+        self.assertNotIn(u'44617100', scheme)
+        self.assertNotIn(u'44617100-9', ITEM_CLASSIFICATIONS[u'CAV-PS'])
+
+    def test_lazy_index(self):
+        scheme = ClassificationScheme(u'CPV', ['45200000-9', '45000000-7'])
+        self.assertIsNone(scheme._index)
+        self.assertIn('45000000-7', scheme)
+        self.assertEqual(list(scheme), ['45200000-9', '45000000-7'])
+        self.assertEqual(scheme.codes, frozenset(['45200000-9', '45000000-7']))
+
+    def test_list_interface(self):
+        scheme = ClassificationScheme(u'CAV-PS', ['04000000-8'])
+        self.assertNotIn('04100000-9', scheme)
+        scheme.append('04100000-9')
+        self.assertIn('04100000-9', scheme)
+        scheme.extend(['04110000-2', '04120000-5'])
+        self.assertEqual(scheme.descendants('04100000-9'), ('04110000-2', '04120000-5'))
+        scheme += ['05000000-5']
+        del scheme[0]
+        self.assertNotIn('04000000-8', scheme)
+        self.assertIn('05000000-5', scheme)
+        self.assertEqual(scheme, ['04100000-9', '04110000-2', '04120000-5', '05000000-5'])
+        self.assertEqual(scheme[:1], ['04100000-9'])
+        self.assertEqual(repr(scheme), repr(list(scheme)))
+
+    def test_descendants(self):
+        scheme = ClassificationScheme(u'CPV', [
+            '45000000-7', '45200000-9', '45210000-2', '45212220-4',
+            '45300000-0', '44617100-9'
+        ])
+        self.assertEqual(scheme.descendants('45200000-9'),
+                         ('45210000-2', '45212220-4'))
+        self.assertEqual(scheme.descendants('45200000'),
+                         ('45210000-2', '45212220-4'))
+        self.assertEqual(scheme.descendants('45000000-7'),
+                         ('45200000-9', '45210000-2', '45212220-4', '45300000-0'))
+        self.assertEqual(scheme.descendants('45212220-4'), ())
+        self.assertEqual(scheme.descendants('99000000-0'), ())
+
+        cpv = ITEM_CLASSIFICATIONS[u'CPV']
+        works = cpv.descendants('45200000-9')
+        self.assertTrue(works)
+        self.assertTrue(all(i.startswith('452') for i in works))
+        # round divisions do not include neighbour ones
+        for division in ['30000000-9', '90000000-7']:
+            codes = cpv.descendants(division)
+            self.assertTrue(codes)
+            self.assertTrue(all(i[:2] == division[:2] for i in codes))
+
+    def test_choices_message(self):
+        self.assertEqual(choices_message(u'CPV', ('test', )), u"('test',)")
+        self.assertEqual(choices_message(u'CAV-PS', ClassificationScheme(u'CAV-PS', [u'test'])), u"[u'test']")
+        self.assertEqual(choices_message(u'CPV', ITEM_CLASSIFICATIONS[u'CPV']),
+                         u'CPV codes ({} available)'.format(len(ITEM_CLASSIFICATIONS[u'CPV'])))
+
+    def test_item_classification_error(self):
+        item_classification = ItemClassification({'scheme': u'CPV', 'id': u'test',
+                                                  'description': u'test'})
+        with self.assertRaises(ModelValidationError) as ex:
+            item_classification.validate()
+        message = ex.exception.messages['id'][0]
+        self.assertLess(len(message), 100)
+        self.assertIn(u'CPV codes', message)
+
+        item_classification.id = u'44617100-9'
+        item_classification.validate()
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ClassificationSchemeTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+import unittest
+import mock
+from copy import deepcopy
+from uuid import uuid4
+from couchdb.client import Row
+from couchdb.design import ViewDefinition
+from couchdb.http import ResourceConflict
+
+from openregistry.api.constants import DESIGN_DOC
+from openregistry.api.design import fields_view, FieldsViews, sync_design, design_docs, IndexWarmer
+
+
+base_view = ViewDefinition('assets', 'by_dateModified', '''function(doc) {
+    if(doc.doc_type == 'Asset') {
+        emit(doc.dateModified, null);
+    }
+}''')
+
+
+class FieldsViewsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mock.Mock()
+        self.db.name = 'db'
+
+    def test_fields_view(self):
+        view = fields_view(base_view, ['title', 'status'], ['status'])
+        self.assertEqual(view.name, 'projection')
+        self.assertIn(base_view.map_fun, view.map_fun)
+        self.assertIn('["title", "status"]', view.map_fun)
+        self.assertEqual(view.design, fields_view(base_view, ['title', 'status'], ['status']).design)
+        self.assertNotEqual(view.design, fields_view(base_view, ['title'], ['status']).design)
+        self.assertNotEqual(view.design, fields_view(base_view, ['title', 'status']).design)
+
+    def test_scalar_fields(self):
+        view = fields_view(base_view, ['title'])
+        self.assertIn("typeof field === 'object'", view.map_fun)
+
+    def test_get(self):
+        views = FieldsViews([(base_view, ['title', 'status'], ['status'])])
+        self.assertEqual(len(views.views), 1)
+        self.assertIsNone(views.get(self.db, base_view, ['status', 'title'], ['status']))
+
+        with mock.patch.object(ViewDefinition, '__call__') as call:
+            views.build(self.db)
+        call.assert_called_once_with(self.db, limit=1)
+        view = views.get(self.db, base_view, ['status', 'title'], ['status'])
+        self.assertEqual(view.design, fields_view(base_view, ['status', 'title'], ['status']).design)
+        self.assertIsNone(views.get(self.db, base_view, ['title']))
+        self.assertIsNone(views.get(self.db, other_view, ['status', 'title'], ['status']))
+        other_db = mock.Mock()
+        other_db.name = 'other'
+        self.assertIsNone(views.get(other_db, base_view, ['status', 'title'], ['status']))
+
+    def test_build_failed(self):
+        views = FieldsViews([(base_view, ['title'], [])])
+        with mock.patch.object(ViewDefinition, '__call__', side_effect=Exception):
+            views.build(self.db)
+        self.assertIsNone(views.get(self.db, base_view, ['title']))
+
+    def test_sync(self):
+        db = DummyDesignDB()
+        views = FieldsViews([(base_view, ['title'], []), (base_view, ['status'], [])])
+        self.assertEqual(len(views.sync(db)), 2)
+        self.assertEqual(len([i for i in db.docs if i.startswith('_design/fields_')]), 2)
+
+        views = FieldsViews([(base_view, ['title'], [])])
+        self.assertEqual(views.sync(db), [])
+        designs = [i for i in db.docs if i.startswith('_design/fields_')]
+        self.assertEqual(designs, ['_design/' + views.views.values()[0].design])
+        self.assertEqual(sorted(db.docs[DESIGN_DOC]['designs']), designs)
+
+        FieldsViews([]).sync(db)
+        self.assertEqual([i for i in db.docs if i.startswith('_design/')], [])
+
+
+class DummyDesignDB(object):
+
+    def __init__(self):
+        self.docs = {}
+        self.requests = []
+        self.views = []
+
+    def get(self, doc_id, default=None):
+        self.requests.append(('get', doc_id))
+        return deepcopy(self.docs.get(doc_id, default))
+
+    def __getitem__(self, doc_id):
+        return deepcopy(self.docs[doc_id])
+
+    def save(self, doc):
+        self.requests.append(('save', doc['_id']))
+        if doc.get('_rev') != self.docs.get(doc['_id'], {}).get('_rev'):
+            raise ResourceConflict
+        doc['_rev'] = uuid4().hex
+        self.docs[doc['_id']] = deepcopy(doc)
+        return doc['_id'], doc['_rev']
+
+    def update(self, docs):
+        return [(True,) + self.save(doc) for doc in docs]
+
+    def delete(self, doc):
+        self.requests.append(('delete', doc['_id']))
+        del self.docs[doc['_id']]
+
+    def view(self, name, **options):
+        if name == '_all_docs':
+            self.requests.append(('view', name))
+            if 'keys' not in options:
+                return [Row(id=i, key=i, value={'rev': self.docs[i]['_rev']}) for i in sorted(self.docs)
+                        if options['startkey'] <= i <= options['endkey']]
+            return [Row(id=i, key=i, value={'rev': self.docs[i]['_rev']}) if i in self.docs else
+                    Row(key=i, error='not_found') for i in options['keys']]
+        self.views.append((name, deepcopy(self.docs['_design/' + name.split('/')[0]]['views'])))
+        return mock.Mock(rows=[])
+
+
+other_view = ViewDefinition('assets', 'by_status', '''function(doc) {
+    emit(doc.status, null);
+}''')
+
+
+class SyncDesignTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DummyDesignDB()
+
+    def test_digest(self):
+        self.assertEqual(sync_design(self.db, [base_view]), ['_design/assets'])
+        design = self.db.docs['_design/assets']
+        self.assertEqual(design['views']['by_dateModified']['map'], base_view.map_fun)
+        self.assertEqual(design['options'], {'local_seq': True})
+        self.assertEqual(self.db.docs[DESIGN_DOC]['designs']['_design/assets']['rev'], design['_rev'])
+
+        self.db.requests = []
+        self.assertEqual(sync_design(self.db, [base_view]), [])
+        self.assertEqual(self.db.requests, [('get', DESIGN_DOC), ('view', '_all_docs')])
+
+        self.assertEqual(sync_design(self.db, [base_view, other_view]), ['_design/assets'])
+        self.assertEqual(sorted(self.db.docs['_design/assets']['views']), ['by_dateModified', 'by_status'])
+
+    def test_changed_in_database(self):
+        sync_design(self.db, [base_view])
+        del self.db.docs['_design/assets']
+        self.assertEqual(sync_design(self.db, [base_view]), ['_design/assets'])
+        self.assertIn('_design/assets', self.db.docs)
+
+        design = self.db.get('_design/assets')
+        design['views']['by_dateModified']['map'] = 'function(doc) {}'
+        self.db.save(design)
+        self.assertEqual(sync_design(self.db, [base_view]), ['_design/assets'])
+        self.assertEqual(self.db.docs['_design/assets']['views']['by_dateModified']['map'], base_view.map_fun)
+        self.assertEqual(sync_design(self.db, [base_view]), [])
+
+    def test_staging(self):
+        sync_design(self.db, [base_view])
+        rev = self.db.docs['_design/assets']['_rev']
+        self.assertEqual(sync_design(self.db, [other_view], staging=True), ['_design/assets'])
+        # index is built in staging copy with views of updated document
+        name, views = self.db.views[0]
+        self.assertEqual(name, 'assets_staging/by_dateModified')
+        self.assertEqual(views, self.db.docs['_design/assets']['views'])
+        self.assertEqual(sorted(views), ['by_dateModified', 'by_status'])
+        self.assertNotEqual(self.db.docs['_design/assets']['_rev'], rev)
+        self.assertNotIn('_design/assets_staging', self.db.docs)
+        self.assertEqual(sync_design(self.db, [other_view], staging=True), [])
+
+    def test_state_conflict(self):
+        save = self.db.save
+
+        def conflict(doc):
+            if doc['_id'] == DESIGN_DOC:
+                raise ResourceConflict
+            return save(doc)
+        self.db.save = conflict
+        self.assertEqual(sync_design(self.db, [base_view]), ['_design/assets'])
+        self.assertIn('_design/assets', self.db.docs)
+
+    def test_prune(self):
+        sync_design(self.db, [base_view, fields_view(base_view, ['title']), fields_view(base_view, ['status'])])
+        self.db.docs['_design/fields_other_staging'] = {'_id': '_design/fields_other_staging', '_rev': '1'}
+        view = fields_view(base_view, ['title'])
+        self.assertEqual(sync_design(self.db, [view], prune='fields_'), [])
+        self.assertEqual(sorted(self.db.docs), sorted([
+            DESIGN_DOC, '_design/assets', '_design/' + view.design, '_design/fields_other_staging']))
+        self.assertEqual(sorted(self.db.docs[DESIGN_DOC]['designs']), ['_design/assets', '_design/' + view.design])
+
+    def test_design_docs(self):
+        docs = design_docs([base_view, other_view, fields_view(base_view, ['title'])])
+        self.assertEqual(len(docs), 2)
+        self.assertEqual(sorted(docs['_design/assets']['views']), ['by_dateModified', 'by_status'])
+        self.assertEqual(docs['_design/assets']['options'], {'local_seq': True})
+
+
+class IndexWarmerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mock.Mock()
+        self.db.info.side_effect = self.info
+        self.update_seq = 10
+        self.index_seq = {'assets': 4, 'assets_changes': 10}
+        self.views = [mock.Mock(design='assets'), mock.Mock(design='assets_changes'), mock.Mock(design='assets')]
+
+    def info(self, ddoc=None):
+        if ddoc:
+            return {'view_index': {'update_seq': self.index_seq[ddoc]}}
+        return {'update_seq': '{}-g1AAAA'.format(self.update_seq)}
+
+    @mock.patch('openregistry.api.design.spawn')
+    def test_warm(self, spawn):
+        warmer = IndexWarmer(self.db, self.views, 5)
+        spawn.assert_called_once_with(warmer.watch)
+        # index is updated by query, lag is checked after it
+        self.views[0].side_effect = lambda db, limit: self.index_seq.update(assets=self.update_seq) or mock.DEFAULT
+        warmer.warm()
+        self.assertEqual(warmer.lag, {'assets': 0, 'assets_changes': 0})
+        self.views[0].assert_called_once_with(self.db, limit=1)
+        self.views[1].assert_called_once_with(self.db, limit=1)
+        self.assertFalse(self.views[2].called)
+
+        warmer.warm()  # no writes since last warm
+        self.assertEqual(warmer.lag, {'assets': 0, 'assets_changes': 0})
+        self.assertEqual(self.views[0].call_count, 1)
+
+        self.update_seq = 12
+        warmer.warm()
+        self.assertEqual(warmer.lag, {'assets': 0, 'assets_changes': 2})
+        self.assertEqual(self.views[0].call_count, 2)
+
+    @mock.patch('openregistry.api.design.spawn')
+    def test_warm_failed(self, spawn):
+        warmer = IndexWarmer(self.db, self.views, 5)
+        self.views[0].side_effect = Exception
+        warmer.warm()
+        self.assertIsNone(warmer.update_seq)
+        self.views[1].assert_called_once_with(self.db, limit=1)
+        self.assertEqual(warmer.lag, {'assets': 6, 'assets_changes': 0})
+
+        self.views[0].side_effect = None
+        warmer.warm()  # warmed again though database was not written
+        self.assertEqual(self.views[0].call_count, 2)
+        self.assertEqual(warmer.update_seq, 10)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(FieldsViewsTest))
+    suite.addTest(unittest.makeSuite(SyncDesignTest))
+    suite.addTest(unittest.makeSuite(IndexWarmerTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
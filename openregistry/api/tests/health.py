@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from json import loads
 from uuid import uuid4
 from openregistry.api.tests.base import BaseWebTest
 from mock import Mock, MagicMock
@@ -94,3 +95,25 @@ class HealthTest_any(HealthTestBase):
     def test_health_view(self):
         response = self.app.get('/health?health_threshold_func=any', status=200)
         self.assertEqual(response.status, '200 OK')
+
+
+class HealthTestIndexLag(HealthTestBase):
+    return_value = [REPLICATION_OK]
+
+    def setUp(self):
+        super(HealthTestIndexLag, self).setUp()
+        self.app.app.registry.index_warmer = Mock(lag={'assets': 10})
+
+    def tearDown(self):
+        self.app.app.registry.index_warmer = None
+        self.app.app.registry.index_lag_threshold = 0
+
+    def test_health_view(self):
+        response = self.app.get('/health', status=200)
+        self.assertEqual(loads(response.headers['X-Index-Lag']), {'assets': 10})
+        self.assertNotIn('index_lag', response.json)
+
+        self.app.app.registry.index_lag_threshold = 5
+        response = self.app.get('/health', status=503)
+        self.assertEqual(loads(response.headers['X-Index-Lag']), {'assets': 10})
+        self.assertEqual(response.json.keys(), [REPLICATION_OK['replication_id']])
@@ -1,12 +1,23 @@
 # -*- coding: utf-8 -*-
 import unittest
+import mock
+from couchdb.client import Row
+from couchdb.http import ResourceConflict
 
+from gevent import sleep
+from pyramid.httpexceptions import HTTPServiceUnavailable
+from pyramid.request import Request
+from time import time
+
+from openregistry.api import migration
 from openregistry.api.migration import (
-    migrate_data, get_db_schema_version
+    migrate_data, get_db_schema_version, MigrationRunner, MigrationLock, SchemaState, run_migrations,
+    document_migration
 )
 from openregistry.api.constants import (
-    SCHEMA_VERSION
+    SCHEMA_VERSION, SCHEMA_DOC, MIGRATION_LOCK_DOC
 )
+from openregistry.api.subscribers import check_schema_pending
 from openregistry.api.tests.base import BaseWebTest
 
 
@@ -22,8 +33,227 @@ class MigrateTest(BaseWebTest):
         self.assertEqual(get_db_schema_version(self.db), SCHEMA_VERSION)
 
 
+class DummyMigrationDB(object):
+
+    def __init__(self, docs):
+        self.docs = dict([(i['_id'], dict(i, _rev='1')) for i in docs])
+        self.updates = []
+
+    def view(self, name, include_docs=False, limit=None, startkey=None, skip=0):
+        ids = sorted([i for i in self.docs if startkey is None or i >= startkey])[skip:skip + limit]
+        return [Row(id=i, key=i, value={'rev': self.docs[i]['_rev']}, doc=dict(self.docs[i])) for i in ids]
+
+    def get(self, docid, default=None):
+        return dict(self.docs[docid]) if docid in self.docs else default
+
+    def save(self, doc):
+        success, docid, error = self.update([doc])[0]
+        if not success:
+            raise error
+
+    def delete(self, doc):
+        del self.docs[doc['_id']]
+
+    def update(self, docs):
+        self.updates.append([i['_id'] for i in docs])
+        results = []
+        for doc in docs:
+            if doc['_id'] in self.docs and self.docs[doc['_id']]['_rev'] != doc.get('_rev'):
+                results.append((False, doc['_id'], ResourceConflict()))
+                continue
+            doc['_rev'] = str(int(doc.get('_rev', 0)) + 1)
+            self.docs[doc['_id']] = dict(doc)
+            results.append((True, doc['_id'], doc['_rev']))
+        return results
+
+
+def add_title(doc):
+    if 'title' not in doc:
+        return dict(doc, title=doc['_id'])
+
+
+class MigrationRunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DummyMigrationDB([{'_id': '{:03}'.format(i)} for i in range(25)] + [
+            {'_id': '_design/test'}, {'_id': SCHEMA_DOC, 'version': 1},
+            {'_id': MIGRATION_LOCK_DOC, 'owner': 'test'},
+            {'_id': 'resource_revision_20180101000000000000_0000000001_0', 'doc_type': 'Revision'},
+        ])
+
+    def test_run(self):
+        stats = MigrationRunner(self.db, 'add_title', add_title, batch_size=10, workers=2).run()
+        self.assertEqual((stats['read'], stats['migrated'], stats['failed'], stats['batches']), (25, 25, 0, 3))
+        self.assertEqual(self.db.docs['024']['title'], '024')
+        self.assertNotIn('title', self.db.docs['_design/test'])
+        self.assertNotIn('title', self.db.docs[MIGRATION_LOCK_DOC])
+        self.assertNotIn('title', self.db.docs['resource_revision_20180101000000000000_0000000001_0'])
+        self.assertEqual(self.db.docs[SCHEMA_DOC]['migrations'], {})
+
+        stats = MigrationRunner(self.db, 'add_title', add_title, batch_size=10).run()
+        self.assertEqual((stats['read'], stats['migrated']), (25, 0))
+
+    def test_dry_run(self):
+        stats = MigrationRunner(self.db, 'add_title', add_title, batch_size=10, dry_run=True).run()
+        self.assertEqual(stats['migrated'], 25)
+        self.assertEqual(self.db.updates, [])
+
+    def test_resume(self):
+        def migrate(doc):
+            if doc['_id'] == '015':
+                raise KeyboardInterrupt
+            return add_title(doc)
+        with self.assertRaises(KeyboardInterrupt):
+            MigrationRunner(self.db, 'add_title', migrate, batch_size=10, workers=1).run()
+        checkpoint = self.db.docs[SCHEMA_DOC]['migrations']['add_title']
+        self.assertEqual((checkpoint['last_id'], checkpoint['read']), ('009', 10))
+
+        migrate = mock.MagicMock(side_effect=add_title)
+        stats = MigrationRunner(self.db, 'add_title', migrate, batch_size=10).run()
+        self.assertEqual(migrate.call_count, 15)
+        self.assertEqual((stats['read'], stats['migrated']), (25, 25))
+        self.assertEqual(self.db.docs[SCHEMA_DOC]['version'], 1)
+
+    def test_resume_deleted(self):
+        checkpoint = {'last_id': '009', 'read': 10, 'migrated': 10}
+        self.db.docs[SCHEMA_DOC]['migrations'] = {'add_title': checkpoint}
+        del self.db.docs['009']
+        migrate = mock.MagicMock(side_effect=add_title)
+        stats = MigrationRunner(self.db, 'add_title', migrate, batch_size=10).run()
+        self.assertEqual([i[0][0]['_id'] for i in migrate.call_args_list], ['{:03}'.format(i) for i in range(10, 25)])
+        self.assertEqual(stats['read'], 25)
+
+    def test_failures_and_conflicts(self):
+        def migrate(doc):
+            if doc['_id'] == '003':
+                raise ValueError('broken')
+            if doc['_id'] == '004' and doc['_rev'] == '1':
+                self.db.docs['004']['_rev'] = '2'  # changed concurrently
+            return add_title(doc)
+        stats = MigrationRunner(self.db, 'add_title', migrate, batch_size=10).run()
+        self.assertEqual((stats['migrated'], stats['failed'], stats['conflicts']), (24, 1, 0))
+        self.assertEqual(self.db.docs['004']['title'], '004')
+        self.assertNotIn('title', self.db.docs['003'])
+
+    def test_lasting_conflict(self):
+        def migrate(doc):
+            if doc['_id'] == '004':
+                self.db.docs['004']['_rev'] = str(int(doc['_rev']) + 1)  # changed on every read
+            return add_title(doc)
+        stats = MigrationRunner(self.db, 'add_title', migrate, batch_size=10).run()
+        self.assertEqual((stats['migrated'], stats['failed'], stats['conflicts']), (24, 0, 1))
+        self.assertNotIn('title', self.db.docs['004'])
+
+    def test_migrate_data(self):
+        del self.db.docs[SCHEMA_DOC]['version']
+        registry = mock.Mock(db=self.db, settings={'migration_batch_size': '10'})
+        step = 'from{}to{}'.format(SCHEMA_VERSION - 1, SCHEMA_VERSION)
+        with mock.patch.dict(migration.__dict__, {step: document_migration(mock.MagicMock(side_effect=add_title))}):
+            migrate_data(registry)
+            self.assertEqual(migration.__dict__[step].call_count, 25)
+        self.assertEqual(self.db.docs['024']['title'], '024')
+        self.assertEqual(get_db_schema_version(self.db), SCHEMA_VERSION)
+
+
+class MigrationLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DummyMigrationDB([{'_id': SCHEMA_DOC, 'version': SCHEMA_VERSION}])
+
+    def test_lock(self):
+        lock = MigrationLock(self.db, 'first', ttl=60)
+        self.assertTrue(lock.acquire())
+        self.assertFalse(MigrationLock(self.db, 'second').acquire())
+        registry = mock.MagicMock(db=self.db)
+        with mock.patch('openregistry.api.migration.load_plugins') as load_plugins:
+            self.assertFalse(run_migrations(registry))
+        self.assertFalse(load_plugins.called)
+
+        lock.release()
+        self.assertNotIn(MIGRATION_LOCK_DOC, self.db.docs)
+        with mock.patch('openregistry.api.migration.load_plugins') as load_plugins:
+            self.assertTrue(run_migrations(registry))
+        load_plugins.assert_called_once_with(registry, group='openregistry.api.migrations')
+        self.assertNotIn(MIGRATION_LOCK_DOC, self.db.docs)
+
+    def test_expired(self):
+        self.assertTrue(MigrationLock(self.db, 'first', ttl=60).save())
+        self.db.docs[MIGRATION_LOCK_DOC]['expires'] = time() - 1
+        lock = MigrationLock(self.db, 'second', ttl=60)
+        self.assertTrue(lock.acquire())
+        self.assertEqual(self.db.docs[MIGRATION_LOCK_DOC]['owner'], 'second')
+        lock.release()
+
+    def test_lock_lost(self):
+        steps = []
+
+        def migrate(registry, group):
+            steps.append('started')
+            # lock expired while migration was blocked and was taken over
+            self.db.docs[MIGRATION_LOCK_DOC].update(owner='second', expires=time() + 60)
+            sleep(0.1)
+            steps.append('finished')
+        registry = mock.MagicMock(db=self.db)
+        with mock.patch('openregistry.api.migration.load_plugins', migrate), \
+                mock.patch('openregistry.api.migration.gethostname', return_value='first'):
+            self.assertFalse(run_migrations(registry, lock_ttl=0.03))
+        self.assertEqual(steps, ['started'])
+        self.assertEqual(self.db.docs[MIGRATION_LOCK_DOC]['owner'], 'second')
+
+    def test_schema_state(self):
+        lock = MigrationLock(self.db, 'first', ttl=60)
+        self.assertTrue(lock.save())
+        state = SchemaState(self.db, 0.01)
+        self.addCleanup(state.watcher.kill)
+        self.assertTrue(state.pending)
+
+        request = Request.blank('/', method='POST')
+        request.registry = mock.MagicMock(schema_state=state)
+        with self.assertRaises(HTTPServiceUnavailable):
+            check_schema_pending(mock.MagicMock(request=request))
+        request.method = 'GET'
+        check_schema_pending(mock.MagicMock(request=request))
+
+        lock.release()
+        sleep(0.05)
+        self.assertFalse(state.pending)
+        request.method = 'POST'
+        check_schema_pending(mock.MagicMock(request=request))
+
+    def test_schema_state_external(self):
+        state = SchemaState(self.db, 0.01)
+        self.addCleanup(state.watcher.kill)
+        self.assertFalse(state.pending)
+        # migrate_api_data started after worker
+        self.assertTrue(MigrationLock(self.db, 'external', ttl=60).save())
+        sleep(0.05)
+        self.assertTrue(state.pending)
+
+    def test_schema_version(self):
+        # lock released, version of schema is not written yet
+        self.db.docs[SCHEMA_DOC]['version'] = SCHEMA_VERSION - 1
+        state = SchemaState(self.db, 0.01)
+        self.addCleanup(state.watcher.kill)
+        self.assertTrue(state.pending)
+        migrate_data(mock.MagicMock(db=self.db))
+        sleep(0.05)
+        self.assertFalse(state.pending)
+
+    def test_schema_state_migrate(self):
+        self.db.docs[SCHEMA_DOC]['version'] = SCHEMA_VERSION - 1
+        state = SchemaState(self.db, 0)
+        self.assertIsNone(state.watcher)
+        registry = mock.MagicMock(db=self.db)
+        with mock.patch('openregistry.api.migration.load_plugins'):
+            self.assertTrue(state.migrate(registry))
+        self.assertFalse(state.pending)
+        self.assertEqual(get_db_schema_version(self.db), SCHEMA_VERSION)
+
+
 def suite():
     suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(MigrationLockTest))
+    suite.addTest(unittest.makeSuite(MigrationRunnerTest))
     suite.addTest(unittest.makeSuite(MigrateTest))
     return suite
 
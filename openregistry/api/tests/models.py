@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 import unittest
 import mock
+from couchdb.http import ResourceConflict
 from datetime import datetime, timedelta
-from schematics.exceptions import ConversionError, ValidationError, ModelValidationError
+from iso8601 import parse_date
+from pytz import utc
+from schematics.exceptions import ConversionError, ValidationError, ModelValidationError, ModelConversionError
 
+from openregistry.api.constants import TZ
 from openregistry.api.utils import get_now
 
-from openregistry.api.models.roles import blacklist
+from openregistry.api.models.roles import blacklist, whitelist
 from openregistry.api.models.schematics_extender import (
     IsoDateTimeType, HashType)
 from openregistry.api.models.ocds import (
@@ -14,6 +18,19 @@ from openregistry.api.models.ocds import (
     Item, Location, Unit, Value, ItemClassification, Classification,
     Period, PeriodEndRequired, Document
 )
+from openregistry.api.models.schematics_extender import Model, ListType
+from openregistry.api.models.projection import projection_plan, project_document
+from openregistry.api.models.patching import (
+    patched_model, export_fields, validator_dependencies, depends
+)
+from openregistry.api.models.common import BaseResourceItem, revision_doc_id
+from openregistry.api.models.serializer import SERIALIZERS, EACH, document_paths
+from openregistry.api.traversal import Root
+from openregistry.api.utils import apply_data_patch
+from schematics.types import StringType
+from schematics.types.compound import ModelType, DictType, ListType as BaseListType
+from schematics.transforms import export_loop
+from schematics.types.serializable import serializable
 
 
 now = get_now()
@@ -45,6 +62,28 @@ class SchematicsExtenderTest(unittest.TestCase):
             with self.assertRaises(ConversionError):
                 dt.to_native(dt.to_primitive(date))
 
+    def test_IsoDateTimeType_cache(self):
+        dt = IsoDateTimeType()
+        for value in ['2017-01-01T12:00:00.123456+02:00', '2017-06-01T00:00:00-05:30',
+                      '2017-01-01T12:00:00+00:00', '2017-01-01T12:00:00Z', '2017-01-01T12:00:00.123',
+                      '2017-01-01T12:00:00', '2017-01-01']:
+            date = dt.to_native(value)
+            expected = parse_date(value, None)
+            if not expected.tzinfo:
+                expected = TZ.localize(expected)
+            self.assertEqual(date, expected)
+            self.assertEqual(date.isoformat(), expected.isoformat())
+            self.assertEqual(type(date.tzinfo), type(expected.tzinfo))
+            self.assertIs(dt.to_native(value), date)
+            self.assertEqual(dt.to_primitive(date), expected.isoformat())
+
+        with self.assertRaisesRegexp(ConversionError, u'Could not parse'):
+            dt.to_native('2017-02-30T12:00:00+02:00')
+
+        date = dt.to_native('2017-01-01T12:00:00+02:00')
+        self.assertEqual(dt.to_primitive(date), '2017-01-01T12:00:00+02:00')
+        self.assertEqual(dt.to_primitive(date.astimezone(utc)), '2017-01-01T10:00:00+00:00')
+
     def test_HashType_model(self):
         from uuid import uuid4
 
@@ -369,8 +408,359 @@ class DummyOCDSModelsTest(unittest.TestCase):
         self.assertEqual(organization2.serialize(), data)
 
 
+class DummyResource(Model):
+    class Options:
+        roles = {'view': blacklist('__parent__', 'owner_token')}
+
+    title = StringType()
+    status = StringType(default='draft')
+    owner_token = StringType()
+    items = ListType(ModelType(Item), default=list())
+    documents = ListType(ModelType(Document), default=list())
+    period = ModelType(Period)
+
+    @serializable
+    def numberOfItems(self):
+        return len(self.items)
+
+
+class ProjectionTest(unittest.TestCase):
+
+    def test_projection_plan(self):
+        plan = projection_plan(DummyResource, 'view', ['title', 'items', 'period', 'owner_token', 'unknown'])
+        self.assertEqual(plan.model, ())
+        self.assertEqual(plan.cost, {'title': 'raw', 'items': 'raw', 'period': 'raw',
+                                     'owner_token': 'hidden', 'unknown': 'hidden'})
+
+        plan = projection_plan(DummyResource, 'view', ['title', 'documents', 'numberOfItems'])
+        self.assertEqual(sorted(plan.model), ['documents', 'numberOfItems'])
+        self.assertEqual(plan.cost['title'], 'raw')
+        self.assertIs(plan, projection_plan(DummyResource, 'view', ['numberOfItems', 'documents', 'title']))
+
+    def test_project_document(self):
+        doc = {'title': u'title', 'status': 'active', 'owner_token': 'secret',
+               'items': [{'id': '1', 'description': u'item'}]}
+        resource = DummyResource(doc)
+
+        fields = ['title', 'status', 'items', 'owner_token', 'period']
+        plan = projection_plan(DummyResource, 'view', fields)
+        data = project_document(doc, plan)
+        self.assertEqual(data, dict([(i, j) for i, j in resource.serialize('view').items() if i in fields]))
+
+        del doc['status']  # default is applied by model only
+        self.assertIsNone(project_document(doc, plan))
+        plan = projection_plan(DummyResource, 'view', ['title', 'numberOfItems'])
+        self.assertIsNone(project_document(doc, plan))
+
+
+class DummyPatchResource(Model):
+    class Options:
+        roles = {'edit': blacklist('__parent__', 'owner')}
+
+    title = StringType(required=True)
+    owner = StringType()
+    startDate = IsoDateTimeType()
+    endDate = IsoDateTimeType()
+    items = ListType(ModelType(Item), default=list())
+
+    @depends('endDate')
+    def validate_startDate(self, data, value):
+        if value and data.get('endDate') and data.get('endDate') < value:
+            raise ValidationError(u"period should begin before its end")
+
+    def validate_owner(self, data, value):
+        if value == items_owner(data):
+            raise ValidationError(u"owner should differ from items owner")
+
+
+def items_owner(data):
+    return (data.get('items') or [None])[0] and data['items'][0].description
+
+
+class PatchingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = DummyPatchResource({
+            'title': u'title',
+            'owner': u'broker',
+            'startDate': now.isoformat(),
+            'endDate': (now + timedelta(1)).isoformat(),
+            'items': [{'id': '1', 'description': u'item'}, {'id': '2', 'description': u'item'}],
+        })
+
+    def full_patch(self, data, role):
+        initial_data = self.context.serialize()
+        m = DummyPatchResource(initial_data)
+        new_patch = apply_data_patch(initial_data, data)
+        if new_patch:
+            m.import_data(new_patch, partial=True, strict=True)
+        m.validate()
+        return m.to_patch(role)
+
+    def test_validator_dependencies(self):
+        dependencies = validator_dependencies(DummyPatchResource)
+        self.assertEqual(dependencies['startDate'], set(['startDate', 'endDate']))
+        # not declared, read through helper
+        self.assertEqual(dependencies['owner'], set(DummyPatchResource._fields))
+
+    def test_patch(self):
+        for data in [
+            {'title': u'new title'},
+            {'items': [{'description': u'changed'}]},
+            {'items': [{}, {}, {'id': '3', 'description': u'new'}]},
+            {'endDate': (now + timedelta(2)).isoformat(), 'owner': u'other'},
+        ]:
+            m, fields = patched_model(DummyPatchResource, self.context, data)
+            patch = export_fields(m, fields, 'edit')
+            self.assertEqual(sorted(patch), sorted(set(data) - set(['owner'])))
+            full = self.full_patch(data, 'edit')
+            for i in patch:
+                self.assertEqual(patch[i], full[i])
+            self.assertEqual(m.to_patch('edit'), full)
+        self.assertEqual(self.context.title, u'title')
+        self.assertEqual(len(self.context.items), 2)
+
+    def test_patch_errors(self):
+        with self.assertRaises(ModelValidationError) as ex:
+            patched_model(DummyPatchResource, self.context, {'endDate': (now - timedelta(1)).isoformat()})
+        self.assertEqual(ex.exception.messages, {'startDate': [u'period should begin before its end']})
+
+        with self.assertRaises(ModelValidationError) as ex:
+            patched_model(DummyPatchResource, self.context, {'items': [{'description': None}]})
+        self.assertIn('items', ex.exception.messages)
+
+        with self.assertRaises(ModelValidationError) as ex:
+            patched_model(DummyPatchResource, self.context, {'items': [{'description': u'broker'}]})
+        self.assertEqual(ex.exception.messages, {'owner': [u'owner should differ from items owner']})
+
+        with self.assertRaises(ModelConversionError) as ex:
+            patched_model(DummyPatchResource, self.context, {'rogue': 1})
+        self.assertEqual(ex.exception.messages, {'rogue': 'Rogue field'})
+
+
+class DummySerializedResource(DummyResource):
+    class Options:
+        roles = {
+            'view': blacklist('__parent__', 'owner_token'),
+            'listing': whitelist('title', 'numberOfItems'),
+            'active': lambda name, value: name == 'title' and value == u'hidden',
+        }
+
+    tags = BaseListType(StringType(), default=list())
+    extra = DictType(ModelType(Period))
+    nested = BaseListType(BaseListType(ModelType(Value)))
+
+
+class SerializerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = DummySerializedResource({
+            'title': u'title',
+            'owner_token': 'secret',
+            'items': [{'id': '1', 'description': u'item'}, {'id': '2'}],
+            'documents': [{'title': u'doc', 'url': u'http://localhost/doc', 'format': u'text/plain'}],
+            'period': {'startDate': now.isoformat()},
+            'tags': [u'a', u'b'],
+            'extra': {'first': {'endDate': now.isoformat()}, 'empty': {}},
+            'nested': [[{'amount': 1}], []],
+        })
+
+    def assertSameExport(self, resource, role):
+        field_converter = lambda field, value: field.to_primitive(value)
+        self.assertEqual(resource.to_patch(role),
+                         export_loop(type(resource), resource, field_converter, role=role, print_none=True))
+        self.assertEqual(resource.to_primitive(role),
+                         export_loop(type(resource), resource, field_converter, role=role))
+
+    def test_export(self):
+        for role in [None, 'view', 'listing', 'active', 'embedded']:
+            self.assertSameExport(self.resource, role)
+        self.assertIn((DummySerializedResource, 'view', False, True), SERIALIZERS)
+
+        self.resource.title = u'hidden'
+        self.assertNotIn('title', self.resource.serialize('active'))
+        self.assertSameExport(self.resource, 'active')
+        self.assertSameExport(DummySerializedResource(), 'view')
+
+    def test_unknown_role(self):
+        with self.assertRaises(ValueError):
+            self.resource.serialize('unknown')
+        with self.assertRaises(ValueError):
+            self.resource.to_patch('unknown')
+
+    def test_document_paths(self):
+        self.assertEqual(sorted(document_paths(DummySerializedResource)), [('documents', EACH), ('extra',)])
+        self.assertEqual(document_paths(Document), ((),))
+        self.assertEqual(sorted(document_paths(DummySerializedResource, ['id', 'title', 'documents'])),
+                         [('documents', EACH), ('id',)])
+
+
+class DummyRevisionsResource(BaseResourceItem):
+    class Options:
+        roles = {
+            'default': blacklist('__parent__'),
+            'plain': blacklist('_attachments', '__parent__'),
+            'view': blacklist('_attachments', '__parent__', 'owner_token', 'revisions'),
+        }
+
+    title = StringType()
+
+
+class DummyRevisionsDB(object):
+
+    def __init__(self):
+        self.docs = {}
+
+    def save(self, doc):
+        doc['_rev'] = '{}-rev'.format(int(doc.get('_rev', '0-rev').split('-')[0]) + 1)
+        self.docs[doc['_id']] = doc
+        return doc['_id'], doc['_rev']
+
+    def get(self, doc_id):
+        return self.docs.get(doc_id)
+
+    def update(self, docs):
+        results = []
+        for doc in docs:
+            if doc['_id'] in self.docs:
+                results.append((False, doc['_id'], ResourceConflict()))
+            else:
+                self.docs[doc['_id']] = dict(doc, _rev='1-rev')
+                results.append((True, doc['_id'], '1-rev'))
+        return results
+
+    def view(self, name, startkey, endkey, include_docs):
+        return [mock.MagicMock(id=i, doc=self.docs[i])
+                for i in sorted(self.docs) if startkey <= i <= endkey]
+
+
+class RevisionsOffloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = DummyRevisionsDB()
+        self.revisions_db = DummyRevisionsDB()
+        request = mock.MagicMock()
+        request.registry.db = self.db
+        request.registry.revisions_db = self.revisions_db
+        request.registry.revisions_offload = True
+        self.root = Root(request)
+
+    def get_resource(self):
+        resource = DummyRevisionsResource(dict(self.db.docs['resource']))
+        resource.__parent__ = self.root
+        return resource
+
+    def save(self, resource, title):
+        resource.title = title
+        resource.revisions.append(type(resource).revisions.model_class({
+            'author': u'broker', 'changes': [{'op': 'replace', 'path': '/title', 'value': title}],
+            'rev': resource.rev
+        }))
+        resource.store(self.db)
+
+    def test_offload(self):
+        resource = DummyRevisionsResource({'_id': 'resource', 'title': u'0'})
+        resource.__parent__ = self.root
+        self.save(resource, u'1')
+        self.assertEqual(len(self.db.docs['resource']['revisions']), 1)
+        self.assertEqual(len(self.db.docs), 1)
+
+        for title in [u'2', u'3']:
+            self.save(self.get_resource(), title)
+            self.assertEqual(len(self.db.docs['resource']['revisions']), 1)
+        self.assertEqual(len(self.db.docs), 1)
+        self.assertEqual(len(self.revisions_db.docs), 2)
+        revision = self.revisions_db.docs[sorted(self.revisions_db.docs)[0]]
+        self.assertEqual(revision['doc_type'], 'Revision')
+        self.assertEqual(revision['resource_id'], 'resource')
+
+        resource = self.get_resource()
+        self.assertNotIn('revisions', resource.serialize('view'))
+        revisions = resource.serialize('plain')['revisions']
+        self.assertEqual([i['changes'][0]['value'] for i in revisions], [u'1', u'2', u'3'])
+        self.assertEqual(len(resource.revisions), 1)
+
+    def test_failed_store(self):
+        resource = DummyRevisionsResource({'_id': 'resource', 'title': u'0'})
+        resource.__parent__ = self.root
+        self.save(resource, u'1')
+        self.save(resource, u'2')
+
+        resource = self.get_resource()
+        with mock.patch.object(self.db, 'save', side_effect=Exception):
+            with self.assertRaises(Exception):
+                self.save(resource, u'3')
+        self.assertEqual(len(resource.revisions), 2)
+        self.assertEqual(len(self.db.docs['resource']['revisions']), 1)
+        # offloaded revisions still stored inline are not duplicated
+        revisions = self.get_resource().serialize('plain')['revisions']
+        self.assertEqual([i['changes'][0]['value'] for i in revisions], [u'1', u'2'])
+
+    def test_failed_offload(self):
+        resource = DummyRevisionsResource({'_id': 'resource', 'title': u'0'})
+        resource.__parent__ = self.root
+        self.save(resource, u'1')
+        resource = self.get_resource()
+        with mock.patch.object(self.revisions_db, 'update', return_value=[(False, 'id', Exception('Bad request'))]):
+            self.save(resource, u'2')
+        self.assertEqual(len(self.db.docs['resource']['revisions']), 2)
+        self.assertEqual(self.revisions_db.docs, {})
+
+        # already offloaded revision with other content is kept inline
+        revision = self.get_resource().revisions[0]
+        revision_id = revision_doc_id('resource', revision)
+        self.revisions_db.docs[revision_id] = dict(
+            revision.to_primitive(), _id=revision_id, _rev='1-rev', changes=[{'value': u'other'}])
+        self.save(self.get_resource(), u'3')
+        self.assertEqual(len(self.db.docs['resource']['revisions']), 3)
+        # and is not replaced by the other document in exports
+        revisions = self.get_resource().serialize('plain')['revisions']
+        self.assertEqual([i['changes'][0]['value'] for i in revisions], [u'other', u'1', u'2', u'3'])
+
+        del self.revisions_db.docs[revision_id]
+        self.save(self.get_resource(), u'4')
+        self.assertEqual(len(self.db.docs['resource']['revisions']), 1)
+        revisions = self.get_resource().serialize('plain')['revisions']
+        self.assertEqual([i['changes'][0]['value'] for i in revisions], [u'1', u'2', u'3', u'4'])
+
+    def test_disabled(self):
+        self.root.request.registry.revisions_offload = False
+        resource = DummyRevisionsResource({'_id': 'resource', 'title': u'0'})
+        resource.__parent__ = self.root
+        for title in [u'1', u'2', u'3']:
+            self.save(resource, title)
+        self.assertEqual(len(self.db.docs), 1)
+        self.assertEqual(len(self.get_resource().serialize('plain')['revisions']), 3)
+
+    def test_revision_doc_id(self):
+        revision = BaseResourceItem.revisions.model_class({'date': '2017-01-01T12:00:00.000001+02:00'})
+        self.assertTrue(revision_doc_id('resource', revision).startswith(
+            u'resource_revision_20170101100000000001_0000000000_'))
+        other = BaseResourceItem.revisions.model_class({'date': '2017-01-01T12:00:00.000001+02:00', 'author': u'a'})
+        self.assertNotEqual(revision_doc_id('resource', revision), revision_doc_id('resource', other))
+
+    def test_same_date(self):
+        resource = DummyRevisionsResource({'_id': 'resource', 'title': u'0'})
+        resource.__parent__ = self.root
+        for title in [u'1', u'2']:
+            resource.title = title
+            resource.revisions.append(type(resource).revisions.model_class({
+                'date': now.isoformat(), 'changes': [{'op': 'replace', 'path': '/title', 'value': title}],
+                'rev': resource.rev
+            }))
+            resource.store(self.db)
+        self.save(resource, u'3')
+        self.assertEqual(len(self.revisions_db.docs), 2)
+        revisions = self.get_resource().serialize('plain')['revisions']
+        self.assertEqual([i['changes'][0]['value'] for i in revisions], [u'1', u'2', u'3'])
+
+
 def suite():
     suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SerializerTest))
+    suite.addTest(unittest.makeSuite(RevisionsOffloadTest))
+    suite.addTest(unittest.makeSuite(ProjectionTest))
+    suite.addTest(unittest.makeSuite(PatchingTest))
     suite.addTest(unittest.makeSuite(DummyOCDSModelsTest))
     suite.addTest(unittest.makeSuite(SchematicsExtenderTest))
     return suite
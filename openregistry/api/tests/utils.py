@@ -0,0 +1,937 @@
+# -*- coding: utf-8 -*-
+import logging
+import unittest
+import mock
+from json import dumps, loads
+from uuid import uuid4
+from copy import deepcopy
+from itertools import islice
+from base64 import b64encode
+from shutil import rmtree
+from tempfile import mkdtemp
+from urllib import quote
+import os
+from couchdb.client import Row
+from jsonpatch import apply_patch
+from cornice.errors import Errors
+from libnacl.sign import Signer
+from schematics.types import StringType
+from schematics.types.compound import ModelType
+from pyramid import testing
+from pyramid.events import BeforeRender
+from pyramid.httpexceptions import HTTPError
+from pyramid.request import Request
+from time import time as ttime
+
+from openregistry.api.constants import ROUTE_PREFIX
+from openregistry.api.events import ErrorDesctiptorEvent
+from openregistry.api.subscribers import add_logging_context, beforerender
+from openregistry.api.models.ocds import Document
+from openregistry.api.models.roles import blacklist
+from openregistry.api.models.schematics_extender import Model, ListType
+from openregistry.api.models.serializer import EACH
+from openregistry.api.traversal import Root
+from openregistry.api.validation import validate_document_data, validate_documents_data
+from openregistry.api.utils import (
+    encode_cursor, decode_cursor, cursor_startkey_docid, APIResourceListing,
+    get_revision_changes, apply_data_patch, LRUCache, TTLCache, request_json_body,
+    LoggingContext, update_logging_context, context_unpack, error_handler, ErrorLogLimiter,
+    fix_url, fix_url_paths, serialize_document_url, DocserviceSigner, generate_docservice_url,
+    Keyring, check_document, check_documents, entry_points, load_plugins, StartupProfile,
+    StalenessPolicy, listing_views, listing_fields_views, context_document_paths, batched_rows
+)
+
+
+class ListingCursorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.secret = uuid4().hex
+        self.docid = uuid4().hex
+        self.key = u'2017-01-01T00:00:00.000000+02:00'
+
+    def test_cursor(self):
+        cursor = encode_cursor(self.secret, 'db', self.key, self.docid)
+        self.assertEqual(decode_cursor(self.secret, 'db', cursor), (self.key, self.docid))
+
+        for key in [12, [u'active', self.key], u'a;b', None]:
+            cursor = encode_cursor(self.secret, 'db', key, self.docid)
+            self.assertEqual(decode_cursor(self.secret, 'db', cursor), (key, self.docid))
+        self.assertIsInstance(decode_cursor(self.secret, 'db', encode_cursor(self.secret, 'db', 12, self.docid))[0], int)
+
+    def test_cursor_invalid(self):
+        cursor = encode_cursor(self.secret, 'db', self.key, self.docid)
+        self.assertIsNone(decode_cursor(self.secret, 'other_db', cursor))
+        self.assertIsNone(decode_cursor(uuid4().hex, 'db', cursor))
+        self.assertIsNone(decode_cursor(self.secret, 'db', self.key))
+        self.assertIsNone(decode_cursor(self.secret, 'db', cursor.replace(self.docid, uuid4().hex)))
+        self.assertIsNone(decode_cursor(self.secret, 'db', u'a;b;c'))
+        self.assertIsNone(decode_cursor(self.secret, 'db', u'a;b;\xe9'))
+        self.assertIsNone(decode_cursor(self.secret, 'db', u'\xe9;\xe9;\xe9' * 2))
+
+    def test_cursor_startkey_docid(self):
+        docids = sorted(uuid4().hex for _ in xrange(100))
+        for i, docid in enumerate(docids[1:-1], 1):
+            startkey_docid = cursor_startkey_docid(docid)
+            self.assertTrue(docid < startkey_docid.encode('utf-8') < docids[i + 1])
+            startkey_docid = cursor_startkey_docid(docid, descending=True)
+            self.assertTrue(docids[i - 1] < startkey_docid.encode('utf-8') < docid)
+        self.assertEqual(cursor_startkey_docid(u'ab\x00', descending=True), u'ab')
+
+
+class DummyListingView(object):
+    """ View of rows ordered by (key, docid) as CouchDB does """
+    design = 'assets'
+    name = 'by_dateModified'
+    defaults = {}
+
+    def __init__(self, rows):
+        self.rows = sorted(rows, key=lambda i: (i.key, i.id))
+        self.calls = []
+
+    def __call__(self, db, limit=None, startkey=None, startkey_docid=None, descending=False, skip=0, **options):
+        self.calls.append(dict(options, limit=limit, startkey=startkey, startkey_docid=startkey_docid, skip=skip))
+        if descending:
+            rows = [i for i in reversed(self.rows)
+                    if (i.key, i.id) <= (startkey, u'\ufff0' if startkey_docid is None else startkey_docid)]
+        else:
+            rows = [i for i in self.rows if (i.key, i.id) >= (startkey, startkey_docid or u'')]
+        return rows[skip:skip + limit]
+
+
+class ListingPagesTest(unittest.TestCase):
+
+    def setUp(self):
+        # duplicate keys, e.g. documents modified at once
+        keys = [u'2017-01-01', u'2017-01-02', u'2017-01-02', u'2017-01-02', u'2017-01-03']
+        self.view = DummyListingView([Row(id=uuid4().hex, key=i, value={}) for i in keys])
+        self.ids = [i.id for i in self.view.rows]
+
+        class AssetsResource(APIResourceListing):
+            FEED = {}
+            VIEW_MAP = {u'': self.view}
+            CHANGES_VIEW_MAP = {}
+            object_name_for_listing = 'Assets'
+
+        self.resource = AssetsResource
+        self.request = mock.MagicMock(params={})
+        self.request.registry.couchdb_server.uuid = uuid4().hex
+        self.request.registry.db.name = 'db'
+        self.request.registry.listing_stale = StalenessPolicy('ok')
+        self.request.registry.listing_stream = False
+        self.request.registry.fields_views = None
+
+    def get(self, **params):
+        self.request.params = params
+        return self.resource(self.request, None).get()
+
+    def pages(self, **params):
+        ids = []
+        for i in range(10):
+            data = self.get(**params)
+            if not data['data']:
+                return ids
+            ids.extend([j['id'] for j in data['data']])
+            params['offset'] = data['next_page']['offset']
+
+    def test_pages(self):
+        self.assertEqual(self.pages(limit='2'), self.ids)
+        self.assertEqual(self.pages(limit='2', descending='1'), self.ids[::-1])
+
+    def test_prev_page(self):
+        first = self.get(limit='2')
+        second = self.get(limit='2', offset=first['next_page']['offset'])
+        self.assertEqual([i['id'] for i in second['data']], self.ids[2:4])
+        prev = self.get(limit='2', descending='1', offset=second['prev_page']['offset'])
+        self.assertEqual([i['id'] for i in prev['data']], self.ids[1::-1])
+
+    def test_stream_pages(self):
+        self.request.registry.listing_stream = True
+        self.request.override_renderer = None
+        self.request.application_url = 'http://localhost'
+        self.request.route_path.return_value = '/assets'
+        self.request.route_url.return_value = 'http://localhost/assets'
+        ids = []
+        params = {'limit': '2'}
+        for i in range(4):
+            self.request.params = params
+            data = loads(self.resource(self.request, None).get().body)
+            ids.extend([j['id'] for j in data['data']])
+            params = dict(params, offset=data['next_page']['offset'])
+        self.assertEqual(ids, self.ids)
+        self.assertEqual(max([i['limit'] for i in self.view.calls]), 2)
+
+    def test_legacy_offset(self):
+        data = self.get(limit='2', offset=u'2017-01-01')
+        # row of offset was the last one of previous page
+        self.assertEqual([i['id'] for i in data['data']], self.ids[1:3])
+        self.assertEqual(self.view.calls[-1]['limit'], 3)
+        data = self.get(limit='2', offset=u'2017-01-01T12:00:00')
+        self.assertEqual([i['id'] for i in data['data']], self.ids[1:3])
+        self.assertEqual(self.pages(limit='2', offset=u'2017-01-01'), self.ids[1:])
+
+
+class ListingStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        request = mock.MagicMock()
+        request.application_url = 'http://localhost'
+        request.route_path.return_value = '/assets'
+        request.route_url.return_value = 'http://localhost/assets'
+        request.registry.couchdb_server.uuid = uuid4().hex
+        request.registry.db.name = 'db'
+        self.listing = APIResourceListing(request, None)
+        self.listing.object_name_for_listing = 'Assets'
+
+    def test_stream_listing(self):
+        rows = [
+            Row(id=uuid4().hex, key=u'2017-01-01T00:00:0{}'.format(i), value={})
+            for i in range(5)
+        ]
+        url = 'http://localhost/get/{}?download=1'.format(uuid4().hex)
+        serialize = lambda x: {'id': x.id, 'documents': [{'format': 'text/plain', 'url': url}]}
+        data = loads(''.join(self.listing.stream_listing(iter(rows), serialize, {}, {}, '', False)))
+
+        self.assertEqual([i['id'] for i in data['data']], [i.id for i in rows])
+        self.assertTrue(data['data'][0]['documents'][0]['url'].startswith('http://localhost' + ROUTE_PREFIX))
+        self.assertEqual(decode_cursor(self.listing.server.uuid, 'db', data['next_page']['offset']),
+                         (rows[-1].key, rows[-1].id))
+        self.assertNotIn('prev_page', data)
+
+    def test_stream_listing_paths(self):
+        rows = [Row(id=uuid4().hex, key=u'2017-01-01T00:00:00', value={})]
+        url = 'http://docs/api/2.3/assets/{}/documents/1?download=1'.format(uuid4().hex)
+        document = {'format': 'text/plain', 'url': url}
+        serialize = lambda x: {'id': x.id, 'documents': [dict(document)], 'other': dict(document)}
+        data = loads(''.join(self.listing.stream_listing(iter(rows), serialize, {}, {}, '', False,
+                                                         (('documents', EACH),))))
+        self.assertEqual(data['data'][0]['documents'][0]['url'],
+                         'http://localhost' + ROUTE_PREFIX + url[len('http://docs/api/2.3'):])
+        self.assertEqual(data['data'][0]['other']['url'], url)
+
+    def test_batched_rows(self):
+        view = DummyListingView([Row(id=uuid4().hex, key=u'2017-01-0{}'.format(i % 3), value={}) for i in range(7)])
+        rows = list(batched_rows(view, None, 2, limit=5, startkey=u''))
+        self.assertEqual(rows, view.rows[:5])
+        self.assertEqual([i['limit'] for i in view.calls], [2, 2, 1])
+        self.assertEqual([i['skip'] for i in view.calls], [0, 1, 1])
+
+        view.calls = []
+        rows = list(batched_rows(view, None, 2, limit=5, startkey=u'9', descending=True))
+        self.assertEqual(rows, view.rows[:1:-1])
+        self.assertEqual(list(batched_rows(view, None, 4, limit=10, startkey=u'')), view.rows)
+
+    def test_stream_listing_failed(self):
+        def rows():
+            for i in range(150):
+                yield Row(id=uuid4().hex, key=u'2017-01-01', value={})
+            raise ValueError('connection lost')
+        serialize = lambda x: {'id': x.id}
+        with self.assertRaises(ValueError):
+            next(self.listing.stream_listing(islice(rows(), 150, None), serialize, {}, {}, '', False))
+
+        data = loads(''.join(self.listing.stream_listing(rows(), serialize, {}, {}, '', False)))
+        self.assertEqual(len(data['data']), 150)
+        self.assertEqual(data['status'], 'error')
+        self.assertNotIn('next_page', data)
+
+    def test_stream_listing_empty(self):
+        data = loads(''.join(self.listing.stream_listing(iter([]), None, {}, {}, 'offset', True)))
+        self.assertEqual(data['data'], [])
+        self.assertEqual(data['next_page']['offset'], 'offset')
+        self.assertEqual(data['prev_page']['offset'], 'offset')
+
+
+class StalenessPolicyTest(unittest.TestCase):
+
+    def test_get(self):
+        policy = StalenessPolicy('update_after', {'changes': 'fresh', 'dateModified.test': 'ok'})
+        self.assertEqual(policy.get('dateModified'), 'update_after')
+        self.assertEqual(policy.get('dateModified', 'test'), 'ok')
+        self.assertEqual(policy.get('dateModified', '_all_'), 'update_after')
+        self.assertIsNone(policy.get('changes'))
+        self.assertIsNone(policy.get('changes', 'test'))
+        self.assertIsNone(StalenessPolicy('fresh').get('dateModified'))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            StalenessPolicy('stale')
+        with self.assertRaises(ValueError):
+            StalenessPolicy('ok', {'changes': 'update'})
+
+    def test_update_after_override(self):
+        view = mock.MagicMock(return_value=[])
+
+        class AssetsResource(APIResourceListing):
+            FEED = {}
+            VIEW_MAP = {u'': view}
+            CHANGES_VIEW_MAP = {}
+            object_name_for_listing = 'Assets'
+
+            def __init__(self, request, context):
+                super(AssetsResource, self).__init__(request, context)
+                self.update_after = False
+
+        request = mock.MagicMock(params={})
+        request.registry.update_after = True
+        request.registry.listing_stale = StalenessPolicy('ok')
+        request.registry.listing_stream = False
+        AssetsResource(request, None).get()
+        self.assertNotIn('stale', view.call_args[1])
+
+        listing = AssetsResource(request, None)
+        listing.update_after = True
+        listing.get()
+        self.assertEqual(view.call_args[1]['stale'], 'ok')
+
+    def test_listing_views(self):
+        views = [mock.Mock(design='assets'), mock.Mock(design='assets_changes'), mock.Mock(design='assets')]
+
+        class AssetsResource(APIResourceListing):
+            VIEW_MAP = {u'': views[0], u'test': views[2]}
+            CHANGES_VIEW_MAP = {u'': views[1]}
+
+        class TestAssetsResource(AssetsResource):
+            VIEW_MAP = {u'': views[0]}
+
+        found = listing_views()
+        self.assertEqual([i for i in found if i in views], [views[0], views[2], views[1]])
+
+    def test_listing_fields_views(self):
+        views = [mock.Mock(design='assets'), mock.Mock(design='assets_changes')]
+
+        class ListedAsset(Model):
+            title = StringType()
+            status = StringType(default='active')
+            documents = ListType(ModelType(Document), default=list())
+
+        class AssetsResource(APIResourceListing):
+            VIEW_MAP = {u'': views[0]}
+            CHANGES_VIEW_MAP = {u'': views[1]}
+            listing_model = ListedAsset
+
+        found = listing_fields_views([['title', 'status'], ['id', 'title'], ['title', 'documents'], ['id']])
+        self.assertEqual([i for i in found if i[0] in views], [
+            (views[0], ['status', 'title'], ['status']),
+            (views[1], ['status', 'title'], ['status']),
+            (views[0], ['title'], []),
+            (views[1], ['title'], []),
+        ])
+
+
+class FixURLTest(unittest.TestCase):
+
+    def data(self):
+        return {
+            'id': uuid4().hex,
+            'documents': [
+                {'format': 'text/plain', 'url': 'http://docs/api/2.3/assets/1/documents/2?download=3'},
+                {'format': 'text/plain', 'url': '/assets/1/documents/4?download=5'},
+                {'format': 'text/plain', 'url': 'http://docs/get/6?Signature=7'},
+            ],
+            'items': [{'documents': [{'format': 'text/plain', 'url': 'http://docs/api/2.3/assets/1/items/8?download=9'}]}],
+            'nested': {'url': 'http://docs/api/2.3/assets/1/documents/2?download=3'},
+        }
+
+    def test_fix_url(self):
+        data = self.data()
+        fix_url([data], 'http://localhost')
+        self.assertEqual([i['url'] for i in data['documents']], [
+            'http://localhost' + ROUTE_PREFIX + '/assets/1/documents/2?download=3',
+            'http://localhost' + ROUTE_PREFIX + '/assets/1/documents/4?download=5',
+            'http://docs/get/6?Signature=7',
+        ])
+        self.assertEqual(data['items'][0]['documents'][0]['url'],
+                         'http://localhost' + ROUTE_PREFIX + '/assets/1/items/8?download=9')
+        self.assertEqual(data['nested'], self.data()['nested'])
+
+    def test_fix_url_paths(self):
+        data = self.data()
+        expected = deepcopy(data)
+        fix_url(expected, 'http://localhost')
+        fix_url_paths([data], [(EACH, 'documents', EACH), (EACH, 'items', EACH, 'documents'), (EACH, 'missing')],
+                      'http://localhost')
+        self.assertEqual(data, expected)
+
+        data = self.data()
+        fix_url_paths(data, [('documents', EACH)], 'http://localhost')
+        self.assertEqual(data['items'], self.data()['items'])
+
+
+class DummyDocumentsResource(Model):
+    class Options:
+        roles = {
+            'default': blacklist('__parent__'),
+            'draft': blacklist('__parent__', 'documents'),
+            'active': blacklist('__parent__'),
+        }
+
+    id = StringType()
+    status = StringType()
+    documents = ListType(ModelType(Document), default=list())
+
+
+class DocumentURLTest(unittest.TestCase):
+
+    def setUp(self):
+        self.request = Request.blank('/')
+        self.config = testing.setUp(request=self.request)
+        self.request.registry = self.config.registry
+        self.request.registry.docservice_url = 'http://docs'
+        self.request.registry.docservice_key = Signer('0' * 32)
+        self.request.registry.db = None
+        self.resource_id = uuid4().hex
+        self.resource = DummyDocumentsResource({
+            'id': self.resource_id,
+            'status': 'active',
+            'documents': [{
+                'title': u'document',
+                'format': u'text/plain',
+                'url': 'http://localhost/api/2.3/resources/{}/documents/{}?download={}'.format(
+                    self.resource_id, uuid4().hex, key),
+            } for key in [uuid4().hex, uuid4().hex]],
+        })
+        self.resource.__parent__ = Root(self.request)
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_signed(self):
+        document = self.resource.documents[0]
+        path, key = document.url.split('?download=')
+        url = serialize_document_url(document)
+        self.assertTrue(url.startswith('http://docs/get/{}?'.format(key)))
+        self.assertIn('Prefix={}%2F{}'.format(self.resource_id, path.split('/')[-1]), url)
+
+        document.hash = 'md5:' + '0' * 32
+        self.assertNotIn('Prefix', serialize_document_url(document))
+        self.assertEqual(len(self.request.document_owners), 1)
+
+    def test_role(self):
+        self.resource.status = 'draft'
+        role = mock.MagicMock(return_value=True)
+        with mock.patch.dict(DummyDocumentsResource._options.roles, {'draft': role}):
+            self.assertEqual([serialize_document_url(i) for i in self.resource.documents],
+                             [i.url for i in self.resource.documents])
+        role.assert_called_once_with('documents', [])
+
+        self.resource.status = 'active'
+        self.assertTrue(serialize_document_url(self.resource.documents[0]).startswith('http://docs/get/'))
+
+    def test_signature_cache(self):
+        signer = DocserviceSigner(self.request.registry.docservice_key, 10)
+        self.request.registry.docservice_signer = signer
+        with mock.patch.object(signer, 'sign', wraps=signer.sign) as sign:
+            data = self.resource.serialize()
+            self.assertEqual(sign.call_count, 2)
+            self.assertEqual(self.resource.serialize(), data)
+            self.assertEqual(sign.call_count, 2)
+            self.assertEqual(len(signer.cache), 2)
+
+            self.assertEqual(signer.signatures([('1', None), ('2', 'a/b'), ('1', None)]),
+                             [signer.sign('1'), signer.sign('a/b/2'), signer.sign('1')])
+            sign.reset_mock()
+            generate_docservice_url(self.request, '1')
+            generate_docservice_url(self.request, '1')
+            self.assertEqual(sign.call_count, 2)
+        self.assertIn('KeyID={}'.format(self.request.registry.docservice_key.hex_vk()[:8]),
+                      data['documents'][0]['url'])
+
+    def test_context_document_paths(self):
+        self.request.context = self.resource
+        data = {'id': self.resource_id, 'documents': [{'format': u'text/plain', 'url': '/a?download=1'}]}
+        self.assertEqual(context_document_paths(self.request, data), (('documents', EACH),))
+        self.assertIsNone(context_document_paths(self.request, dict(data, id=uuid4().hex)))
+        self.assertIsNone(context_document_paths(self.request, [data]))
+
+        with mock.patch('openregistry.api.subscribers.fix_url') as fix:
+            beforerender(BeforeRender({'request': self.request}, {'data': data}))
+        self.assertFalse(fix.called)  # item is not walked as a whole
+        self.assertEqual(data['documents'][0]['url'], self.request.application_url + ROUTE_PREFIX + '/a?download=1')
+
+        del self.request.context
+        with mock.patch('openregistry.api.subscribers.fix_url') as fix:
+            beforerender(BeforeRender({'request': self.request}, {'data': data}))
+        fix.assert_called_once_with(data, self.request.application_url)
+
+    def test_no_docservice(self):
+        self.request.registry.docservice_url = None
+        document = self.resource.documents[0]
+        self.assertEqual(serialize_document_url(document), document.url)
+
+
+class KeyringTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key = Signer('1' * 32)
+        self.directory = mkdtemp()
+        self.path = os.path.join(self.directory, 'dockeys')
+        self.request = Request.blank('/')
+        self.request.registry = mock.MagicMock()
+        self.request.registry.docservice_url = 'http://docs'
+        self.request.registry.keyring = Keyring([Signer('0' * 32).hex_vk()], self.path)
+        self.request.errors = Errors()
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def document(self, key=None, hash='0' * 32):
+        key = key or self.key
+        doc_id = uuid4().hex
+        signature = quote(b64encode(key.signature('{}\0{}'.format(doc_id, hash))))
+        return Document({
+            'title': u'document',
+            'format': u'text/plain',
+            'hash': 'md5:' + hash,
+            'url': 'http://docs/get/{}?Signature={}&KeyID={}'.format(doc_id, signature, key.hex_vk()[:8]),
+        })
+
+    def write_keys(self, *keys):
+        with open(self.path, 'w') as keys_file:
+            keys_file.write('\n'.join([i.hex_vk() for i in keys]))
+        os.utime(self.path, (ttime() + len(keys), ttime() + len(keys)))
+
+    def test_verify_cache(self):
+        keyring = self.request.registry.keyring
+        keyring.rotate([self.key.hex_vk()])
+        document = self.document()
+        with mock.patch.object(keyring.verifiers[self.key.hex_vk()[:8]], 'verify',
+                               wraps=keyring.verifiers[self.key.hex_vk()[:8]].verify) as verify:
+            check_document(self.request, document, 'body')
+            check_documents(self.request, [document, document], 'body')
+            self.assertEqual(verify.call_count, 1)
+
+        document.hash = 'md5:' + '1' * 32
+        with self.assertRaises(HTTPError):
+            check_document(self.request, document, 'body')
+        self.assertEqual(self.request.errors, [
+            {'location': 'body', 'name': 'url', 'description': 'Document url invalid.'}])
+
+    def test_check_documents(self):
+        self.request.registry.keyring.rotate([self.key.hex_vk()])
+        foreign = self.document()
+        foreign.url = foreign.url.replace('http://docs', 'http://other')
+        with self.assertRaises(HTTPError):
+            check_documents(self.request, [self.document(), self.document(Signer('2' * 32)), foreign], 'body')
+        self.assertEqual([i['description'] for i in self.request.errors], [
+            'Document url expired.', 'Can add document only from document service.'])
+        self.assertEqual(self.request.errors.status, 403)
+
+    def documents_request(self, documents):
+        registry, self.request = self.request.registry, Request.blank('/')
+        self.request.registry = registry
+        self.request.errors = Errors()
+        self.request.registry.json_loads = None
+        self.request.method = 'POST'
+        self.request.content_type = 'application/json'
+        self.request.body = dumps({'data': [i.serialize() for i in documents]})
+        self.request.context = DummyDocumentsResource({'documents': []})
+        self.request.validated = {}
+        self.request.matched_route = mock.Mock()
+        self.request.matched_route.name = 'collection_Dummy Documents'
+
+    @mock.patch('openregistry.api.validation.update_document_url', side_effect=lambda r, d, *a: d)
+    def test_validate_documents_data(self, update_document_url):
+        self.request.registry.keyring.rotate([self.key.hex_vk()])
+        self.documents_request([self.document(), self.document()])
+        with mock.patch('openregistry.api.validation.check_documents', wraps=check_documents) as check:
+            validate_documents_data(self.request, error_handler)
+        self.assertEqual(check.call_count, 1)
+        self.assertEqual(len(check.call_args[0][1]), 2)
+        documents = self.request.validated['new_documents']
+        self.assertEqual([i.documentOf for i in documents], ['dummydocumentsresource'] * 2)
+        self.assertEqual(len(self.request.validated['data']), 2)
+
+        self.documents_request([self.document(Signer('2' * 32)), self.document(), self.document(Signer('3' * 32))])
+        with self.assertRaises(HTTPError):
+            validate_documents_data(self.request, error_handler)
+        self.assertEqual([i['description'] for i in self.request.errors], ['Document url expired.'] * 2)
+
+    @mock.patch('openregistry.api.validation.update_document_url', side_effect=lambda r, d, *a: d)
+    def test_validate_document_data(self, update_document_url):
+        self.request.registry.keyring.rotate([self.key.hex_vk()])
+        self.documents_request([])
+        self.request.body = dumps({'data': self.document().serialize()})
+        with mock.patch('openregistry.api.validation.check_documents', wraps=check_documents) as check:
+            validate_document_data(self.request, error_handler)
+        check.assert_called_once_with(self.request, [self.request.validated['document']], 'body')
+
+    def test_rotation(self):
+        keyring = self.request.registry.keyring
+        self.assertEqual(len(keyring.verifiers), 1)
+        document = self.document()
+        self.write_keys(self.key)
+        self.assertTrue(keyring.reload())
+        self.assertFalse(keyring.reload())
+        self.assertIn(self.key.hex_vk()[:8], keyring)
+        check_document(self.request, document, 'body')
+
+        self.write_keys(Signer('2' * 32), Signer('3' * 32))
+        self.assertTrue(keyring.reload())
+        self.assertEqual(len(keyring.verifiers), 3)
+        self.assertNotIn(self.key.hex_vk()[:8], keyring)
+        self.assertEqual(len(keyring.verified), 0)
+        with self.assertRaises(HTTPError):
+            check_document(self.request, document, 'body')
+
+    def test_invalid_file(self):
+        keyring = self.request.registry.keyring
+        self.write_keys(self.key)
+        self.assertTrue(keyring.reload())
+        document = self.document()
+
+        os.remove(self.path)
+        self.assertFalse(keyring.reload())
+        self.write_keys()
+        self.assertFalse(keyring.reload())
+        with open(self.path, 'w') as keys_file:
+            keys_file.write(self.key.hex_vk()[:10])  # partially written
+        self.assertFalse(keyring.reload())
+        self.assertEqual(len(keyring.verifiers), 2)
+        check_document(self.request, document, 'body')
+
+
+class RevisionChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.src = {
+            'title': u'asset',
+            'status': 'pending',
+            'value': {'amount': 100, 'currency': u'UAH'},
+            'items': [{'id': str(i), 'description': u'item {}'.format(i), 'quantity': i} for i in range(5)],
+            'documents': [{'id': '1', 'title': u'v1'}, {'id': '1', 'title': u'v2'}],
+            'a/b~c': 1,
+        }
+
+    def assertChanges(self, dst, length=None):
+        changes = get_revision_changes(dst, self.src)
+        self.assertEqual(apply_patch(dst, changes), self.src)
+        if length is not None:
+            self.assertEqual(len(changes), length)
+        return changes
+
+    def test_equal(self):
+        self.assertEqual(get_revision_changes(self.src, deepcopy(self.src)), [])
+        self.assertEqual(get_revision_changes(self.src, self.src), [])
+
+    def test_scalars(self):
+        dst = deepcopy(self.src)
+        dst['title'] = u'old'
+        dst['value']['amount'] = 50
+        del dst['status']
+        dst['a/b~c'] = 2
+        dst['extra'] = [1]
+        changes = self.assertChanges(dst, 5)
+        self.assertIn({'op': 'replace', 'path': u'/a~1b~0c', 'value': 1}, changes)
+
+    def test_items_by_id(self):
+        dst = deepcopy(self.src)
+        dst['items'].insert(0, {'id': 'removed', 'description': u'removed'})
+        self.assertEqual(self.assertChanges(dst, 1), [{'op': 'remove', 'path': u'/items/0'}])
+
+        dst = deepcopy(self.src)
+        del dst['items'][2]
+        self.assertEqual(self.assertChanges(dst, 1),
+                         [{'op': 'add', 'path': u'/items/2', 'value': self.src['items'][2]}])
+
+        dst = deepcopy(self.src)
+        del dst['items'][1]
+        dst['items'][2]['quantity'] = 10
+        dst['items'].append({'id': 'removed'})
+        self.assertChanges(dst, 3)
+
+    def test_items_reordered(self):
+        dst = deepcopy(self.src)
+        dst['items'].reverse()
+        self.assertChanges(dst)
+
+    def test_documents_versions(self):
+        dst = deepcopy(self.src)
+        dst['documents'].pop()
+        self.assertEqual(self.assertChanges(dst, 1),
+                         [{'op': 'add', 'path': u'/documents/1', 'value': self.src['documents'][1]}])
+
+    def test_types(self):
+        dst = deepcopy(self.src)
+        dst['value'] = [1, 2]
+        dst['items'] = None
+        self.assertChanges(dst, 2)
+
+    def test_apply_data_patch(self):
+        self.assertEqual(apply_data_patch(self.src, {'title': u'asset'}), {})
+        self.assertEqual(apply_data_patch(self.src, {'title': u'new'})['title'], u'new')
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(4)
+        for i in range(4):
+            cache[i] = str(i)
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.get(0), '0')  # moved to recent generation
+        cache[4] = '4'
+        cache[5] = '5'
+        self.assertEqual(cache.get(0), '0')
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.get(2, 'default'), 'default')
+        self.assertLessEqual(len(cache), 4)
+
+        self.assertEqual(cache.pop(0), '0')
+        self.assertIsNone(cache.get(0))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_ttl(self):
+        cache = TTLCache(4, 10)
+        cache['key'] = 'value'
+        self.assertEqual(cache.get('key'), 'value')
+        with mock.patch('openregistry.api.utils.ttime', return_value=ttime() + 11):
+            self.assertIsNone(cache.get('key'))
+        self.assertEqual(len(cache), 0)
+
+
+class RequestJSONBodyTest(unittest.TestCase):
+
+    def request(self, body=None, **kwargs):
+        request = Request.blank('/', body=body, **kwargs)
+        request.registry = mock.MagicMock()
+        request.registry.json_loads = mock.MagicMock(side_effect=loads)
+        return request
+
+    def test_parsed_once(self):
+        request = self.request('{"data": {"title": "test"}}', method='POST', content_type='application/json')
+        self.assertEqual(request_json_body(request), {'data': {'title': 'test'}})
+        self.assertIs(request_json_body(request), request_json_body(request))
+        self.assertEqual(request.registry.json_loads.call_count, 1)
+        self.assertIn('JSON_PARSE_TIME', request.logging_context)
+
+    def test_errors(self):
+        request = self.request('{"data": ', method='POST', content_type='application/json')
+        for i in range(2):
+            with self.assertRaises(ValueError):
+                request_json_body(request)
+        self.assertEqual(request.registry.json_loads.call_count, 1)
+
+        request = self.request()
+        with self.assertRaisesRegexp(ValueError, 'No JSON object could be decoded'):
+            request_json_body(request)
+        self.assertFalse(request.registry.json_loads.called)
+
+    def test_default_backend(self):
+        request = self.request('[1, 2]', method='PATCH')
+        request.registry.json_loads = None
+        self.assertEqual(request_json_body(request), [1, 2])
+
+
+class LoggingContextTest(unittest.TestCase):
+
+    def test_lazy_values(self):
+        user = mock.MagicMock(return_value='broker')
+        request = Request.blank('/')
+        update_logging_context(request, {'api_version': '2.3'})
+        update_logging_context(request, {'user': user}, lazy=True)
+        self.assertIsInstance(request.logging_context, LoggingContext)
+        self.assertEqual(sorted(request.logging_context), ['API_VERSION', 'USER'])
+        self.assertFalse(user.called)
+
+        self.assertEqual(context_unpack(request, {'MESSAGE_ID': 'test'}),
+                         {'MESSAGE_ID': 'test', 'JOURNAL_API_VERSION': '2.3', 'JOURNAL_USER': 'broker'})
+        self.assertIs(request.logging_context.journal(), request.logging_context.journal())
+        context_unpack(request, {}, {'document_id': '__new__'})
+        self.assertEqual(request.logging_context.journal()['JOURNAL_DOCUMENT_ID'], '__new__')
+        self.assertEqual(user.call_count, 1)
+
+        del request.logging_context['USER']
+        self.assertNotIn('JOURNAL_USER', request.logging_context.journal())
+        request.logging_context['USER'] = 'other'
+        self.assertEqual(dict(request.logging_context), {'API_VERSION': '2.3', 'DOCUMENT_ID': '__new__',
+                                                         'USER': 'other'})
+
+    def test_filtered_record(self):
+        user = mock.MagicMock(return_value='broker')
+        request = Request.blank('/')
+        update_logging_context(request, {'user': user}, lazy=True)
+        logger = logging.getLogger('openregistry.api.tests.filtered')
+        logger.setLevel(logging.WARNING)
+        logger.info('Not logged', extra=context_unpack(request, {'MESSAGE_ID': 'test'}))
+        self.assertFalse(user.called)
+        self.assertEqual(str(context_unpack(request, {})['JOURNAL_USER']), 'broker')
+
+    def test_merged_on_new_request(self):
+        request = Request.blank('/', method='POST', body='{}', content_type='application/json')
+        request.registry = mock.MagicMock(json_loads=None)
+        request_json_body(request)
+        add_logging_context(mock.MagicMock(request=request))
+        self.assertIn('JSON_PARSE_TIME', request.logging_context)
+        self.assertEqual(request.logging_context['REQUEST_METHOD'], 'POST')
+
+    def test_plain_dict(self):
+        request = Request.blank('/')
+        request.logging_context = {'TAGS': 'python,api'}
+        update_logging_context(request, {'role': 'broker'})
+        self.assertEqual(dict(request.logging_context), {'TAGS': 'python,api', 'ROLE': 'broker'})
+
+
+class ErrorHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def request(self):
+        request = Request.blank('/', remote_addr='127.0.0.1')
+        request.registry = self.config.registry
+        request.matchdict = {'asset_id': 'a' * 32}
+        request.authenticated_role = 'broker'
+        request.errors = Errors(422)
+        request.errors.add('body', 'data', 'No JSON object could be decoded')
+        return request
+
+    @mock.patch('openregistry.api.utils.LOGGER')
+    def test_log(self, logger):
+        with mock.patch.object(self.config.registry, 'notify') as notify:
+            response = error_handler(self.request())
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(notify.called)
+
+        args, kwargs = logger.info.call_args
+        self.assertEqual(args[0] % args[1:], 'Error on processing request '
+                         '"[{"location": "body", "name": "data", "description": "No JSON object could be decoded"}]"')
+        self.assertEqual(kwargs['extra']['JOURNAL_ASSET_ID'], 'a' * 32)
+        self.assertEqual(kwargs['extra']['JOURNAL_ERROR_STATUS'], 422)
+        self.assertEqual(kwargs['extra']['JOURNAL_ROLE'], 'broker')
+
+    @mock.patch('openregistry.api.utils.LOGGER')
+    def test_subscribers(self, logger):
+        events = []
+
+        def subscriber(event):
+            events.append(event)
+            event.params['EXTRA'] = 'value'
+        self.config.add_subscriber(subscriber, ErrorDesctiptorEvent)
+        error_handler(self.request())
+        self.assertEqual(len(events), 1)
+        self.assertEqual(logger.info.call_args[1]['extra']['JOURNAL_EXTRA'], 'value')
+
+    @mock.patch('openregistry.api.utils.LOGGER')
+    def test_rate_limit(self, logger):
+        self.config.registry.error_log_limiter = ErrorLogLimiter(60)
+        for i in range(3):
+            error_handler(self.request())
+        self.assertEqual(logger.info.call_count, 1)
+
+        request = self.request()
+        request.errors.status = 403
+        error_handler(request)
+        self.assertEqual(logger.info.call_count, 2)
+
+        with mock.patch('openregistry.api.utils.ttime', return_value=ttime() + 61):
+            error_handler(self.request())
+        self.assertEqual(logger.info.call_count, 3)
+        self.assertEqual(logger.info.call_args[1]['extra']['JOURNAL_SUPPRESSED_ERRORS'], 2)
+
+
+class DummyEntryPoint(object):
+
+    def __init__(self, name, plugin=None):
+        self.name = name
+        self.plugin = plugin
+
+    def load(self):
+        return self.plugin
+
+
+class DummyDistribution(object):
+
+    def __init__(self, entry_map):
+        self.entry_map = entry_map
+        self.calls = 0
+
+    def get_entry_map(self):
+        self.calls += 1
+        return self.entry_map
+
+
+class StartupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = mock.Mock()
+        self.dists = [
+            DummyDistribution({'openregistry.api.plugins': {'api': DummyEntryPoint('api', self.plugin)}}),
+            DummyDistribution({'openregistry.subscribers.x': {'a': DummyEntryPoint('a'),
+                                                              'b': DummyEntryPoint('b')}}),
+        ]
+        patcher = mock.patch('openregistry.api.utils.working_set', self.dists)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict('openregistry.api.utils.ENTRY_POINTS', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_entry_points_index(self):
+        self.assertEqual([i.name for i in entry_points('openregistry.api.plugins')], ['api'])
+        self.assertEqual(sorted(i.name for i in entry_points('openregistry.subscribers.x')), ['a', 'b'])
+        self.assertEqual([i.name for i in entry_points('openregistry.subscribers.x', 'b')], ['b'])
+        self.assertEqual(entry_points('openregistry.subscribers.y'), [])
+        self.assertEqual([i.calls for i in self.dists], [1, 1])
+
+    def test_entry_points_working_set(self):
+        self.assertEqual(entry_points('openregistry.subscribers.z'), [])
+        self.dists.append(DummyDistribution({'openregistry.subscribers.z': {'c': DummyEntryPoint('c')}}))
+        self.assertEqual([i.name for i in entry_points('openregistry.subscribers.z')], ['c'])
+        self.assertEqual([i.calls for i in self.dists], [2, 2, 1])
+
+        with mock.patch('openregistry.api.utils.working_set', self.dists[:1]):
+            self.assertEqual(entry_points('openregistry.subscribers.z'), [])
+
+    def test_load_plugins(self):
+        load_plugins('config', group='openregistry.api.plugins', plugins=['other'])
+        self.assertFalse(self.plugin.called)
+        load_plugins('config', group='openregistry.api.plugins', plugins=['api'])
+        self.plugin.assert_called_once_with('config')
+
+    @mock.patch('openregistry.api.utils.LOGGER')
+    def test_profile(self, logger):
+        profile = StartupProfile()
+        with profile('plugins'):
+            pass
+        profile.report()
+        self.assertEqual(profile.phases, [])
+        self.assertFalse(logger.info.called)
+
+        profile = StartupProfile(True)
+        with profile('plugins'):
+            pass
+        with self.assertRaises(ValueError):
+            with profile('couchdb'):
+                raise ValueError
+        profile.report()
+        self.assertEqual([i[0] for i in profile.phases], ['plugins', 'couchdb'])
+        extra = logger.info.call_args[1]['extra']
+        self.assertEqual(extra['MESSAGE_ID'], 'startup_profile')
+        self.assertIn('STARTUP_PLUGINS', extra)
+        self.assertIn('STARTUP_COUCHDB', extra)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ErrorHandlerTest))
+    suite.addTest(unittest.makeSuite(StartupTest))
+    suite.addTest(unittest.makeSuite(FixURLTest))
+    suite.addTest(unittest.makeSuite(StalenessPolicyTest))
+    suite.addTest(unittest.makeSuite(DocumentURLTest))
+    suite.addTest(unittest.makeSuite(KeyringTest))
+    suite.addTest(unittest.makeSuite(LoggingContextTest))
+    suite.addTest(unittest.makeSuite(RequestJSONBodyTest))
+    suite.addTest(unittest.makeSuite(LRUCacheTest))
+    suite.addTest(unittest.makeSuite(RevisionChangesTest))
+    suite.addTest(unittest.makeSuite(ListingCursorTest))
+    suite.addTest(unittest.makeSuite(ListingStreamTest))
+    suite.addTest(unittest.makeSuite(ListingPagesTest))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -1,37 +1,111 @@
 # -*- coding: utf-8 -*-
+import os
 from datetime import datetime
 from string import hexdigits
-from json import dumps
+from json import dumps, loads
 from uuid import uuid4
 from functools import partial
-from logging import getLogger
+from itertools import chain, islice
+from collections import MutableMapping
+from contextlib import contextmanager
+from logging import getLogger, INFO
 from binascii import hexlify, unhexlify
 from Crypto.Cipher import AES
+from gevent import sleep, spawn
+from libnacl.sign import Verifier
 from cornice.util import json_error
 from cornice.resource import view
+from pyramid.response import Response
+from pyramid.threadlocal import get_current_request
+from couchdb.client import Row
 from webob.multidict import NestedMultiDict
-from pkg_resources import iter_entry_points
+from pkg_resources import working_set
+from zope.interface import implementedBy
 from urlparse import urlparse, parse_qs, urlunsplit, parse_qsl
 from time import time as ttime
 from urllib import quote, unquote, urlencode
 from base64 import b64encode, b64decode
-from hashlib import sha512
+from hashlib import sha512, sha1
+from hmac import new as hmac_new, compare_digest
 from rfc6266 import build_header
 
+from schematics.models import Model
 from schematics.types import StringType
-from jsonpatch import make_patch, apply_patch as _apply_patch
+from jsonpatch import apply_patch as _apply_patch
 
 from openregistry.api.events import ErrorDesctiptorEvent
 from openregistry.api.constants import LOGGER, TZ, ROUTE_PREFIX
 from openregistry.api.interfaces import IContentConfigurator
+from openregistry.api.models.projection import projection_plan, project_document, scalar_fields
+from openregistry.api.models.serializer import EACH, document_paths
 
 
 json_view = partial(view, renderer='json')
 
+STREAM_BATCH = 100
+STREAM_ERROR = {'status': 'error', 'errors': [
+    {'location': 'body', 'name': 'data', 'description': 'Listing interrupted, page is incomplete'}]}
+
+
+ENTRY_POINTS = {}
+
+
+def entry_points(group, name=None):
+    """ Entry points of ``group`` (with ``name``) in installed distributions.
+
+    Entry maps of all distributions are read once into index by group, so
+    plugins and every ``subscribers.*`` setting do not parse them again.
+    Index is kept for distributions it was read from and is read again
+    once distributions are added to working set or replaced.
+    """
+    dists = tuple(working_set)
+    if ENTRY_POINTS.get('dists') != dists:
+        index = {}
+        for dist in dists:
+            for key, entries in dist.get_entry_map().items():
+                index.setdefault(key, []).extend(entries.values())
+        ENTRY_POINTS.update(dists=dists, index=index)
+    return [i for i in ENTRY_POINTS['index'].get(group, ()) if name is None or i.name == name]
+
+
+class StartupProfile(object):
+    """ Wall time of application startup phases.
+
+        with profile('plugins'):
+            load_plugins(...)
+
+    Disabled profile only runs the phases.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []
+        self.started = ttime()
+
+    @contextmanager
+    def __call__(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = ttime()
+        try:
+            yield
+        finally:
+            self.phases.append((name, ttime() - start))
+
+    def report(self):
+        if not self.enabled:
+            return
+        total = ttime() - self.started
+        message = ', '.join('{} {:.1f} ms'.format(name, seconds * 1000) for name, seconds in self.phases)
+        extra = dict([('STARTUP_' + name.upper(), seconds) for name, seconds in self.phases],
+                     MESSAGE_ID='startup_profile', STARTUP_TIME=total)
+        LOGGER.info('Startup {:.1f} ms: {}'.format(total * 1000, message), extra=extra)
+
 
 def load_plugins(config, group, **kwargs):
     plugins = kwargs.get('plugins')
-    for entry_point in iter_entry_points(group, kwargs.get('name')):
+    for entry_point in entry_points(group, kwargs.get('name')):
         if not plugins or entry_point.name in plugins:
             plugin = entry_point.load()
             plugin(config)
@@ -46,6 +120,69 @@ def set_parent(item, parent):
         item.__parent__ = parent
 
 
+class LRUCache(object):
+    """ Bounded cache evicting least recently used entries.
+
+    Entries are kept in two generations of ``size / 2``: when recent one is
+    full it becomes old one, and old entries are moved back to recent on
+    hit. It keeps lookups to plain dict operations.
+    """
+
+    def __init__(self, size):
+        self.size = max(size / 2, 1)
+        self.recent = {}
+        self.old = {}
+
+    def __len__(self):
+        return len(self.recent) + len(self.old)
+
+    def get(self, key, default=None):
+        try:
+            return self.recent[key]
+        except KeyError:
+            pass
+        try:
+            value = self.old.pop(key)
+        except KeyError:
+            return default
+        self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if len(self.recent) >= self.size:
+            self.old = self.recent
+            self.recent = {}
+        self.recent[key] = value
+
+    def pop(self, key, default=None):
+        value = self.recent.pop(key, default)
+        return self.old.pop(key, value)
+
+    def clear(self):
+        self.recent.clear()
+        self.old.clear()
+
+
+class TTLCache(LRUCache):
+    """ LRUCache with entries expiring ``ttl`` seconds after they are set """
+
+    def __init__(self, size, ttl):
+        super(TTLCache, self).__init__(size)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = super(TTLCache, self).get(key)
+        if entry is None:
+            return default
+        if entry[1] < ttime():
+            self.pop(key)
+            return default
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        super(TTLCache, self).__setitem__(key, (value, ttime() + self.ttl))
+
+
 def encrypt(uuid, name, key):
     iv = "{:^{}.{}}".format(name, AES.block_size, AES.block_size)
     text = "{:^{}}".format(key, AES.block_size)
@@ -61,6 +198,85 @@ def decrypt(uuid, name, key):
     return text
 
 
+CURSOR_SIGNERS = {}
+
+
+def sign_cursor(secret, name, key, docid):
+    if secret not in CURSOR_SIGNERS:
+        CURSOR_SIGNERS[secret] = hmac_new(str(secret), digestmod=sha1)
+    signer = CURSOR_SIGNERS[secret].copy()
+    signer.update(u'{}\0{}\0{}'.format(name, key, docid).encode('utf-8'))
+    return signer.hexdigest()[:16]
+
+
+def encode_cursor(secret, name, key, docid):
+    """ Listing offset pointing to the (key, docid) view row, key of any
+        JSON type is stored as JSON.
+    """
+    key = dumps(key)
+    return u'{};{};{}'.format(key, docid, sign_cursor(secret, name, key, docid))
+
+
+def decode_cursor(secret, name, cursor):
+    """ Return (key, docid) of signed listing offset or None """
+    parts = cursor.rsplit(';', 2)
+    if len(parts) != 3:
+        return None
+    key, docid, signature = parts
+    if isinstance(signature, unicode):
+        signature = signature.encode('utf-8')
+    if not compare_digest(signature, str(sign_cursor(secret, name, key, docid))):
+        return None
+    return loads(key), docid
+
+
+def batched_rows(view, db, batch, **options):
+    """ ``limit`` rows of ``view`` read in batches of ``batch`` rows.
+
+    Next batch is read from the last row of previous one with ``skip=1``,
+    so unlike ``iterview`` no row is fetched twice or past ``limit``.
+    """
+    remaining = options.pop('limit')
+    while remaining > 0:
+        size = min(batch, remaining)
+        rows = list(view(db, limit=size, **options))
+        for row in rows:
+            yield row
+        if len(rows) < size:
+            return
+        remaining -= size
+        options.update(startkey=rows[-1].key, startkey_docid=rows[-1].id, skip=1)
+
+
+def offset_rows(rows, key, limit):
+    """ Rows of page of plain or encrypted offset of old clients.
+
+    View is read from ``key`` with one row more, the first row is the last
+    one of previous page if it has offset key, so it is skipped.
+    """
+    rows = iter(rows)
+    for row in rows:
+        if row.key != key:
+            yield row
+            limit -= 1
+        break
+    for row in islice(rows, limit):
+        yield row
+
+
+def cursor_startkey_docid(docid, descending=False):
+    """ The closest docid after ``docid`` in view order.
+
+    CouchDB orders rows with equal keys by raw docid bytes, so the next page
+    starts right after the cursor row without fetching it once more.
+    """
+    if not descending:
+        return docid + u'\x00'
+    if docid[-1] == u'\x00':
+        return docid[:-1]
+    return docid[:-1] + unichr(ord(docid[-1]) - 1) + u'\ufff0'
+
+
 def generate_id():
     return uuid4().hex
 
@@ -81,10 +297,8 @@ def prepare_patch(changes, orig, patch, basepath=''):
                 prepare_patch(changes, orig[i], patch[i], '{}/{}'.format(basepath, i))
             else:
                 changes.append({'op': 'add', 'path': '{}/{}'.format(basepath, i), 'value': j})
-    else:
-        for x in make_patch(orig, patch).patch:
-            x['path'] = '{}{}'.format(basepath, x['path'])
-            changes.append(x)
+    elif orig != patch:
+        changes.append({'op': 'replace', 'path': basepath, 'value': patch})
 
 
 def apply_data_patch(item, changes):
@@ -95,8 +309,85 @@ def apply_data_patch(item, changes):
     return _apply_patch(item, patch_changes)
 
 
+def json_pointer(path, key):
+    return u'{}/{}'.format(path, unicode(key).replace(u'~', u'~0').replace(u'/', u'~1'))
+
+
+def list_ids(items):
+    """ Ids of list of objects, None if some has no id or ids repeat """
+    ids = []
+    for i in items:
+        if not isinstance(i, dict) or 'id' not in i:
+            return None
+        ids.append(i['id'])
+    return ids if len(set(ids)) == len(ids) else None
+
+
+def diff_value(changes, src, dst, path):
+    if src is dst:
+        return
+    if isinstance(src, dict) and isinstance(dst, dict):
+        diff_dict(changes, src, dst, path)
+    elif isinstance(src, list) and isinstance(dst, list):
+        diff_list(changes, src, dst, path)
+    elif src != dst:
+        changes.append({'op': 'replace', 'path': path, 'value': dst})
+
+
+def diff_dict(changes, src, dst, path):
+    for key in src:
+        if key not in dst:
+            changes.append({'op': 'remove', 'path': json_pointer(path, key)})
+    for key, value in dst.iteritems():
+        if key not in src:
+            changes.append({'op': 'add', 'path': json_pointer(path, key), 'value': value})
+        elif src[key] is not value and src[key] != value:
+            diff_value(changes, src[key], value, json_pointer(path, key))
+
+
+def diff_list_by_id(changes, src, dst, src_ids, dst_ids, path):
+    """ Diff of lists of objects matched by id, False if order changed """
+    src_map = dict(zip(src_ids, src))
+    dst_set = set(dst_ids)
+    kept = [i for i in src_ids if i in dst_set]
+    if kept != [i for i in dst_ids if i in src_map]:
+        return False
+    for index in reversed(xrange(len(src_ids))):
+        if src_ids[index] not in dst_set:
+            changes.append({'op': 'remove', 'path': json_pointer(path, index)})
+    for index, value in enumerate(dst):
+        if dst_ids[index] in src_map:
+            if src_map[dst_ids[index]] != value:
+                diff_value(changes, src_map[dst_ids[index]], value, json_pointer(path, index))
+        else:
+            changes.append({'op': 'add', 'path': json_pointer(path, index), 'value': value})
+    return True
+
+
+def diff_list(changes, src, dst, path):
+    src_ids = list_ids(src)
+    dst_ids = src_ids is not None and list_ids(dst)
+    if dst_ids and src_ids != dst_ids and diff_list_by_id(changes, src, dst, src_ids, dst_ids, path):
+        return
+    common = min(len(src), len(dst))
+    for index in xrange(common):
+        if src[index] is not dst[index] and src[index] != dst[index]:
+            diff_value(changes, src[index], dst[index], json_pointer(path, index))
+    for index in reversed(xrange(common, len(src))):
+        changes.append({'op': 'remove', 'path': json_pointer(path, index)})
+    for index in xrange(common, len(dst)):
+        changes.append({'op': 'add', 'path': json_pointer(path, index), 'value': dst[index]})
+
+
 def get_revision_changes(dst, src):
-    return make_patch(dst, src).patch
+    """ JSON patch turning ``dst`` into ``src``.
+
+    Equal subtrees are skipped without descending into them and lists of
+    objects with unique ids are matched by id instead of position.
+    """
+    changes = []
+    diff_value(changes, dst, src, u'')
+    return changes
 
 
 def set_ownership(item, request):
@@ -115,10 +406,8 @@ def set_ownership(item, request):
 def context_unpack(request, msg, params=None):
     if params:
         update_logging_context(request, params)
-    logging_context = request.logging_context
     journal_context = msg
-    for key, value in logging_context.items():
-        journal_context["JOURNAL_" + key] = value
+    journal_context.update(get_logging_context(request).journal())
     return journal_context
 
 
@@ -130,24 +419,111 @@ def get_content_configurator(request):
                                                   IContentConfigurator)
 
 
+class LazyJSON(object):
+    """ Value serialized to JSON only when log record is formatted """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return dumps(self.value)
+
+
+class ErrorLogLimiter(object):
+    """ Lets identical errors of one client be logged once per ``interval``
+        seconds and counts suppressed ones.
+    """
+
+    def __init__(self, interval, size=10000):
+        self.interval = interval
+        self.logged = LRUCache(size)
+
+    def check(self, key):
+        """ Number of errors suppressed since ``key`` was logged last time,
+            or None when this one should be suppressed too.
+        """
+        now = ttime()
+        entry = self.logged.get(key)
+        if entry is not None and entry[0] > now:
+            entry[1] += 1
+            return None
+        self.logged[key] = [now + self.interval, 0]
+        return entry[1] if entry is not None else 0
+
+
+def has_subscribers(registry, event_class):
+    """ Whether any subscriber is registered for events of ``event_class`` """
+    return bool(registry.adapters.subscriptions([implementedBy(event_class)], None))
+
+
 def error_handler(request, request_params=True):
     errors = request.errors
     params = {
         'ERROR_STATUS': errors.status
     }
     if request_params:
-        params['ROLE'] = str(request.authenticated_role)
+        # already set by set_logging_context unless context is not found yet
+        lazy_params = {'ROLE': lambda: str(request.authenticated_role)}
         if request.params:
-            params['PARAMS'] = str(dict(request.params))
+            lazy_params['PARAMS'] = lambda: str(dict(request.params))
+        update_logging_context(request, lazy_params, lazy=True)
     if request.matchdict:
         for x, j in request.matchdict.items():
             params[x.upper()] = j
-    request.registry.notify(ErrorDesctiptorEvent(request, params))
-    LOGGER.info('Error on processing request "{}"'.format(dumps(errors, indent=4)),
+    registry = request.registry
+    if has_subscribers(registry, ErrorDesctiptorEvent):
+        registry.notify(ErrorDesctiptorEvent(request, params))
+    if not LOGGER.isEnabledFor(INFO):
+        return json_error(request)
+    limiter = getattr(registry, 'error_log_limiter', None)
+    if limiter is not None:
+        client = request.authenticated_userid or request.remote_addr
+        suppressed = limiter.check((client, errors.status, repr(errors)))
+        if suppressed is None:
+            return json_error(request)
+        if suppressed:
+            params['SUPPRESSED_ERRORS'] = suppressed
+    LOGGER.info('Error on processing request "%s"', LazyJSON(errors),
                 extra=context_unpack(request, {'MESSAGE_ID': 'error_handler'}, params))
     return json_error(request)
 
 
+# message of json.loads for empty body
+NO_JSON_BODY = 'No JSON object could be decoded'
+
+
+def decode_json_body(request):
+    """ Parse body with ``json_loads`` of registry, parse time in ms goes
+        to logging context.
+    """
+    body = request.body if request.is_body_readable else None
+    if not body:
+        raise ValueError(NO_JSON_BODY)
+    json_loads = getattr(request.registry, 'json_loads', None) or loads
+    start = ttime()
+    try:
+        return json_loads(body.decode(request.charset))
+    finally:
+        update_logging_context(request, {'JSON_PARSE_TIME': '{:.3f}'.format((ttime() - start) * 1000)})
+
+
+def request_json_body(request):
+    """ ``request.json_body`` parsed at most once per request.
+
+    Parse error is kept as well and raised as ValueError on every call.
+    """
+    if 'decoded_json_body' not in request.__dict__:
+        try:
+            request.__dict__['decoded_json_body'] = decode_json_body(request)
+        except ValueError, e:
+            request.__dict__['decoded_json_body'] = e
+    json = request.__dict__['decoded_json_body']
+    if isinstance(json, ValueError):
+        raise json
+    return json
+
+
 def request_params(request):
     try:
         params = NestedMultiDict(request.GET, request.POST)
@@ -164,39 +540,213 @@ def request_params(request):
 
 def fix_url(item, app_url):
     if isinstance(item, list):
-        [
-            fix_url(i, app_url)
-            for i in item
-            if isinstance(i, dict) or isinstance(i, list)
-        ]
+        for i in item:
+            if isinstance(i, (dict, list)):
+                fix_url(i, app_url)
     elif isinstance(item, dict):
-        if "format" in item and "url" in item and '?download=' in item['url']:
-            path = item["url"] if item["url"].startswith('/') else '/' + '/'.join(item['url'].split('/')[5:])
-            item["url"] = app_url + ROUTE_PREFIX + path
+        url = item.get("url")
+        if url and "format" in item and '?download=' in url:
+            if url.startswith('/'):
+                item["url"] = app_url + ROUTE_PREFIX + url
+            else:
+                parts = url.split('/', 5)
+                item["url"] = app_url + ROUTE_PREFIX + '/' + (parts[5] if len(parts) > 5 else '')
             return
-        [
-            fix_url(item[i], app_url)
-            for i in item
-            if isinstance(item[i], dict) or isinstance(item[i], list)
-        ]
+        for i in item.itervalues():
+            if isinstance(i, (dict, list)):
+                fix_url(i, app_url)
+
+
+def fix_url_paths(item, paths, app_url):
+    """ ``fix_url`` of nodes at ``paths`` of ``document_paths`` only """
+    for path in paths:
+        nodes = [item]
+        for key in path:
+            if key is EACH:
+                nodes = [i for node in nodes if isinstance(node, list) for i in node]
+            else:
+                nodes = [node[key] for node in nodes if isinstance(node, dict) and key in node]
+        for node in nodes:
+            fix_url(node, app_url)
+
+
+def context_document_paths(request, data):
+    """ ``document_paths`` of model of context when ``data`` is exported
+        context, as item views render, None for other data.
+    """
+    context = request.__dict__.get('context')
+    if isinstance(context, Model) and isinstance(data, dict) and \
+            data.get('id') and data.get('id') == getattr(context, 'id', None):
+        return document_paths(type(context))
+
+
+class DocserviceSigner(object):
+    """ Signs docservice URLs with ``key``. Signatures of permanent URLs
+        never change for doc_id and prefix, so they are kept in LRU cache.
+    """
+
+    def __init__(self, key, cache_size=10000):
+        self.key = key
+        self.key_id = key.hex_vk()[:8]
+        self.cache = LRUCache(cache_size)
+        self.urls = LRUCache(cache_size)
+
+    def sign(self, message):
+        return quote(b64encode(self.key.signature(message.encode("utf-8"))))
+
+    def signature(self, doc_id, prefix=None, expires=None):
+        mess = doc_id if expires is None else "{}\0{}".format(doc_id, expires)
+        if prefix:
+            mess = '{}/{}'.format(prefix, mess)
+        if expires is not None:
+            return self.sign(mess)
+        signature = self.cache.get(mess)
+        if signature is None:
+            signature = self.cache[mess] = self.sign(mess)
+        return signature
+
+    def signatures(self, targets):
+        """ Permanent signatures of (doc_id, prefix) ``targets``, each
+            distinct missing one is signed once.
+        """
+        signed = {}
+        for target in targets:
+            if target not in signed:
+                signed[target] = self.signature(*target)
+        return [signed[i] for i in targets]
+
+
+def read_keys(path):
+    """ Hex encoded verify keys of document service from file, separated
+        by whitespace.
+    """
+    with open(path) as keys_file:
+        return keys_file.read().split()
+
+
+class Keyring(object):
+    """ Document service verify keys by KeyID.
+
+    Keys of ``path`` file are added to ``keys`` and reloaded when file
+    changes, polled every ``interval`` seconds. Missing, empty or invalid
+    file keeps current keys. Verified signatures are cached by (KeyID,
+    key, hash), cache is dropped when keys change.
+    """
+
+    def __init__(self, keys=(), path=None, interval=0, cache_size=10000):
+        self.keys = [i for i in keys if i]
+        self.path = path
+        self.interval = interval
+        self.verified = LRUCache(cache_size)
+        self.stamp = None
+        self.rotate([])
+        if path:
+            self.reload()
+        if path and interval:
+            spawn(self.watch)
+
+    def __contains__(self, keyid):
+        return keyid in self.verifiers
+
+    def __getitem__(self, keyid):
+        return self.verifiers[keyid]
+
+    def get(self, keyid, default=None):
+        return self.verifiers.get(keyid, default)
+
+    def rotate(self, keys):
+        """ Replaces keys added after static ones with ``keys`` """
+        self.verifiers = dict([(i[:8], Verifier(i)) for i in self.keys + list(keys)])
+        self.verified.clear()
+
+    def reload(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            stamp = None
+        else:
+            stamp = stat.st_mtime, stat.st_size, stat.st_ino
+        if stamp == self.stamp:
+            return False
+        # file is read again only after next change, e.g. end of rewrite
+        self.stamp = stamp
+        try:
+            if stamp is None:
+                raise IOError("No such file")
+            keys = read_keys(self.path)
+            if not keys:
+                raise ValueError("No keys")
+            for key in keys:
+                if len(key) != 64 or key.strip(hexdigits):
+                    raise ValueError("Invalid key {}".format(key))
+            self.rotate(keys)
+        except Exception, e:
+            LOGGER.warning("Kept {} keys, failed to reload keyring {}: {}".format(len(self.verifiers), self.path, e),
+                           extra={'MESSAGE_ID': 'keyring_reload_failed'})
+            return False
+        LOGGER.info("Reloaded keyring {} with {} keys".format(self.path, len(self.verifiers)),
+                    extra={'MESSAGE_ID': 'keyring_reload'})
+        return True
+
+    def watch(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.reload()
+            except Exception, e:
+                LOGGER.warning("Failed to reload keyring {}: {}".format(self.path, e),
+                               extra={'MESSAGE_ID': 'keyring_reload_failed'})
+
+    def verify(self, keyid, key, hash, signature):
+        """ Whether ``signature`` of document service is valid for document
+            ``key`` with ``hash``. Once verified, (KeyID, key, hash) is
+            trusted without checking signature again.
+        """
+        cache_key = (keyid, key, hash)
+        if self.verified.get(cache_key):
+            return True
+        verifier = self.verifiers.get(keyid)
+        if verifier is None:
+            return False
+        mess = "{}\0{}".format(key, hash)
+        try:
+            if mess != verifier.verify(signature + mess.encode("utf-8")):
+                return False
+        except ValueError:
+            return False
+        self.verified[cache_key] = True
+        return True
+
+
+def docservice_signer(registry):
+    signer = getattr(registry, 'docservice_signer', None)
+    if signer is None or signer.key is not registry.docservice_key:
+        signer = registry.docservice_signer = DocserviceSigner(registry.docservice_key)
+    return signer
 
 
 def generate_docservice_url(request, doc_id, temporary=True, prefix=None):
-    docservice_key = getattr(request.registry, 'docservice_key', None)
-    parsed_url = urlparse(request.registry.docservice_url)
+    signer = docservice_signer(request.registry)
+    docservice_url = request.registry.docservice_url
+    if not temporary:
+        url = signer.urls.get((docservice_url, doc_id, prefix))
+        if url is not None:
+            return url
+    parsed_url = urlparse(docservice_url)
     query = {}
     if temporary:
         expires = int(ttime()) + 300  # EXPIRES
-        mess = "{}\0{}".format(doc_id, expires)
         query['Expires'] = expires
+        query['Signature'] = signer.signature(doc_id, prefix, expires)
     else:
-        mess = doc_id
+        query['Signature'] = signer.signature(doc_id, prefix)
     if prefix:
-        mess = '{}/{}'.format(prefix, mess)
         query['Prefix'] = prefix
-    query['Signature'] = quote(b64encode(docservice_key.signature(mess.encode("utf-8"))))
-    query['KeyID'] = docservice_key.hex_vk()[:8]
-    return urlunsplit((parsed_url.scheme, parsed_url.netloc, '/get/{}'.format(doc_id), urlencode(query), ''))
+    query['KeyID'] = signer.key_id
+    url = urlunsplit((parsed_url.scheme, parsed_url.netloc, '/get/{}'.format(doc_id), urlencode(query), ''))
+    if not temporary:
+        signer.urls[(docservice_url, doc_id, prefix)] = url
+    return url
 
 
 def update_file_content_type(request):
@@ -228,44 +778,58 @@ def get_file(request):
     return url
 
 
-def check_document(request, document, document_container):
+def document_error(request, document):
+    """ Status, field and message of error of document uploaded to document
+        service, None for valid one.
+    """
     url = document.url
     parsed_url = urlparse(url)
     parsed_query = dict(parse_qsl(parsed_url.query))
+    path = parsed_url.path.split('/')
     if not url.startswith(request.registry.docservice_url) or \
-            len(parsed_url.path.split('/')) != 3 or \
+            len(path) != 3 or \
             set(['Signature', 'KeyID']) != set(parsed_query):
-        request.errors.add(document_container, 'url', "Can add document only from document service.")
-        request.errors.status = 403
-        raise error_handler(request)
+        return 403, 'url', "Can add document only from document service."
     if not document.hash:
-        request.errors.add(document_container, 'hash', "This field is required.")
-        request.errors.status = 422
-        raise error_handler(request)
+        return 422, 'hash', "This field is required."
+    keyring = request.registry.keyring
     keyid = parsed_query['KeyID']
-    if keyid not in request.registry.keyring:
-        request.errors.add(document_container, 'url', "Document url expired.")
-        request.errors.status = 422
-        raise error_handler(request)
-    dockey = request.registry.keyring[keyid]
-    signature = parsed_query['Signature']
-    key = urlparse(url).path.split('/')[-1]
+    if keyid not in keyring:
+        return 422, 'url', "Document url expired."
     try:
-        signature = b64decode(unquote(signature))
+        signature = b64decode(unquote(parsed_query['Signature']))
     except TypeError:
-        request.errors.add(document_container, 'url', "Document url signature invalid.")
-        request.errors.status = 422
-        raise error_handler(request)
-    mess = "{}\0{}".format(key, document.hash.split(':', 1)[-1])
-    try:
-        if mess != dockey.verify(signature + mess.encode("utf-8")):
-            raise ValueError
-    except ValueError:
-        request.errors.add(document_container, 'url', "Document url invalid.")
-        request.errors.status = 422
+        return 422, 'url', "Document url signature invalid."
+    key = path[-1]
+    hash = document.hash.split(':', 1)[-1]
+    if isinstance(keyring, Keyring):
+        valid = keyring.verify(keyid, key, hash, signature)
+    else:
+        mess = "{}\0{}".format(key, hash)
+        try:
+            valid = mess == keyring[keyid].verify(signature + mess.encode("utf-8"))
+        except ValueError:
+            valid = False
+    if not valid:
+        return 422, 'url', "Document url invalid."
+
+
+def check_documents(request, documents, document_container):
+    """ Checks all ``documents`` and raises once with errors of every
+        invalid one.
+    """
+    errors = [i for i in [document_error(request, i) for i in documents] if i]
+    if errors:
+        for status, name, message in errors:
+            request.errors.add(document_container, name, message)
+        request.errors.status = min([i[0] for i in errors])
         raise error_handler(request)
 
 
+def check_document(request, document, document_container):
+    check_documents(request, [document], document_container)
+
+
 def update_document_url(request, document, document_route, route_kwargs):
     key = urlparse(document.url).path.split('/')[-1]
     route_kwargs.update({'_route_name': document_route,
@@ -282,12 +846,106 @@ def forbidden(request):
     return error_handler(request)
 
 
-def update_logging_context(request, params):
-    if not request.__dict__.get('logging_context'):
-        request.logging_context = {}
+class LazyContextValue(object):
+    """ Lazy value of logging context computed only when log record is
+        formatted, so records filtered out by level do not pay for it.
+    """
+    __slots__ = ('context', 'key')
+
+    def __init__(self, context, key):
+        self.context = context
+        self.key = key
+
+    def value(self):
+        return self.context.get(self.key, '')
+
+    def __str__(self):
+        return str(self.value())
+
+    def __unicode__(self):
+        return unicode(self.value())
+
+    def __repr__(self):
+        return repr(self.value())
+
+    def __radd__(self, other):
+        return other + self.value()
+
+    def __eq__(self, other):
+        return self.value() == other
+
+    def __ne__(self, other):
+        return self.value() != other
+
+
+class LoggingContext(MutableMapping):
+    """ Request logging context with values computed on first access.
+
+    Lazy values are callables, so requests which never log do not pay for
+    them. ``journal`` view with JOURNAL_ prefixed keys is kept until
+    context changes, its lazy values are computed when log record is
+    formatted.
+    """
+
+    def __init__(self, values=None, lazy=None):
+        self.values = dict(values or {})
+        self.lazy = dict(lazy or {})
+        self.journal_view = None
+
+    def __getitem__(self, key):
+        if key in self.lazy:
+            self.values[key] = self.lazy.pop(key)()
+        return self.values[key]
 
+    def __setitem__(self, key, value):
+        self.lazy.pop(key, None)
+        self.values[key] = value
+        self.journal_view = None
+
+    def __delitem__(self, key):
+        if self.lazy.pop(key, None) is None:
+            del self.values[key]
+        else:
+            self.values.pop(key, None)
+        self.journal_view = None
+
+    def __iter__(self):
+        return iter(self.values.keys() + self.lazy.keys())
+
+    def __len__(self):
+        return len(self.values) + len(self.lazy)
+
+    def set_lazy(self, key, func):
+        self.values.pop(key, None)
+        self.lazy[key] = func
+        self.journal_view = None
+
+    def journal(self):
+        if self.journal_view is None:
+            journal = {}
+            for key, value in self.values.iteritems():
+                journal["JOURNAL_" + key] = value
+            for key in self.lazy:
+                journal["JOURNAL_" + key] = LazyContextValue(self, key)
+            self.journal_view = journal
+        return self.journal_view
+
+
+def get_logging_context(request):
+    logging_context = request.__dict__.get('logging_context')
+    if type(logging_context) is not LoggingContext:
+        logging_context = request.logging_context = LoggingContext(logging_context)
+    return logging_context
+
+
+def update_logging_context(request, params, lazy=False):
+    """ Add params to request logging context, with ``lazy`` values of
+        params are callables computed on first access.
+    """
+    logging_context = get_logging_context(request)
+    setter = logging_context.set_lazy if lazy else logging_context.__setitem__
     for x, j in params.items():
-        request.logging_context[x.upper()] = j
+        setter(x.upper(), j)
 
 
 def raise_operation_error(request, error_handler, message):
@@ -310,12 +968,82 @@ class APIResource(object):
         self.LOGGER = getLogger(type(self).__module__)
 
 
+STALE_POLICIES = ('ok', 'update_after', 'fresh')
+
+
+class StalenessPolicy(object):
+    """ ``stale`` option of listing views by feed and mode.
+
+    ``ok`` reads index as is, ``update_after`` also starts index update
+    after read and ``fresh`` waits for index update. Policies are keyed
+    ``<feed>`` or ``<feed>.<mode>``, e.g. ``changes`` or ``dateModified.test``,
+    the most specific one applies.
+    """
+
+    def __init__(self, default='update_after', policies=None):
+        self.default = default
+        self.policies = policies or {}
+        for policy in [default] + self.policies.values():
+            if policy not in STALE_POLICIES:
+                raise ValueError('Unknown listing stale policy {!r}'.format(policy))
+
+    def get(self, feed, mode=''):
+        policy = self.policies.get('{}.{}'.format(feed, mode)) if mode else None
+        policy = policy or self.policies.get(feed, self.default)
+        return None if policy == 'fresh' else policy
+
+
+def listing_views():
+    """ Views of ``VIEW_MAP`` and ``CHANGES_VIEW_MAP`` of listing resources """
+    views = []
+    classes = APIResourceListing.__subclasses__()
+    while classes:
+        cls = classes.pop(0)
+        classes.extend(cls.__subclasses__())
+        for view_map in (getattr(cls, 'VIEW_MAP', {}), getattr(cls, 'CHANGES_VIEW_MAP', {})):
+            views.extend([i for _, i in sorted(view_map.items()) if i not in views])
+    return views
+
+
+def listing_fields_views(combinations):
+    """ (base view, fields, defaults) of fields views for opt_fields ``combinations``.
+
+    Only combinations exported from stored documents as is and of scalar
+    fields get views, as these copy field values into the index.
+    """
+    views = []
+    classes = APIResourceListing.__subclasses__()
+    while classes:
+        cls = classes.pop(0)
+        classes.extend(cls.__subclasses__())
+        if not cls.listing_model:
+            continue
+        for fields in combinations:
+            plan = projection_plan(cls.listing_model, cls.listing_role,
+                                   [i for i in fields if i not in ('id', 'dateModified')])
+            raw = sorted([i for i, _ in plan.raw])
+            if plan.model or not raw or not scalar_fields(cls.listing_model, raw):
+                continue
+            defaults = sorted([i for i, j in plan.raw if j])
+            for view_map in (getattr(cls, 'VIEW_MAP', {}), getattr(cls, 'CHANGES_VIEW_MAP', {})):
+                views.extend([
+                    (i, raw, defaults) for _, i in sorted(view_map.items())
+                    if (i, raw, defaults) not in views
+                ])
+    return views
+
+
 class APIResourceListing(APIResource):
+    listing_model = None  # enables custom fields projection from stored documents
+    listing_role = 'view'
 
     def __init__(self, request, context):
         super(APIResourceListing, self).__init__(request, context)
         self.server = request.registry.couchdb_server
         self.update_after = request.registry.update_after
+        self.stale = request.registry.listing_stale
+        self.stream = request.registry.listing_stream
+        self.fields_views = request.registry.fields_views
 
     @json_view(permission='view_listing')
     def get(self):
@@ -348,68 +1076,129 @@ class APIResourceListing(APIResource):
         if mode and mode in view_map:
             params['mode'] = mode
             pparams['mode'] = mode
-        view_limit = limit + 1 if offset else limit
-        if changes:
-            if offset:
+        view_offset_docid = None
+        if offset:
+            cursor = decode_cursor(self.server.uuid, self.db.name, offset)
+            if cursor:
+                view_offset, view_offset_docid = cursor
+            elif changes:
                 view_offset = decrypt(self.server.uuid, self.db.name, offset)
-                if view_offset and view_offset.isdigit():
-                    view_offset = int(view_offset)
-                else:
-                    self.request.errors.add('querystring', 'offset', 'Offset expired/invalid')
-                    self.request.errors.status = 404
-                    raise error_handler(self.request)
-            if not offset:
-                view_offset = 'now' if descending else 0
-        else:
-            if offset:
-                view_offset = offset
+                view_offset = int(view_offset) if view_offset.isdigit() else None
             else:
-                view_offset = '9' if descending else ''
-        list_view = view_map.get(mode, view_map[u''])
-        if self.update_after:
-            view = partial(list_view, self.db, limit=view_limit, startkey=view_offset, descending=descending, stale='update_after')
+                view_offset = offset
+            if changes and not isinstance(view_offset, (int, long)):
+                self.request.errors.add('querystring', 'offset', 'Offset expired/invalid')
+                self.request.errors.status = 404
+                raise error_handler(self.request)
+        elif changes:
+            view_offset = 'now' if descending else 0
         else:
-            view = partial(list_view, self.db, limit=view_limit, startkey=view_offset, descending=descending)
+            view_offset = '9' if descending else ''
+        list_view = view_map.get(mode, view_map[u''])
+        view_kwargs = dict(limit=limit, startkey=view_offset, descending=descending)
+        if view_offset_docid:
+            view_kwargs['startkey_docid'] = cursor_startkey_docid(view_offset_docid, descending)
+        elif offset:
+            view_kwargs['limit'] = limit + 1
+        stale = self.stale.get('changes' if changes else 'dateModified', mode if mode in view_map else '')
+        if self.update_after != self.request.registry.update_after:
+            # overridden by resource, as before listing_stale settings
+            stale = 'update_after' if self.update_after else None
+        if stale:
+            view_kwargs['stale'] = stale
         if fields:
-            if not changes and set(fields).issubset(set(self.FIELDS)):
-                results = [
-                    (dict([(i, j) for i, j in x.value.items() + [('id', x.id), ('dateModified', x.key)] if i in view_fields]), x.key)
-                    for x in view()
-                ]
-            elif changes and set(fields).issubset(set(self.FIELDS)):
-                results = [
-                    (dict([(i, j) for i, j in x.value.items() + [('id', x.id)] if i in view_fields]), x.key)
-                    for x in view()
-                ]
-            elif fields:
-                self.LOGGER.info('Used custom fields for {} list: {}'.format(self.object_name_for_listing, ','.join(sorted(fields))),
-                            extra=context_unpack(self.request, {'MESSAGE_ID': self.log_message_id}))
-
-                results = [
-                    (self.serialize_func(self.request, i[u'doc'], view_fields), i.key)
-                    for i in view(include_docs=True)
-                ]
+            if set(fields).issubset(set(self.FIELDS)):
+                serialize = partial(self.serialize_view_row, view_fields, changes)
+            else:
+                message = {'MESSAGE_ID': self.log_message_id}
+                serialize = lambda x: self.serialize_func(self.request, x[u'doc'], view_fields)
+                view_kwargs['include_docs'] = True
+                if self.listing_model:
+                    plan = projection_plan(self.listing_model, self.listing_role,
+                                           [i for i in fields if i not in ('id', 'dateModified')])
+                    message['FIELDS_COST'] = ','.join(['{}:{}'.format(i, j) for i, j in sorted(plan.cost.items())])
+                    if not plan.model:
+                        serialize = partial(self.project, plan, serialize)
+                        fields_view = self.fields_views and self.fields_views.get(
+                            self.db, list_view, [i for i, _ in plan.raw], [i for i, j in plan.raw if j])
+                        if fields_view:
+                            message['FIELDS_VIEW'] = fields_view.design
+                            list_view = fields_view
+                            del view_kwargs['include_docs']
+                            serialize = partial(self.serialize_fields_view_row, view_fields, changes, serialize)
+                if self.LOGGER.isEnabledFor(INFO):
+                    self.LOGGER.info('Used custom fields for {} list: {}'.format(
+                        self.object_name_for_listing, ','.join(sorted(fields))),
+                        extra=context_unpack(self.request, message))
+        elif changes:
+            serialize = lambda x: {'id': x.id, 'dateModified': x.value['dateModified']}
         else:
-            results = [
-                ({'id': i.id, 'dateModified': i.value['dateModified']} if changes else {'id': i.id, 'dateModified': i.key}, i.key)
-                for i in view()
-            ]
-        if results:
-            params['offset'], pparams['offset'] = results[-1][1], results[0][1]
-            if offset and view_offset == results[0][1]:
-                results = results[1:]
-            elif offset and view_offset != results[0][1]:
-                results = results[:limit]
-                params['offset'], pparams['offset'] = results[-1][1], view_offset
-            results = [i[0] for i in results]
-            if changes:
-                params['offset'] = encrypt(self.server.uuid, self.db.name, params['offset'])
-                pparams['offset'] = encrypt(self.server.uuid, self.db.name, pparams['offset'])
+            serialize = lambda x: {'id': x.id, 'dateModified': x.key}
+        if not fields:
+            item_paths = ()
+        elif self.listing_model:
+            item_paths = document_paths(self.listing_model, view_fields)
+        else:
+            item_paths = None
+        if self.stream and not getattr(self.request, 'override_renderer', None):
+            rows = batched_rows(list_view, self.db, STREAM_BATCH, **view_kwargs)
+            if offset and not view_offset_docid:
+                rows = offset_rows(rows, view_offset, limit)
+            body = self.stream_listing(rows, serialize, params, pparams, offset, descending, item_paths)
+            # errors of the first chunk are raised before response is started
+            first = next(body)
+            return Response(app_iter=chain([first], body), content_type='application/json')
+        if item_paths is not None:
+            self.request.document_url_paths = tuple([(EACH,) + i for i in item_paths])
+        rows = list_view(self.db, **view_kwargs)
+        if offset and not view_offset_docid:
+            rows = offset_rows(rows, view_offset, limit)
+        results = [(serialize(x), (x.key, x.id)) for x in rows]
+        data = {'data': [i[0] for i in results]}
+        data.update(self.get_pages(params, pparams, results[0][1] if results else None,
+                                   results[-1][1] if results else None, offset, descending))
+        return data
+
+    def serialize_view_row(self, view_fields, changes, row):
+        if changes:
+            items = row.value.items() + [('id', row.id)]
+        else:
+            items = row.value.items() + [('id', row.id), ('dateModified', row.key)]
+        return dict([(i, j) for i, j in items if i in view_fields])
+
+    def serialize_fields_view_row(self, view_fields, changes, serialize, row):
+        """ Row of generated fields view, documents which export
+            needs model are fetched and serialized as usual.
+        """
+        if row.value.get('_fallback'):
+            row = Row(row, doc=self.db.get(row.id))
+            return serialize(row)
+        return self.serialize_view_row(view_fields, changes, row)
+
+    def project(self, plan, serialize, row):
+        """ Listing item copied from stored document, model is built only
+            for documents missing fields with defaults.
+        """
+        doc = row[u'doc']
+        data = project_document(doc, plan)
+        if data is None:
+            return serialize(row)
+        data['id'] = row.id
+        if 'dateModified' in doc:
+            data['dateModified'] = doc['dateModified']
+        return data
+
+    def get_pages(self, params, pparams, first, last, offset, descending):
+        """ Next and previous page links; ``first`` and ``last`` are
+            (key, docid) of the page boundary rows.
+        """
+        if first:
+            params['offset'] = encode_cursor(self.server.uuid, self.db.name, *last)
+            pparams['offset'] = encode_cursor(self.server.uuid, self.db.name, *first)
         else:
             params['offset'] = offset
             pparams['offset'] = offset
-        data = {
-            'data': results,
+        pages = {
             'next_page': {
                 "offset": params['offset'],
                 "path": self.request.route_path(self.object_name_for_listing, _query=params),
@@ -417,12 +1206,54 @@ class APIResourceListing(APIResource):
             }
         }
         if descending or offset:
-            data['prev_page'] = {
+            pages['prev_page'] = {
                 "offset": pparams['offset'],
                 "path": self.request.route_path(self.object_name_for_listing, _query=pparams),
                 "uri": self.request.route_url(self.object_name_for_listing, _query=pparams)
             }
-        return data
+        return pages
+
+    def stream_listing(self, rows, serialize, params, pparams, offset, descending, item_paths=None):
+        """ Chunked JSON encoding of listing page.
+
+        Rows are serialized and URL-fixed one by one as they come from the
+        view, so memory doesn't depend on page size. ``item_paths`` are
+        ``document_paths`` of rows, whole rows are walked without them.
+        """
+        app_url = self.request.application_url
+        first = last = None
+        chunk = ['{"data": [']
+        started = False
+        try:
+            for row in rows:
+                item = serialize(row)
+                if item_paths is None:
+                    fix_url(item, app_url)
+                else:
+                    fix_url_paths(item, item_paths, app_url)
+                if first:
+                    chunk.append(', ')
+                else:
+                    first = (row.key, row.id)
+                last = (row.key, row.id)
+                chunk.append(dumps(item))
+                if len(chunk) > STREAM_BATCH:
+                    yield ''.join(chunk)
+                    started = True
+                    chunk = []
+        except Exception, e:
+            if not started:
+                raise
+            # response is already started with 200, page is closed with error
+            # instead of pages, so it can't be taken for complete one
+            self.LOGGER.error('Failed to stream {} list: {!r}'.format(self.object_name_for_listing, e),
+                              extra=context_unpack(self.request, {'MESSAGE_ID': 'listing_stream_failed'}))
+            chunk.append('], {}}}'.format(dumps(STREAM_ERROR)[1:-1]))
+            yield ''.join(chunk)
+            return
+        pages = self.get_pages(params, pparams, first, last, offset, descending)
+        chunk.append('], {}}}'.format(dumps(pages)[1:-1]))
+        yield ''.join(chunk)
 
 
 def set_modetest_titles(item):
@@ -437,31 +1268,95 @@ def set_modetest_titles(item):
 # Schematics Serialize Functions
 
 
-def serialize_document_url(document):
+def document_owner(document):
+    """ Request and parents of ``document`` from top resource down to its
+        parent. Documents share parents, so chain is cached in current
+        request for every parent.
+    """
+    parent = document.__parent__
+    current = get_current_request()
+    owners = current.__dict__.setdefault('document_owners', {}) if current is not None else {}
+    owner = owners.get(id(parent))
+    if owner is None or owner[0] is not parent or owner[1] is not parent.__parent__:
+        root = parent
+        parents = []
+        while root.__parent__ is not None:
+            parents[0:0] = [root]
+            root = root.__parent__
+        owner = owners[id(parent)] = (parent, parent.__parent__, root.request, parents)
+    return owner[2], owner[3]
+
+
+def document_field_allowed(request, cls, role, field):
+    """ Whether role of ``cls`` exports field named as ``field`` URL
+        segment, cached per request.
+    """
+    cache = request.__dict__.setdefault('document_url_roles', {})
+    key = (cls, role, field)
+    allowed = cache.get(key)
+    if allowed is None:
+        if "_" in field:
+            field = field[0] + field.title().replace("_", "")[1:]
+        roles = cls._options.roles
+        allowed = cache[key] = bool(roles[role if role in roles else 'default'](field, []))
+    return allowed
+
+
+def docservice_document(document):
+    """ Request, doc_id and prefix of permanent docservice URL of
+        ``document``, None if its URL is exported as is. Result is kept
+        in request for export after ``sign_document_urls``.
+    """
     url = document.url
     if not url or '?download=' not in url:
-        return url
-    doc_id = parse_qs(urlparse(url).query)['download'][-1]
-    root = document.__parent__
-    parents = []
-    while root.__parent__ is not None:
-        parents[0:0] = [root]
-        root = root.__parent__
-    request = root.request
+        return
+    request, parents = document_owner(document)
     if not request.registry.docservice_url:
-        return url
+        return
+    targets = request.__dict__.setdefault('docservice_documents', {})
+    key = (url, document.hash, parents[0].get('status'))
+    target = targets.get(id(document))
+    if target is not None and target[0] is document and target[1] == key:
+        return target[2]
+    target = find_docservice_document(document, request, parents, url)
+    targets[id(document)] = (document, key, target)
+    return target
+
+
+def find_docservice_document(document, request, parents, url):
+    path, query = url.split('?', 1)
+    doc_id = query[9:]
+    if not query.startswith('download=') or not doc_id.isalnum():
+        doc_id = parse_qs(query)['download'][-1]
+    segments = path.split('/')
     if 'status' in parents[0] and parents[0].status in type(parents[0])._options.roles:
         role = parents[0].status
+        count = len(parents)
         for index, obj in enumerate(parents):
-            if obj.id != url.split('/')[(index - len(parents)) * 2 - 1]:
+            if obj.id != segments[(index - count) * 2 - 1]:
                 break
-            field = url.split('/')[(index - len(parents)) * 2]
-            if "_" in field:
-                field = field[0] + field.title().replace("_", "")[1:]
-            roles = type(obj)._options.roles
-            if roles[role if role in roles else 'default'](field, []):
-                return url
+            if document_field_allowed(request, type(obj), role, segments[(index - count) * 2]):
+                return
     if not document.hash:
-        path = [i for i in urlparse(url).path.split('/') if len(i) == 32 and not set(i).difference(hexdigits)]
-        return generate_docservice_url(request, doc_id, False, '{}/{}'.format(path[0], path[-1]))
-    return generate_docservice_url(request, doc_id, False)
\ No newline at end of file
+        path = [i for i in (segments[3:] if '://' in path else segments)
+                if len(i) == 32 and not set(i).difference(hexdigits)]
+        return request, doc_id, '{}/{}'.format(path[0], path[-1])
+    return request, doc_id, None
+
+
+def serialize_document_url(document):
+    target = docservice_document(document)
+    if target is None:
+        return document.url
+    request, doc_id, prefix = target
+    return generate_docservice_url(request, doc_id, False, prefix)
+
+
+def sign_document_urls(documents):
+    """ Signs docservice URLs of ``documents`` in one batch, so their
+        export finds signatures in cache.
+    """
+    targets = [docservice_document(i) for i in documents if isinstance(i, Model) and i.__parent__ is not None]
+    targets = [i for i in targets if i is not None]
+    if targets:
+        docservice_signer(targets[0][0].registry).signatures([(doc_id, prefix) for _, doc_id, prefix in targets])
@@ -1,3 +1,4 @@
+from functools import partial as partial_func
 from schematics.exceptions import ModelValidationError, ModelConversionError
 from openregistry.api.constants import (
     DOCUMENT_BLACKLISTED_FIELDS,
@@ -5,14 +6,15 @@ from openregistry.api.constants import (
 )
 from openregistry.api.utils import (
     apply_data_patch, update_logging_context,
-    check_document, update_document_url,
-    error_handler, raise_operation_error
+    check_documents, update_document_url,
+    error_handler, raise_operation_error, request_json_body
 )
+from openregistry.api.models.patching import patched_model, export_fields
 
 
 def validate_json_data(request):
     try:
-        json = request.json_body
+        json = request_json_body(request)
     except ValueError, e:
         request.errors.add('body', 'data', e.message)
         request.errors.status = 422
@@ -29,7 +31,11 @@ def validate_data(request, model, partial=False, data=None):
     if data is None:
         data = validate_json_data(request)
     try:
-        if partial and isinstance(request.context, model):
+        if partial and isinstance(request.context, model) and getattr(request.registry, 'incremental_patch', False):
+            m, fields = patched_model(model, request.context, data)
+            role = request.context.get_role()
+            method = partial_func(export_fields, m, fields)
+        elif partial and isinstance(request.context, model):
             initial_data = request.context.serialize()
             m = model(initial_data)
             new_patch = apply_data_patch(initial_data, data)
@@ -110,7 +116,7 @@ def validate_document_data(request, error_handler, **kwargs):
 
     first_document = request.validated['documents'][-1] if 'documents' in request.validated and request.validated['documents'] else None
     document = request.validated['document']
-    check_document(request, document, 'body')
+    check_documents(request, [document], 'body')
 
     if first_document:
         for attr_name in type(first_document)._fields:
@@ -119,10 +125,40 @@ def validate_document_data(request, error_handler, **kwargs):
             elif attr_name not in DOCUMENT_BLACKLISTED_FIELDS and attr_name not in request.validated['json_data']:
                 setattr(document, attr_name, getattr(first_document, attr_name))
 
+    request.validated['document'] = attach_document(request, context, document)
+
+
+def validate_documents_data(request, error_handler, **kwargs):
+    """ Validates list of new documents in ``data``, document service urls
+        of all of them are checked at once.
+    """
+    context = request.context if 'documents' in request.context else request.context.__parent__
+    model = type(context).documents.model_class
+    try:
+        json = request_json_body(request)
+    except ValueError, e:
+        request.errors.add('body', 'data', e.message)
+        request.errors.status = 422
+        raise error_handler(request)
+    if not isinstance(json, dict) or not isinstance(json.get('data'), list) or \
+            not json['data'] or not all([isinstance(i, dict) for i in json['data']]):
+        request.errors.add('body', 'data', "Data not available")
+        request.errors.status = 422
+        raise error_handler(request)
+    documents, validated = [], []
+    for data in json['data']:
+        validated.append(validate_data(request, model, data=data))
+        documents.append(request.validated['document'])
+    check_documents(request, documents, 'body')
+    request.validated['json_data'] = json['data']
+    request.validated['data'] = validated
+    request.validated['new_documents'] = [attach_document(request, context, i) for i in documents]
+
+
+def attach_document(request, context, document):
     document.documentOf = type(context).__name__.lower()
     document_route = request.matched_route.name.replace("collection_", "")
-    document = update_document_url(request, document, document_route, {})
-    request.validated['document'] = document
+    return update_document_url(request, document, document_route, {})
 
 
 def validate_file_upload(request, error_handler, **kwargs):
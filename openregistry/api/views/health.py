@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from json import dumps
 from cornice.service import Service
 from pyramid.response import Response
 
@@ -19,9 +20,19 @@ def get_health(request):
         health_threshold = request.registry.health_threshold
     health_threshold_func_name = request.params.get('health_threshold_func', request.registry.health_threshold_func)
     health_threshold_func = HEALTH_THRESHOLD_FUNCTIONS.get(health_threshold_func_name, all)
-    if not(output and health_threshold_func(
-            [True if (task['source_seq'] - task['checkpointed_source_seq']) <= health_threshold else False
-             for task in tasks if 'type' in task and task['type'] == 'replication']
-    )):
-        return Response(json_body=output, status=503)
+    healthy = output and health_threshold_func(
+        [True if (task['source_seq'] - task['checkpointed_source_seq']) <= health_threshold else False
+         for task in tasks if 'type' in task and task['type'] == 'replication']
+    )
+    headers = {}
+    index_warmer = getattr(request.registry, 'index_warmer', None)
+    if index_warmer:
+        # body is keyed by replication ids only, lag of indexes goes to header
+        headers['X-Index-Lag'] = dumps(index_warmer.lag, sort_keys=True)
+        index_lag_threshold = request.registry.index_lag_threshold
+        if index_lag_threshold and any(i > index_lag_threshold for i in index_warmer.lag.values()):
+            healthy = False
+    if not healthy:
+        return Response(json_body=output, status=503, headers=headers)
+    request.response.headers.update(headers)
     return output
@@ -38,7 +38,8 @@ entry_points = {
         'api = openregistry.api.tests.main:suite'
     ],
     'console_scripts': [
-        'bootstrap_api_security = openregistry.api.database:bootstrap_api_security'
+        'bootstrap_api_security = openregistry.api.database:bootstrap_api_security',
+        'migrate_api_data = openregistry.api.migration:migrate_api_data'
     ]
 }
 